@@ -4,19 +4,29 @@
     __init__.py
     ~~~~~~~~~~
 """
+import copy
 import json
+import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from functools import partial
+from itertools import islice
 
 import hashlib
-import OpenSSL
-from Cryptodome.Hash import SHA, SHA256
-from Cryptodome.PublicKey import RSA
-from Cryptodome.Signature import PKCS1_v1_5
+import os
+import threading
+import time
 
 from .compat import decodebytes, encodebytes, quote_plus, urlopen
+from .crypto import get_backend
+from .jsonlib import StdlibJSON, get_backend as get_json_backend
+from .keystore import default_store
 from .exceptions import AliPayException, AliPayValidationError
-from .utils import AliPayConfig
+from .hooks import emit, record_build_body, start_event
+from .singleflight import READ_ONLY_METHODS, SingleFlight, request_key
+from .snapshot import KeySnapshot
+from .streaming import TAIL_PATTERN, TAIL_SIZE, read_stream
+from .utils import AliPayConfig, BatchResult
 from .loggers import logger
 
 
@@ -31,6 +41,42 @@ CryptoAlgSet = (
     b'sha512WithRSAEncryption'
 )
 
+# apis sending app_notify_url by default
+NOTIFY_METHODS = (
+    "alipay.trade.app.pay", "alipay.trade.wap.pay",
+    "alipay.trade.page.pay", "alipay.trade.pay",
+    "alipay.trade.precreate", "alipay.trade.create"
+)
+
+JSON_DECODER = json.JSONDecoder()
+SIGN_PATTERNS = {
+    str: re.compile(r'"sign"\s*:\s*"((?:[^"\\]|\\.)*)"'),
+    bytes: re.compile(rb'"sign"\s*:\s*"((?:[^"\\]|\\.)*)"'),
+}
+ERROR_RESPONSE_PATTERNS = {
+    str: re.compile(r'"error_response"\s*:'),
+    bytes: re.compile(rb'"error_response"\s*:'),
+}
+ALIPAY_CERT_SN_PATTERNS = {
+    str: re.compile(r'"alipay_cert_sn"\s*:\s*"(\w+)"'),
+    bytes: re.compile(rb'"alipay_cert_sn"\s*:\s*"(\w+)"'),
+}
+
+
+class RequestTemplate:
+    """
+    static fields of one api method and their "k=v" pairs, both raw and url encoded,
+    computed once and shared by every request of the method
+    """
+    __slots__ = ("fields", "values", "raw_pairs", "quoted_pairs")
+
+    def __init__(self, fields, extra_fields=None):
+        # fields are copied into every request, extra_fields are the default values of optional ones
+        self.fields = fields
+        self.values = dict(fields, **(extra_fields or {}))
+        self.raw_pairs = {k: "{}={}".format(k, v) for k, v in self.values.items()}
+        self.quoted_pairs = {k: "{}={}".format(k, quote_plus(v)) for k, v in self.values.items()}
+
 
 class BaseAliPay:
     @property
@@ -76,9 +122,26 @@ class BaseAliPay:
         self._alipay_public_key_string = alipay_public_key_string
         self._verbose = verbose
         self._config = config or AliPayConfig()
+        self._transport = self._config.transport
+        self._signer = self._config.signer
+        self._crypto = get_backend(self._config.crypto_backend)
+        self._notify_cache = self._config.notify_cache
+        self._json = get_json_backend(self._config.json_backend)
+        self._hooks = tuple(self._config.hooks or ())
+        single_flight = self._config.single_flight
+        if single_flight is True:
+            single_flight = READ_ONLY_METHODS
+        self._single_flight_methods = frozenset(single_flight or ())
+        self._flight = SingleFlight()
+        self._trade_cache = self._config.trade_cache
+        response_objects = self._config.response_objects
+        if response_objects is True:
+            from .responses import RESPONSE_CLASSES as response_objects
+        self._response_classes = response_objects or None
 
         self._app_private_key = None
         self._alipay_public_key = None
+        self._templates = {}
         if sign_type not in ("RSA", "RSA2"):
             message = "Unsupported sign type {}".format(sign_type)
             raise AliPayException(None, message)
@@ -89,18 +152,59 @@ class BaseAliPay:
             self._gateway = "https://openapi-sandbox.dl.alipaydev.com/gateway.do"
         else:
             self._gateway = "https://openapi.alipay.com/gateway.do"
+        if self._config.gateway:
+            self._gateway = self._config.gateway
 
         # load key file immediately
         self._load_key()
 
+    def _cached(self, kind, content, loader, scope=None):
+        """loader(content), shared with other clients through the key store"""
+        store = self._config.key_store
+        if store is None:
+            store = default_store
+        return store.get(kind, content, loader, scope)
+
+    def _parse_private_key(self, content):
+        snapshot = self._config.key_snapshot
+        der = snapshot.get("private_key", content) if snapshot is not None else None
+        if der is not None:
+            # validated when the snapshot was taken
+            return self._crypto.load_private_key(der, validate=False)
+        return self._crypto.load_private_key(content)
+
+    def _parse_public_key(self, content):
+        snapshot = self._config.key_snapshot
+        der = snapshot.get("public_key", content) if snapshot is not None else None
+        return self._crypto.load_public_key(der if der is not None else content)
+
     def _load_key(self):
         # load private key
-        content = self._app_private_key_string
-        self._app_private_key = RSA.importKey(content)
+        self._app_private_key = self._cached(
+            "private_key", self._app_private_key_string, self._parse_private_key, self._crypto
+        )
 
         # load public key
-        content = self._alipay_public_key_string
-        self._alipay_public_key = RSA.importKey(content)
+        self._alipay_public_key = self._cached(
+            "public_key", self._alipay_public_key_string, self._parse_public_key, self._crypto
+        )
+
+    def snapshot_keys(self, snapshot=None):
+        """
+        adds the parsed key material of this client to snapshot, a new alipay.snapshot.KeySnapshot
+        if not given, and returns it. Pass it to AliPayConfig(key_snapshot=...) to skip parsing
+        """
+        if snapshot is None:
+            snapshot = KeySnapshot()
+        snapshot.set(
+            "private_key", self._app_private_key_string,
+            self._crypto.export_private_key(self._app_private_key)
+        )
+        snapshot.set(
+            "public_key", self._alipay_public_key_string,
+            self._crypto.export_public_key(self._alipay_public_key)
+        )
+        return snapshot
 
     def _sign(self, unsigned_string):
         """
@@ -119,13 +223,16 @@ class BaseAliPay:
         方法3
             echo "abc" | openssl sha1 -sign alipay.key | openssl base64
         """
+        if self._signer is not None:
+            return self._signer.sign(
+                self._app_private_key_string, self._sign_type, unsigned_string,
+                self._sign_in_process, backend=self._crypto.name
+            )
+        return self._sign_in_process(unsigned_string)
+
+    def _sign_in_process(self, unsigned_string):
         # 开始计算签名
-        key = self.app_private_key
-        signer = PKCS1_v1_5.new(key)
-        if self._sign_type == "RSA":
-            signature = signer.sign(SHA.new(unsigned_string.encode()))
-        else:
-            signature = signer.sign(SHA256.new(unsigned_string.encode()))
+        signature = self._crypto.sign(self.app_private_key, unsigned_string.encode(), self._sign_type)
         # base64 编码，转换为 unicode 表示并移除回车
         sign = encodebytes(signature).decode().replace("\n", "")
         return sign
@@ -134,29 +241,43 @@ class BaseAliPay:
         for k, v in data.items():
             if isinstance(v, dict):
                 # 将字典类型的数据dump出来
-                data[k] = json.dumps(v, separators=(',', ':'))
+                data[k] = self._json.dumps(v)
+            elif isinstance(v, bytes):
+                # 已经序列化好的数据, 例如 biz_content
+                data[k] = v.decode()
         return sorted(data.items())
 
-    def build_body(self, method, biz_content=None, **kwargs):
-        if not biz_content:
-            biz_content = {}
-            
-        data = {
+    def _static_fields(self, method):
+        """fields which are the same for every request of method"""
+        return {
             "app_id": self._appid,
             "method": method,
             "charset": "utf-8",
             "sign_type": self._sign_type,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "version": "1.0",
-            "biz_content": biz_content
         }
+
+    def _get_template(self, method):
+        template = self._templates.get(method)
+        if template is None:
+            extra_fields = {}
+            if method in NOTIFY_METHODS and self._app_notify_url:
+                extra_fields["notify_url"] = self._app_notify_url
+            template = self._templates[method] = RequestTemplate(self._static_fields(method), extra_fields)
+        return template
+
+    def build_body(self, method, biz_content=None, **kwargs):
+        if self._hooks:
+            wall, cpu = time.perf_counter(), time.thread_time()
+        if not biz_content:
+            biz_content = {}
+
+        data = dict(self._get_template(method).fields)
+        data["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        data["biz_content"] = biz_content
         data.update(kwargs)
 
-        if method in (
-            "alipay.trade.app.pay", "alipay.trade.wap.pay",
-            "alipay.trade.page.pay", "alipay.trade.pay",
-            "alipay.trade.precreate", "alipay.trade.create"
-        ) and not data.get("notify_url") and self._app_notify_url:
+        if method in NOTIFY_METHODS and not data.get("notify_url") and self._app_notify_url:
             data["notify_url"] = self._app_notify_url
 
         # the following keys are optional, and should be removed if it's empty
@@ -168,32 +289,46 @@ class BaseAliPay:
         if self._verbose:
             logger.debug("data to be signed")
             logger.debug(data)
+        if self._hooks:
+            record_build_body(method, time.perf_counter() - wall, time.thread_time() - cpu)
         return data
 
     def sign_data(self, data):
         # 排序后的字符串
         ordered_items = self._ordered_data(data)
-        raw_string = "&".join("{}={}".format(k, v) for k, v in ordered_items)
+        template = self._templates.get(data.get("method"))
+        values = template.values if template else {}
+        raw_pairs = []
+        quoted_pairs = []
+        for k, v in ordered_items:
+            # pairs of static fields are precompiled, only the dynamic ones are formatted
+            if k in values and values[k] == v:
+                raw_pairs.append(template.raw_pairs[k])
+                quoted_pairs.append(template.quoted_pairs[k])
+            else:
+                raw_pairs.append("{}={}".format(k, v))
+                quoted_pairs.append("{}={}".format(k, quote_plus(v)))
+        raw_string = "&".join(raw_pairs)
         sign = self._sign(raw_string)
-        unquoted_items = ordered_items + [('sign', sign)]
+        quoted_pairs.append("sign={}".format(quote_plus(sign)))
 
         # 获得最终的订单信息字符串
-        signed_string = "&".join("{}={}".format(k, quote_plus(v)) for k, v in unquoted_items)
+        signed_string = "&".join(quoted_pairs)
         if self._verbose:
             logger.debug("signed srtring")
             logger.debug(signed_string)
         return signed_string
 
-    def _verify(self, raw_content, signature):
+    def _verify(self, raw_content, signature, public_key=None):
+        """raw_content may be str or any bytes-like object, e.g. memoryview"""
+        if isinstance(raw_content, str):
+            raw_content = raw_content.encode()
+        if isinstance(signature, str):
+            signature = signature.encode()
         # 开始计算签名
-        key = self.alipay_public_key
-        signer = PKCS1_v1_5.new(key)
-        if self._sign_type == "RSA":
-            digest = SHA.new()
-        else:
-            digest = SHA256.new()
-        digest.update(raw_content.encode())
-        return bool(signer.verify(digest, decodebytes(signature.encode())))
+        return self._crypto.verify(
+            public_key or self.alipay_public_key, raw_content, decodebytes(signature), self._sign_type
+        )
 
     def verify(self, data, signature):
         if "sign_type" in data:
@@ -203,7 +338,21 @@ class BaseAliPay:
         # 排序后的字符串
         unsigned_items = self._ordered_data(data)
         message = "&".join(u"{}={}".format(k, v) for k, v in unsigned_items)
-        return self._verify(message, signature)
+        if self._notify_cache is None or not data.get("notify_id"):
+            result = self._verify(message, signature)
+        else:
+            # alipay retries notifications, the same notification is only verified once.
+            # message and public key are part of the key so a cached result can't be reused for other data
+            key = hashlib.sha256("\0".join((
+                self._alipay_public_key_string, data["notify_id"], signature, message
+            )).encode()).digest()
+            result = self._notify_cache.get(key)
+            if result is None:
+                result = self._verify(message, signature)
+                self._notify_cache.set(key, result)
+        if result and self._trade_cache is not None:
+            self._trade_cache.update_from_notify(data)
+        return result
 
     def client_api(self, api_name, biz_content=None, **kwargs):
         """
@@ -228,6 +377,139 @@ class BaseAliPay:
         # print(data)
         return self.verified_sync_response(data, response_type)
 
+    def server_api_stream(
+        self, api_name, biz_content=None, chunk_size=64 * 1024, spool_size=1024 * 1024, **kwargs
+    ):
+        """
+        like server_api, but the response is read and verified incrementally,
+        at most spool_size bytes are kept in memory and the rest is spooled to a temporary file.
+        returns alipay.streaming.StreamingResponse, top level arrays are lazy iterators
+
+        with alipay.server_api_stream("alipay.ebpp.invoice.token.batchquery", biz_content) as response:
+            for invoice in response["invoice_info_list"]:
+                ...
+        """
+        data = self.build_body(api_name, biz_content or {}, **kwargs)
+        response_type = api_name.replace(".", "_") + "_response"
+        url = self._gateway + "?" + self.sign_data(data)
+        response = self._call_gateway(data["method"], self._open, url)
+        try:
+            return read_stream(self, response, response_type, chunk_size, spool_size)
+        finally:
+            response.close()
+
+    def _iter_concurrently(self, func, keyed_args, max_workers):
+        """
+        call func(*args) for every (key, args) on a thread pool, at most max_workers calls are in flight.
+        BatchResult is yielded in completion order, exceptions are returned instead of raised
+        """
+        keyed_args = iter(keyed_args)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {}
+
+            def submit(count):
+                for key, args in islice(keyed_args, count):
+                    pending[executor.submit(func, *args)] = key
+
+            submit(max_workers)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = pending.pop(future)
+                    exception = future.exception()
+                    if exception is None:
+                        yield BatchResult(key, future.result(), None)
+                    else:
+                        yield BatchResult(key, None, exception)
+                submit(len(done))
+
+    def server_api_many(self, calls, max_workers=8):
+        """
+        run server_api for every (api_name, biz_content) in calls concurrently,
+        yields BatchResult(key, response, exception) in completion order, key is the index in calls
+
+        for result in alipay.server_api_many([
+            ("alipay.trade.query", {"out_trade_no": "1"}),
+            ("alipay.trade.fastpay.refund.query", {"out_trade_no": "1", "out_request_no": "1"}),
+        ]):
+            ...
+        """
+        return self._iter_concurrently(
+            self.server_api, enumerate(calls), max_workers
+        )
+
+    def api_alipay_trade_query_many(self, out_trade_nos, max_workers=8):
+        """
+        query orders concurrently, yields BatchResult(out_trade_no, response, exception) in completion order
+        """
+        return self._iter_concurrently(
+            self.api_alipay_trade_query,
+            ((out_trade_no, (out_trade_no,)) for out_trade_no in out_trade_nos),
+            max_workers
+        )
+
+    def api_alipay_data_dataservice_bill_downloadurl_query(self, bill_type, bill_date, **kwargs):
+        """
+        bill_type: trade, signcustomer, ...
+        bill_date: 2023-01-01 for daily bills, 2023-01 for monthly bills
+
+        response = {
+            "code": "10000",
+            "msg": "Success",
+            "bill_download_url": "http://dwbillcenter.alipay.com/downloadBillFile.resource?..."
+        }
+        """
+        biz_content = {
+            "bill_type": bill_type,
+            "bill_date": bill_date
+        }
+        biz_content.update(kwargs)
+        data = self.build_body("alipay.data.dataservice.bill.downloadurl.query", biz_content)
+        response_type = "alipay_data_dataservice_bill_downloadurl_query_response"
+        return self.verified_sync_response(data, response_type)
+
+    def download_bill(self, bill_type, bill_date, fileobj=None, chunk_size=64 * 1024, spool_size=1024 * 1024,
+                      **kwargs):
+        """
+        downloads a bill into fileobj, or into a temporary file keeping at most spool_size bytes in memory,
+        and returns alipay.bill.Bill, whose rows are parsed lazily
+
+        with alipay.download_bill("trade", "2023-01-01") as bill:
+            for row in bill.rows():
+                ...
+        """
+        from .bill import Bill, fetch
+
+        result = self.api_alipay_data_dataservice_bill_downloadurl_query(bill_type, bill_date, **kwargs)
+        url = result.get("bill_download_url")
+        if not url:
+            raise AliPayException(
+                result.get("sub_code") or result.get("code"), result.get("sub_msg") or result.get("msg")
+            )
+        return Bill(fetch(self._open, url, fileobj, chunk_size, spool_size), bill_type, bill_date)
+
+    def download_bills(self, bills, directory=None, max_workers=4):
+        """
+        downloads every (bill_type, bill_date) in bills concurrently, into directory if given,
+        yields BatchResult((bill_type, bill_date), Bill, exception) in completion order
+        """
+        def download(bill_type, bill_date):
+            fileobj = None
+            if directory is not None:
+                path = os.path.join(directory, "{}_{}.zip".format(bill_type, bill_date))
+                fileobj = open(path, "w+b")
+            try:
+                return self.download_bill(bill_type, bill_date, fileobj)
+            except BaseException:
+                if fileobj is not None:
+                    fileobj.close()
+                raise
+
+        return self._iter_concurrently(
+            download, (((bill_type, bill_date), (bill_type, bill_date)) for bill_type, bill_date in bills),
+            max_workers
+        )
+
     def api_alipay_trade_wap_pay(
         self, subject, out_trade_no, total_amount,
         return_url=None, notify_url=None, **kwargs
@@ -577,6 +859,9 @@ class BaseAliPay:
         """
         return response if verification succeeded, raise exception if not
 
+        raw_string may be str, bytes or memoryview, the signed span is verified in place
+        and only the span is parsed as json
+
         As to issue #69, json.loads(raw_string)[response_type] should not be returned directly,
         use json.loads(plain_content) instead
 
@@ -599,50 +884,246 @@ class BaseAliPay:
             },
             "alipay_cert_sn": "a5b59edf65dcda9ca26e071ab6f5a0a7",
             "sign": ""
-        } 
+        }
 
         """
-        response = json.loads(raw_string)
-        if "sign" not in response.keys() or "error_response" in response.keys():
-            result = response.get(response_type, None) or response.get("error_response")
+        response_class = self._response_classes and self._response_classes.get(response_type)
+        if response_class is not None:
+            response = self._verify_lazily(raw_string, response_type, response_class)
+            if response is not None:
+                return response
+
+        kind = str if isinstance(raw_string, str) else bytes
+        start, end, result = self._parse_signed_span(raw_string, response_type)
+        sign = self._find_sign(raw_string, start, end)
+        error_pattern = ERROR_RESPONSE_PATTERNS[kind]
+        has_error = error_pattern.search(raw_string, max(end, 0)) or \
+            error_pattern.search(raw_string, 0, max(start, 0))
+
+        if sign is None or has_error:
+            if result is None:
+                result = self._parse_signed_span(raw_string, "error_response")[2]
+            if kind is bytes:
+                raw_string = str(raw_string, "utf-8")
             raise AliPayException(
-                code=result.get("code", "0"),
+                code=(result or {}).get("code", "0"),
                 message=raw_string
             )
 
-        sign = response["sign"]
-
-        # locate string to be signed
-        plain_content = self._get_string_to_be_signed(raw_string, response_type)
+        if result is None:
+            raise AliPayValidationError
+        # bytes are verified in place without being copied
+        plain_content = memoryview(raw_string)[start:end] if kind is bytes else raw_string[start:end]
+        if not self._verify(plain_content, sign, self._response_public_key(raw_string, start, end)):
+            raise AliPayValidationError
+        if response_class is not None:
+            return response_class.from_dict(result, self._json)
+        return result
 
-        if not self._verify(plain_content, sign):
+    def _verify_lazily(self, raw_string, response_type, response_class):
+        """
+        verifies the signed span without parsing it and wraps it into response_class,
+        returns None if the span can't be located that way or the response is an error
+        """
+        if isinstance(raw_string, str):
+            return None
+        span = self._locate_signed_span_by_tail(raw_string, response_type)
+        if span is None:
+            return None
+        start, end = span
+        sign = self._find_sign(raw_string, start, end)
+        error_pattern = ERROR_RESPONSE_PATTERNS[bytes]
+        if sign is None or error_pattern.search(raw_string, end) \
+                or error_pattern.search(raw_string, 0, start):
+            return None
+        plain_content = memoryview(raw_string)[start:end]
+        if not self._verify(plain_content, sign, self._response_public_key(raw_string, start, end)):
             raise AliPayValidationError
-        return json.loads(plain_content)
+        return response_class(bytes(plain_content), self._json)
+
+    def _response_object(self, result, response_type):
+        """result as the configured response object of response_type, e.g. of a cached notification"""
+        response_class = self._response_classes and self._response_classes.get(response_type)
+        if response_class is None or isinstance(result, response_class):
+            return result
+        return response_class.from_dict(result, self._json)
+
+    def _response_public_key(self, raw_string, start, end):
+        """public key verifying a sync response, None means alipay_public_key"""
+        return None
+
+    def _find_sign(self, raw_string, start, end):
+        """sign is a top level key, so the signed span is skipped while searching"""
+        kind = str if isinstance(raw_string, str) else bytes
+        pattern = SIGN_PATTERNS[kind]
+        match = pattern.search(raw_string, max(end, 0)) or pattern.search(raw_string, 0, max(start, 0))
+        if match is None:
+            return None
+        sign = match.group(1)
+        if ("\\" if kind is str else b"\\") in sign:
+            # json escaped, e.g. "\/"
+            quote = '"' if kind is str else b'"'
+            sign = json.loads(quote + sign + quote)
+        return sign
+
+    def _request(self, url, data=None):
+        if self._transport is None:
+            return urlopen(url, data=data, timeout=self._config.timeout).read()
+        return self._transport.request(url, data=data, timeout=self._config.timeout)
+
+    def _open(self, url, data=None):
+        """like _request, but returns the file-like response"""
+        if self._transport is None:
+            return urlopen(url, data=data, timeout=self._config.timeout)
+        return self._transport.open(url, data=data, timeout=self._config.timeout)
+
+    def _call_gateway(self, method, func, *args):
+        """func(*args) under the retry policy, if any"""
+        policy = self._config.retry_policy
+        if policy is None:
+            return func(*args)
+        return policy.call(self._gateway, method, func, *args)
 
     def verified_sync_response(self, data, response_type):
+        trade_cache = self._trade_cache if data["method"] == "alipay.trade.query" else None
+        if trade_cache is not None:
+            result = trade_cache.lookup(data)
+            if result is not None:
+                return self._response_object(result, response_type)
+
+        if data["method"] in self._single_flight_methods:
+            result = self._flight.do(
+                request_key(data, response_type), self._sync_response, data, response_type
+            )
+            # every caller gets its own copy
+            result = copy.deepcopy(result)
+        else:
+            result = self._sync_response(data, response_type)
+
+        if trade_cache is not None:
+            trade_cache.store(data, result)
+        return result
+
+    def _sync_response(self, data, response_type):
+        if self._hooks:
+            return self._instrumented_sync_response(data, response_type)
         url = self._gateway + "?" + self.sign_data(data)
-        raw_string = urlopen(url, timeout=self._config.timeout).read().decode()
+        raw_string = self._call_gateway(data["method"], self._request, url)
         return self._verify_and_return_sync_response(raw_string, response_type)
 
+    def _end_event(self, event, result=None, exception=None):
+        """fills in the outcome of a call and passes the event to hooks"""
+        if result is not None:
+            event.code, event.sub_code = result.get("code"), result.get("sub_code")
+        if exception is not None:
+            event.exception = exception
+            if isinstance(exception, AliPayException):
+                event.code = exception.code
+        policy = self._config.retry_policy
+        if policy is not None:
+            event.breaker_state = policy.breaker(self._gateway).state
+        emit(self._hooks, event)
+
+    def _instrumented_sync_response(self, data, response_type):
+        """verified_sync_response reporting a CallEvent to hooks"""
+        event = start_event(data["method"])
+
+        def request(url):
+            event.attempts += 1
+            return self._request(url)
+
+        try:
+            with event.timer("sign"):
+                url = self._gateway + "?" + self.sign_data(data)
+            event.request_size = len(url)
+            with event.timer("request"):
+                raw_string = self._call_gateway(data["method"], request, url)
+            event.response_size = len(raw_string)
+            with event.timer("verify"):
+                result = self._verify_and_return_sync_response(raw_string, response_type)
+        except Exception as e:
+            self._end_event(event, exception=e)
+            raise
+        self._end_event(event, result)
+        return result
+
+    def close(self):
+        """release connections held by the transport"""
+        if self._transport is not None:
+            self._transport.close()
+
     def _get_string_to_be_signed(self, raw_string, response_type):
         """
         https://docs.open.alipay.com/200/106120
         从同步返回的接口里面找到待签名的字符串
         """
-        balance = 0
-        start = end = raw_string.find("{", raw_string.find(response_type))
-        # 从response_type之后的第一个｛的下一位开始匹配，
-        # 如果是｛则balance加1; 如果是｝而且balance=0，就是待验签字符串的终点
-        for i, c in enumerate(raw_string[start + 1:], start + 1):
-            if c == "{":
-                balance += 1
-            elif c == "}":
-                if balance == 0:
-                    end = i + 1
-                    break
-                balance -= 1
+        start, end = self._find_signed_span(raw_string, response_type)
         return raw_string[start:end]
 
+    def _find_signed_span(self, raw_string, response_type):
+        """
+        returns (start, end) of the value of response_type, start == end if it can't be located.
+        raw_string may be str, bytes or memoryview
+        """
+        return self._parse_signed_span(raw_string, response_type)[:2]
+
+    def _parse_signed_span(self, raw_string, response_type):
+        """
+        locate the value of response_type and parse it in a single pass with json's C scanner,
+        returns (start, end, value), value is None if it can't be located.
+        offsets are in bytes if raw_string is bytes or memoryview
+        """
+        if not isinstance(raw_string, str) and not isinstance(self._json, StdlibJSON):
+            span = self._parse_signed_span_by_tail(raw_string, response_type)
+            if span is not None:
+                return span
+
+        text = raw_string if isinstance(raw_string, str) else str(raw_string, "utf-8")
+        # the key itself is consumed up to its closing quote
+        key_match = re.compile(re.escape('"' + response_type) + r'(?:[^"\\]|\\.)*"').search(text)
+        start = text.find("{", key_match.end()) if key_match else -1
+        if start < 0:
+            return -1, -1, None
+        try:
+            value, end = JSON_DECODER.raw_decode(text, start)
+        except ValueError:
+            return start, start, None
+
+        if text is not raw_string and len(text) != len(raw_string):
+            # non ascii characters, only the short head and tail are encoded to get the offsets
+            start = len(text[:start].encode())
+            end = len(raw_string) - len(text[end:].encode())
+        return start, end, value
+
+    def _parse_signed_span_by_tail(self, raw_string, response_type):
+        """
+        sign and alipay_cert_sn always come after the signed span, so the end of the span is
+        located by matching the short tail and the span is handed to the json backend as is.
+        returns None if the tail doesn't look like that
+        """
+        span = self._locate_signed_span_by_tail(raw_string, response_type)
+        if span is None:
+            return None
+        start, end = span
+        try:
+            value = self._json.loads(memoryview(raw_string)[start:end])
+        except ValueError:
+            return start, start, None
+        return start, end, value
+
+    def _locate_signed_span_by_tail(self, raw_string, response_type):
+        """(start, end) of the signed span in bytes, without parsing it"""
+        key = re.escape(('"' + response_type).encode()) + rb'(?:[^"\\]|\\.)*"\s*:\s*'
+        key_match = re.compile(key).search(raw_string)
+        if key_match is None or raw_string[key_match.end():key_match.end() + 1] != b"{":
+            return None
+        start = key_match.end()
+        tail_start = max(start, len(raw_string) - TAIL_SIZE)
+        tail_match = TAIL_PATTERN.search(raw_string, tail_start)
+        if tail_match is None:
+            return None
+        return start, tail_match.start() + 1
+
 
 class AliPay(BaseAliPay):
     pass
@@ -663,7 +1144,8 @@ class DCAliPay(BaseAliPay):
         app_notify_url=None,
         sign_type="RSA2",
         debug=False,
-        verbose=False
+        verbose=False,
+        config=None
     ):
         """
         初始化
@@ -679,7 +1161,12 @@ class DCAliPay(BaseAliPay):
         self._app_public_key_cert_string = app_public_key_cert_string
         self._alipay_public_key_cert_string = alipay_public_key_cert_string
         self._alipay_root_cert_string = alipay_root_cert_string
-        alipay_public_key_string = self.load_alipay_public_key_string()
+        self._config = config or AliPayConfig()
+        alipay_public_key_string = self._cached(
+            "cert_public_key",
+            alipay_public_key_cert_string,
+            self._snapshot_or("cert_public_key", lambda _: self.load_alipay_public_key_string())
+        )
         super().__init__(
             appid=appid,
             app_notify_url=app_notify_url,
@@ -687,9 +1174,18 @@ class DCAliPay(BaseAliPay):
             alipay_public_key_string=alipay_public_key_string,
             sign_type=sign_type,
             debug=debug,
-            verbose=verbose
+            verbose=verbose,
+            config=self._config
         )
 
+    def _snapshot_or(self, kind, parse):
+        """loader taking the value from the key snapshot if it's there"""
+        def load(content):
+            snapshot = self._config.key_snapshot
+            value = snapshot.get(kind, content) if snapshot is not None else None
+            return parse(content) if value is None else value
+        return load
+
     def api_alipay_open_app_alipaycert_download(self, alipay_cert_sn):
         """
         下载支付宝证书
@@ -701,29 +1197,155 @@ class DCAliPay(BaseAliPay):
         data = self.build_body("alipay.open.app.alipaycert.download", biz_content)
         return self.sign_data(data)
 
-    def build_body(self, *args, **kwargs):
-        data = super().build_body(*args, **kwargs)
-        data["app_cert_sn"] = self.app_cert_sn
-        data["alipay_root_cert_sn"] = self.alipay_root_cert_sn
-        if self._verbose:
-            logger.debug("data to be signed")
-            logger.debug(data)
-        return data
+    @property
+    def alipay_cert_sn(self):
+        if not hasattr(self, "_alipay_cert_sn"):
+            self._alipay_cert_sn = self._cached(
+                "cert_sn", self._alipay_public_key_cert_string, self._snapshot_or("cert_sn", self.get_cert_sn)
+            )
+        return self._alipay_cert_sn
+
+    def _response_public_key(self, raw_string, start, end):
+        # 支付宝公钥证书无感知升级: 响应中的 alipay_cert_sn 不是当前证书时, 下载并校验新证书
+        pattern = ALIPAY_CERT_SN_PATTERNS[str if isinstance(raw_string, str) else bytes]
+        match = pattern.search(raw_string, max(end, 0)) or pattern.search(raw_string, 0, max(start, 0))
+        if match is None:
+            return None
+        sn = match.group(1)
+        if isinstance(sn, bytes):
+            sn = sn.decode()
+        if sn == self.alipay_cert_sn:
+            return None
+        return self.alipay_public_key_of(sn)
+
+    def alipay_public_key_of(self, alipay_cert_sn):
+        """
+        public key of the alipay certificate alipay_cert_sn, the certificate is looked up in
+        the key store, then in AliPayConfig(cert_cache_dir=...), and is downloaded at last.
+        Certificates not issued by the root certificates are rejected
+        """
+        # shared by every client with the same root certificates, concurrent misses load it once
+        return self._cached(
+            "alipay_cert_public_key", alipay_cert_sn, self._load_alipay_cert,
+            (self._crypto, self.alipay_root_cert_sn)
+        )
+
+    def _cert_cache_path(self, alipay_cert_sn):
+        cache_dir = self._config.cert_cache_dir
+        if cache_dir is None:
+            return None
+        return os.path.join(cache_dir, "{}.crt".format(alipay_cert_sn))
+
+    def _load_alipay_cert(self, alipay_cert_sn):
+        path = self._cert_cache_path(alipay_cert_sn)
+        if path is not None and os.path.exists(path):
+            with open(path) as fp:
+                cert_string = fp.read()
+            try:
+                return self._verified_cert_public_key(cert_string, alipay_cert_sn)
+            except AliPayValidationError:
+                logger.warning("cached alipay certificate %s is invalid", path)
+
+        cert_string = self._download_alipay_cert(alipay_cert_sn)
+        key = self._verified_cert_public_key(cert_string, alipay_cert_sn)
+        if path is not None:
+            tmp = "{}.{}.tmp".format(path, threading.get_ident())
+            with open(tmp, "w") as fp:
+                fp.write(cert_string)
+            os.replace(tmp, path)
+        return key
+
+    def _download_alipay_cert(self, alipay_cert_sn):
+        """runs alipay.open.app.alipaycert.download, returns the certificate in PEM"""
+        biz_content = {"alipay_cert_sn": alipay_cert_sn}
+        data = self.build_body("alipay.open.app.alipaycert.download", biz_content)
+        method = data["method"]
+        event = start_event(method) if self._hooks else None
+
+        def request(url):
+            if event is not None:
+                event.attempts += 1
+            return BaseAliPay._request(self, url)
+
+        # alipay.aio clients verify in executor threads, so the certificate is downloaded synchronously
+        try:
+            url = self._gateway + "?" + BaseAliPay.sign_data(self, data)
+            raw_string = BaseAliPay._call_gateway(self, method, request, url)
+            result, cert_string = self._verify_alipay_cert_response(raw_string, alipay_cert_sn)
+        except Exception as e:
+            if event is not None:
+                self._end_event(event, exception=e)
+            raise
+        if event is not None:
+            event.request_size, event.response_size = len(url), len(raw_string)
+            self._end_event(event, result)
+        return cert_string
+
+    def _verify_alipay_cert_response(self, raw_string, alipay_cert_sn):
+        """result and certificate of a verified alipay.open.app.alipaycert.download response"""
+        response_type = "alipay_open_app_alipaycert_download_response"
+        start, end, result = self._parse_signed_span(raw_string, response_type)
+        if result is None or not result.get("alipay_cert_content"):
+            if isinstance(raw_string, bytes):
+                raw_string = str(raw_string, "utf-8")
+            raise AliPayException((result or {}).get("code", "0"), raw_string)
+
+        cert_string = decodebytes(result["alipay_cert_content"].encode()).decode()
+        # the response is signed with the downloaded certificate itself
+        sign = self._find_sign(raw_string, start, end)
+        public_key = self._verified_cert_public_key(cert_string, alipay_cert_sn)
+        plain_content = memoryview(raw_string)[start:end] if isinstance(raw_string, bytes) \
+            else raw_string[start:end]
+        if sign is None or not (
+            self._verify(plain_content, sign, public_key) or self._verify(plain_content, sign)
+        ):
+            raise AliPayValidationError
+        return result, cert_string
+
+    def _verified_cert_public_key(self, cert_string, alipay_cert_sn):
+        """public key of cert_string, if it has sn alipay_cert_sn and is issued by the root certificates"""
+        from OpenSSL import crypto
+
+        try:
+            cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert_string)
+            store = crypto.X509Store()
+            for root in self.read_pem_cert_chain(self._alipay_root_cert_string):
+                store.add_cert(root)
+            crypto.X509StoreContext(store, cert).verify_certificate()
+        except (crypto.Error, crypto.X509StoreContextError):
+            raise AliPayValidationError
+        if self.get_cert_sn(cert_string) != alipay_cert_sn:
+            raise AliPayValidationError
+        public_key_string = crypto.dump_publickey(crypto.FILETYPE_PEM, cert.get_pubkey()).decode("utf-8")
+        return self._crypto.load_public_key(public_key_string)
+
+    def _static_fields(self, method):
+        fields = super()._static_fields(method)
+        fields["app_cert_sn"] = self.app_cert_sn
+        fields["alipay_root_cert_sn"] = self.alipay_root_cert_sn
+        return fields
+
+    def snapshot_keys(self, snapshot=None):
+        snapshot = super().snapshot_keys(snapshot)
+        snapshot.set("cert_public_key", self._alipay_public_key_cert_string, self._alipay_public_key_string)
+        snapshot.set("cert_sn", self._app_public_key_cert_string, self.app_cert_sn)
+        snapshot.set("root_cert_sn", self._alipay_root_cert_string, self.alipay_root_cert_sn)
+        return snapshot
 
     def load_alipay_public_key_string(self):
-        cert = OpenSSL.crypto.load_certificate(
-            OpenSSL.crypto.FILETYPE_PEM, self._alipay_public_key_cert_string
-        )
-        return OpenSSL.crypto.dump_publickey(
-            OpenSSL.crypto.FILETYPE_PEM, cert.get_pubkey()
-        ).decode("utf-8")
+        from OpenSSL import crypto
+
+        cert = crypto.load_certificate(crypto.FILETYPE_PEM, self._alipay_public_key_cert_string)
+        return crypto.dump_publickey(crypto.FILETYPE_PEM, cert.get_pubkey()).decode("utf-8")
 
     @staticmethod
     def get_cert_sn(cert):
         """
         获取证书 SN 算法
         """
-        cert = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, cert)
+        from OpenSSL import crypto
+
+        cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert)
         certIssue = cert.get_issuer()
         name = 'CN={},OU={},O={},C={}'.format(certIssue.CN, certIssue.OU, certIssue.O, certIssue.C)
         string = name + str(cert.get_serial_number())
@@ -733,8 +1355,10 @@ class DCAliPay(BaseAliPay):
     def read_pem_cert_chain(certContent):
         """解析根证书"""
         # 根证书中，每个 cert 中间有两个回车间隔
+        from OpenSSL import crypto
+
         items = [i for i in certContent.split('\n\n') if i]
-        load_cert = partial(OpenSSL.crypto.load_certificate, OpenSSL.crypto.FILETYPE_PEM)
+        load_cert = partial(crypto.load_certificate, crypto.FILETYPE_PEM)
         return [load_cert(c) for c in items]
 
     @staticmethod
@@ -763,13 +1387,19 @@ class DCAliPay(BaseAliPay):
     @property
     def app_cert_sn(self):
         if not hasattr(self, "_app_cert_sn"):
-            self._app_cert_sn = self.get_cert_sn(self._app_public_key_cert_string)
+            self._app_cert_sn = self._cached(
+                "cert_sn", self._app_public_key_cert_string, self._snapshot_or("cert_sn", self.get_cert_sn)
+            )
         return getattr(self, "_app_cert_sn")
 
     @property
     def alipay_root_cert_sn(self):
         if not hasattr(self, "_alipay_root_cert_sn"):
-            self._alipay_root_cert_sn = self.get_root_cert_sn(self._alipay_root_cert_string)
+            self._alipay_root_cert_sn = self._cached(
+                "root_cert_sn",
+                self._alipay_root_cert_string,
+                self._snapshot_or("root_cert_sn", self.get_root_cert_sn)
+            )
         return getattr(self, "_alipay_root_cert_sn")
 
     def api_alipay_fund_trans_uni_transfer(
@@ -811,13 +1441,15 @@ class ISVAliPay(BaseAliPay):
         debug=False,
         verbose=False,
         app_auth_token=None,
-        app_auth_code=None
+        app_auth_code=None,
+        config=None
     ):
         if not app_auth_token and not app_auth_code:
             raise Exception("Both app_auth_code and app_auth_token are None !!!")
 
         self._app_auth_token = app_auth_token
         self._app_auth_code = app_auth_code
+        self._app_auth_token_lock = threading.Lock()
         super().__init__(
             appid,
             app_notify_url,
@@ -825,23 +1457,26 @@ class ISVAliPay(BaseAliPay):
             alipay_public_key_string=alipay_public_key_string,
             sign_type=sign_type,
             debug=debug,
-            verbose=verbose
+            verbose=verbose,
+            config=config
         )
 
     @property
     def app_auth_token(self):
-        # 没有则换取token
+        # 没有则换取token, 并发时只换取一次
         if not self._app_auth_token:
-            result = self.api_alipay_open_auth_token_app(self._app_auth_code)
-            self._app_auth_token = result.get("app_auth_token")
-            if not self._app_auth_token:
-                msg = "Get auth token by auth code failed: {}"
-                raise Exception(msg.format(self._app_auth_code))
+            with self._app_auth_token_lock:
+                if not self._app_auth_token:
+                    result = self.api_alipay_open_auth_token_app()
+                    self._app_auth_token = result.get("app_auth_token")
+                    if not self._app_auth_token:
+                        msg = "Get auth token by auth code failed: {}"
+                        raise Exception(msg.format(self._app_auth_code))
         return self._app_auth_token
 
     def build_body(self, *args, **kwargs):
         data = super().build_body(*args, **kwargs)
-        if self._app_auth_token:
+        if self._app_auth_token and not data.get("app_auth_token"):
             data["app_auth_token"] = self._app_auth_token
         if self._verbose:
             logger.debug("data to be signed")
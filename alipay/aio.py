@@ -0,0 +1,421 @@
+"""
+    alipay/aio.py
+    ~~~~~~~~~~
+
+    asyncio version of AliPay, DCAliPay and ISVAliPay.
+
+    Every api_* method, client_api, server_api, sign_data and verify returns a coroutine,
+    server_api_many, api_alipay_trade_query_many and download_bills return async iterators.
+    Network I/O never blocks the event loop, signing and verification run in the executor
+    given by AliPayConfig(executor=...), or in the loop's default executor.
+
+        alipay = AsyncAliPay(...)
+        result = await alipay.api_alipay_trade_query(out_trade_no="xxx")
+"""
+import asyncio
+import copy
+import os
+import ssl
+import time
+import zlib
+from collections import deque
+from functools import partial
+from itertools import islice
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+from . import AliPay, BaseAliPay, DCAliPay, ISVAliPay
+from .exceptions import AliPayException
+from .hooks import start_event
+from .singleflight import AsyncSingleFlight, request_key
+from .streaming import read_stream
+from .transport import DEFAULT_HEADERS, FORM_CONTENT_TYPE
+from .utils import BatchResult
+
+
+class _AsyncConnection:
+    __slots__ = ("reader", "writer", "last_used")
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncPooledTransport:
+    """
+    asyncio HTTP/1.1 client keeping persistent connections for every gateway.
+
+    pool_size limits the connections opened to each host, requests beyond it wait
+    for a free connection instead of opening new sockets.
+    """
+
+    def __init__(self, pool_size=100, idle_timeout=60, ssl_context=None):
+        self._pool_size = pool_size
+        self._idle_timeout = idle_timeout
+        self._ssl_context = ssl_context or ssl.create_default_context()
+        self._idle = {}
+        self._semaphores = {}
+
+    async def _acquire(self, key):
+        semaphore = self._semaphores.get(key)
+        if semaphore is None:
+            semaphore = self._semaphores[key] = asyncio.Semaphore(self._pool_size)
+        await semaphore.acquire()
+
+        idle = self._idle.setdefault(key, deque())
+        now = time.monotonic()
+        while idle:
+            conn = idle.pop()
+            if now - conn.last_used <= self._idle_timeout and not conn.reader.at_eof():
+                return conn, True
+            conn.close()
+
+        scheme, host, port = key
+        try:
+            reader, writer = await asyncio.open_connection(
+                host, port, ssl=self._ssl_context if scheme == "https" else None
+            )
+        except BaseException:
+            semaphore.release()
+            raise
+        return _AsyncConnection(reader, writer), False
+
+    def _release(self, key, conn, reusable):
+        if reusable:
+            conn.last_used = time.monotonic()
+            self._idle[key].append(conn)
+        else:
+            conn.close()
+        self._semaphores[key].release()
+
+    async def _exchange(self, conn, request):
+        conn.writer.write(request)
+        await conn.writer.drain()
+
+        status_line = await conn.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by server")
+        version, status, *reason = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        status = int(status)
+        reason = reason[0] if reason else ""
+
+        headers = {}
+        while True:
+            line = await conn.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await conn.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    while (await conn.reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await conn.reader.readexactly(size))
+                await conn.reader.readexactly(2)
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await conn.reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await conn.reader.read()
+            keep_alive = False
+
+        if headers.get("content-encoding", "").lower() == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return status, reason, headers, body, keep_alive
+
+    async def request(self, url, data=None, headers=None, timeout=None):
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        request_headers = dict(DEFAULT_HEADERS)
+        request_headers["Host"] = parts.netloc
+        if data is not None:
+            request_headers["Content-Type"] = FORM_CONTENT_TYPE
+            request_headers["Content-Length"] = str(len(data))
+        request_headers.update(headers or {})
+        lines = ["{} {} HTTP/1.1".format("GET" if data is None else "POST", path)]
+        lines.extend("{}: {}".format(k, v) for k, v in request_headers.items())
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (data or b"")
+
+        async def send():
+            conn, reused = await self._acquire(key)
+            try:
+                result = await self._exchange(conn, request)
+            except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+                self._release(key, conn, False)
+                if not reused:
+                    raise
+                # the server closed an idle keep-alive connection, try again with a fresh one
+                conn, _ = await self._acquire(key)
+                try:
+                    result = await self._exchange(conn, request)
+                except BaseException:
+                    self._release(key, conn, False)
+                    raise
+            except BaseException:
+                self._release(key, conn, False)
+                raise
+            self._release(key, conn, result[-1])
+            return result
+
+        status, reason, response_headers, body, _ = await asyncio.wait_for(send(), timeout)
+        if status >= 400:
+            raise HTTPError(url, status, reason, response_headers, None)
+        return body
+
+    async def close(self):
+        for idle in self._idle.values():
+            while idle:
+                idle.pop().close()
+
+
+class AsyncAliPayMixin:
+    """
+    turns a client into an asyncio one, the request building and verification logic
+    of BaseAliPay is reused as is
+    """
+
+    @property
+    def async_transport(self):
+        if getattr(self, "_async_transport", None) is None:
+            self._async_transport = self._config.async_transport or AsyncPooledTransport()
+        return self._async_transport
+
+    def _run_in_executor(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._config.executor, func, *args)
+
+    async def sign_data(self, data):
+        return await self._run_in_executor(super().sign_data, data)
+
+    async def verify(self, data, signature):
+        return await self._run_in_executor(super().verify, data, signature)
+
+    async def _request(self, url, data=None):
+        return await self.async_transport.request(url, data=data, timeout=self._config.timeout)
+
+    async def _call_gateway(self, method, func, *args):
+        policy = self._config.retry_policy
+        if policy is None:
+            return await func(*args)
+        return await policy.acall(self._gateway, method, func, *args)
+
+    async def verified_sync_response(self, data, response_type):
+        trade_cache = self._trade_cache if data["method"] == "alipay.trade.query" else None
+        if trade_cache is not None:
+            result = trade_cache.lookup(data)
+            if result is not None:
+                return self._response_object(result, response_type)
+
+        if data["method"] in self._single_flight_methods:
+            if getattr(self, "_async_flight", None) is None:
+                self._async_flight = AsyncSingleFlight()
+            result = await self._async_flight.do(
+                request_key(data, response_type), self._sync_response, data, response_type
+            )
+            result = copy.deepcopy(result)
+        else:
+            result = await self._sync_response(data, response_type)
+
+        if trade_cache is not None:
+            trade_cache.store(data, result)
+        return result
+
+    async def _sync_response(self, data, response_type):
+        if self._hooks:
+            return await self._instrumented_sync_response(data, response_type)
+        url = self._gateway + "?" + await self.sign_data(data)
+        raw_string = await self._call_gateway(data["method"], self._request, url)
+        return await self._run_in_executor(
+            self._verify_and_return_sync_response, raw_string, response_type
+        )
+
+    async def _instrumented_sync_response(self, data, response_type):
+        event = start_event(data["method"])
+
+        def timed(phase, func, *args):
+            # runs in the executor, so that cpu time is measured in the thread doing the work
+            with event.timer(phase):
+                return func(*args)
+
+        async def request(url):
+            event.attempts += 1
+            return await self._request(url)
+
+        try:
+            url = self._gateway + "?" + await self._run_in_executor(
+                timed, "sign", super().sign_data, data
+            )
+            event.request_size = len(url)
+            with event.timer("request"):
+                raw_string = await self._call_gateway(data["method"], request, url)
+            event.response_size = len(raw_string)
+            result = await self._run_in_executor(
+                timed, "verify", self._verify_and_return_sync_response, raw_string, response_type
+            )
+        except Exception as e:
+            self._end_event(event, exception=e)
+            raise
+        self._end_event(event, result)
+        return result
+
+    async def server_api_stream(
+        self, api_name, biz_content=None, chunk_size=64 * 1024, spool_size=1024 * 1024, **kwargs
+    ):
+        data = self.build_body(api_name, biz_content or {}, **kwargs)
+        response_type = api_name.replace(".", "_") + "_response"
+        url = self._gateway + "?" + await self.sign_data(data)
+
+        def read(response):
+            try:
+                return read_stream(self, response, response_type, chunk_size, spool_size)
+            finally:
+                response.close()
+
+        # the response is read from a blocking file-like object, so in the executor
+        response = await self._call_gateway(
+            data["method"], self._run_in_executor, partial(BaseAliPay._open, self), url
+        )
+        return await self._run_in_executor(read, response)
+
+    async def _iter_concurrently(self, func, keyed_args, max_workers):
+        """
+        await func(*args) for every (key, args), at most max_workers calls are in flight.
+        BatchResult is yielded in completion order, exceptions are returned instead of raised
+        """
+        keyed_args = iter(keyed_args)
+        pending = {}
+
+        def submit(count):
+            for key, args in islice(keyed_args, count):
+                pending[asyncio.ensure_future(func(*args))] = key
+
+        submit(max_workers)
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    key = pending.pop(future)
+                    exception = future.exception()
+                    if exception is None:
+                        yield BatchResult(key, future.result(), None)
+                    else:
+                        yield BatchResult(key, None, exception)
+                submit(len(done))
+        finally:
+            # the caller stopped iterating
+            for future in pending:
+                future.cancel()
+
+    def server_api_many(self, calls, max_workers=8):
+        """
+        async for result in alipay.server_api_many(calls):
+            ...
+        """
+        return self._iter_concurrently(self.server_api, enumerate(calls), max_workers)
+
+    def api_alipay_trade_query_many(self, out_trade_nos, max_workers=8):
+        return self._iter_concurrently(
+            self.api_alipay_trade_query,
+            ((out_trade_no, (out_trade_no,)) for out_trade_no in out_trade_nos),
+            max_workers
+        )
+
+    def download_bills(self, bills, directory=None, max_workers=4):
+        async def download(bill_type, bill_date):
+            fileobj = None
+            if directory is not None:
+                path = os.path.join(directory, "{}_{}.zip".format(bill_type, bill_date))
+                fileobj = open(path, "w+b")
+            try:
+                return await self.download_bill(bill_type, bill_date, fileobj)
+            except BaseException:
+                if fileobj is not None:
+                    fileobj.close()
+                raise
+
+        return self._iter_concurrently(
+            download, (((bill_type, bill_date), (bill_type, bill_date)) for bill_type, bill_date in bills),
+            max_workers
+        )
+
+    async def download_bill(self, bill_type, bill_date, fileobj=None, chunk_size=64 * 1024,
+                            spool_size=1024 * 1024, **kwargs):
+        from .bill import Bill, fetch
+
+        result = await self.api_alipay_data_dataservice_bill_downloadurl_query(bill_type, bill_date, **kwargs)
+        url = result.get("bill_download_url")
+        if not url:
+            raise AliPayException(
+                result.get("sub_code") or result.get("code"), result.get("sub_msg") or result.get("msg")
+            )
+        # the archive is written to a file, so it's downloaded in the executor
+        fileobj = await self._run_in_executor(
+            partial(fetch, partial(BaseAliPay._open, self), url, fileobj, chunk_size, spool_size)
+        )
+        return Bill(fileobj, bill_type, bill_date)
+
+    async def aclose(self):
+        if getattr(self, "_async_transport", None) is not None:
+            await self._async_transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+class AsyncAliPay(AsyncAliPayMixin, AliPay):
+    pass
+
+
+class AsyncDCAliPay(AsyncAliPayMixin, DCAliPay):
+    pass
+
+
+class AsyncISVAliPay(AsyncAliPayMixin, ISVAliPay):
+    _fetch_lock = None
+
+    @property
+    def app_auth_token(self):
+        if not self._app_auth_token:
+            raise AliPayException(None, "app_auth_token is not ready, await fetch_app_auth_token() first")
+        return self._app_auth_token
+
+    async def fetch_app_auth_token(self):
+        # 没有则换取token, 并发时只换取一次
+        if not self._app_auth_token:
+            if self._fetch_lock is None:
+                self._fetch_lock = asyncio.Lock()
+            async with self._fetch_lock:
+                if not self._app_auth_token:
+                    result = await self.api_alipay_open_auth_token_app()
+                    self._app_auth_token = result.get("app_auth_token")
+                    if not self._app_auth_token:
+                        msg = "Get auth token by auth code failed: {}"
+                        raise Exception(msg.format(self._app_auth_code))
+        return self._app_auth_token
+
+    async def api_alipay_open_auth_token_app_query(self):
+        biz_content = {"app_auth_token": await self.fetch_app_auth_token()}
+        data = self.build_body(
+            "alipay.open.auth.token.app.query",
+            biz_content,
+        )
+        response_type = "alipay_open_auth_token_app_query_response"
+        return await self.verified_sync_response(data, response_type)
@@ -0,0 +1,151 @@
+"""
+    alipay/bill.py
+    ~~~~~~~~~~
+
+    Download and parsing of bills.
+
+    The zip archive behind alipay.data.dataservice.bill.downloadurl.query is streamed to a file,
+    or to a spooled temporary file, and its CSV members are parsed lazily, row by row:
+
+        with alipay.download_bill("trade", "2023-01-01") as bill:
+            for row in bill.rows():
+                print(row["商户订单号"], row["订单金额（元）"])
+"""
+import csv
+import io
+import tempfile
+import zipfile
+
+# bills are encoded in GBK, gb18030 is a superset of it
+ENCODING = "gb18030"
+# members with this in their names hold totals instead of rows
+SUMMARY_MARK = "汇总"
+
+
+class BillRecord:
+    """a row of a bill, values are looked up by column name or by index"""
+    __slots__ = ("columns", "values")
+
+    def __init__(self, columns, values):
+        # columns is a dict of name => index shared by all rows of a member
+        self.columns = columns
+        self.values = values
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self.columns[key]
+        return self.values[key]
+
+    def get(self, key, default=None):
+        index = self.columns.get(key)
+        return default if index is None else self.values[index]
+
+    def as_dict(self):
+        return dict(zip(self.columns, self.values))
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return "<BillRecord {!r}>".format(self.values)
+
+
+def parse_rows(stream):
+    """
+    yields BillRecord for every row of a bill CSV read from a text stream.
+    Lines starting with # are comments, the first other line is the header
+    """
+    columns = None
+    for row in csv.reader(line for line in stream if not line.startswith("#")):
+        if not row:
+            continue
+        if columns is None:
+            names = [name.strip() for name in row]
+            while names and not names[-1]:
+                names.pop()
+            columns = {name: i for i, name in enumerate(names)}
+            size = len(names)
+            continue
+        # alipay pads values with tabs, so that spreadsheets keep them as text
+        yield BillRecord(columns, tuple(value.strip() for value in row[:size]))
+
+
+def _member_name(info):
+    if info.flag_bits & 0x800:
+        return info.filename
+    # names not flagged as utf-8 are GBK, which zipfile decodes as cp437
+    try:
+        return info.filename.encode("cp437").decode(ENCODING)
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return info.filename
+
+
+class Bill:
+    """a downloaded bill archive, close it to free the file"""
+
+    def __init__(self, fileobj, bill_type=None, bill_date=None):
+        self.fileobj = fileobj
+        self.bill_type = bill_type
+        self.bill_date = bill_date
+        self._zip = zipfile.ZipFile(fileobj)
+
+    def members(self):
+        """names of the CSV members"""
+        return [_member_name(info) for info in self._zip.infolist() if not info.is_dir()]
+
+    def rows(self, summary=False, member=None):
+        """
+        yields BillRecord for every row of the detail members, or of the summary members
+        if summary is True, or of the member named member only. Rows are read lazily
+        """
+        for info in self._zip.infolist():
+            name = _member_name(info)
+            if info.is_dir():
+                continue
+            if member is not None:
+                if name != member:
+                    continue
+            elif (SUMMARY_MARK in name) != summary:
+                continue
+            with self._zip.open(info) as raw:
+                stream = io.TextIOWrapper(raw, encoding=ENCODING, errors="replace", newline="")
+                yield from parse_rows(stream)
+
+    def __iter__(self):
+        return self.rows()
+
+    def close(self):
+        self._zip.close()
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return "<Bill {} {}>".format(self.bill_type, self.bill_date)
+
+
+def fetch(open_url, url, fileobj=None, chunk_size=64 * 1024, spool_size=1024 * 1024):
+    """
+    streams url into fileobj, a SpooledTemporaryFile keeping at most spool_size bytes
+    in memory if not given, and returns it rewound. open_url(url) returns a file-like response
+    """
+    if fileobj is None:
+        fileobj = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    response = open_url(url)
+    try:
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                break
+            fileobj.write(chunk)
+    finally:
+        response.close()
+    fileobj.seek(0)
+    return fileobj
@@ -0,0 +1,168 @@
+"""
+    alipay/crypto.py
+    ~~~~~~~~~~
+
+    RSA backends used to sign requests and verify responses.
+
+    - cryptodome: pycryptodome, the default one
+    - openssl: OpenSSL through the `cryptography` package (installed along with pyOpenSSL),
+      keys are parsed once into native handles and padding/hash contexts are reused
+
+    Both of them produce byte-identical PKCS#1 v1.5 signatures, and export keys in the same
+    DER formats, see alipay.snapshot.
+
+        alipay = AliPay(..., config=AliPayConfig(crypto_backend="openssl"))
+"""
+import hashlib
+
+from .compat import decodebytes
+from .exceptions import AliPayException
+
+
+class CryptodomeBackend:
+    name = "cryptodome"
+
+    def __init__(self):
+        from Cryptodome.Hash import SHA, SHA256
+        from Cryptodome.PublicKey import RSA
+        from Cryptodome.Signature import PKCS1_v1_5
+        from Cryptodome.Util.asn1 import DerSequence
+
+        self._rsa = RSA
+        self._pkcs1_v1_5 = PKCS1_v1_5
+        self._der_sequence = DerSequence
+        self._hashes = {"RSA": SHA, "RSA2": SHA256}
+
+    def load_private_key(self, key_string, validate=True):
+        """
+        validate=False skips the consistency check of the key, which takes most of the time.
+        Only PKCS#1 DER keys are loaded without validation, e.g. those of export_private_key
+        """
+        if not validate and isinstance(key_string, bytes) and key_string.startswith(b"\x30"):
+            values = self._der_sequence().decode(key_string, nr_elements=9, only_ints_expected=True)
+            if values[0] == 0:
+                # version, n, e, d, p, q, ...
+                return self._rsa.construct(tuple(values[1:6]), consistency_check=False)
+        return self._rsa.importKey(key_string)
+
+    def load_public_key(self, key_string):
+        return self._rsa.importKey(key_string)
+
+    def export_private_key(self, key):
+        """PKCS#1 DER"""
+        return key.export_key("DER", pkcs=1)
+
+    def export_public_key(self, key):
+        """SubjectPublicKeyInfo DER"""
+        return key.export_key("DER")
+
+    def sign(self, key, message, sign_type):
+        return self._pkcs1_v1_5.new(key).sign(self._hashes[sign_type].new(message))
+
+    def verify(self, key, message, signature, sign_type):
+        return bool(self._pkcs1_v1_5.new(key).verify(self._hashes[sign_type].new(message), signature))
+
+    def new_hash(self, sign_type):
+        """hash object to be fed incrementally and passed to verify_hash"""
+        return self._hashes[sign_type].new()
+
+    def verify_hash(self, key, hash_object, signature, sign_type):
+        return bool(self._pkcs1_v1_5.new(key).verify(hash_object, signature))
+
+
+class OpenSSLBackend:
+    name = "openssl"
+
+    def __init__(self):
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import padding
+        from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+
+        self._invalid_signature = InvalidSignature
+        self._serialization = serialization
+        self._padding = padding.PKCS1v15()
+        self._hashes = {"RSA": hashes.SHA1(), "RSA2": hashes.SHA256()}
+        self._prehashed = {k: Prehashed(v) for k, v in self._hashes.items()}
+
+    @staticmethod
+    def _to_bytes(key_string):
+        if isinstance(key_string, str):
+            key_string = key_string.encode()
+        return key_string.strip()
+
+    def load_private_key(self, key_string, validate=True):
+        """validate=False skips the consistency check of the key, which takes most of the time"""
+        key_string = self._to_bytes(key_string)
+        if key_string.startswith(b"-----"):
+            return self._serialization.load_pem_private_key(key_string, password=None)
+        # DER encoded key, either raw or in base64
+        if not key_string.startswith(b"\x30"):
+            key_string = decodebytes(key_string)
+        if not validate:
+            return self._serialization.load_der_private_key(
+                key_string, password=None, unsafe_skip_rsa_key_validation=True
+            )
+        return self._serialization.load_der_private_key(key_string, password=None)
+
+    def load_public_key(self, key_string):
+        key_string = self._to_bytes(key_string)
+        if key_string.startswith(b"-----"):
+            return self._serialization.load_pem_public_key(key_string)
+        if not key_string.startswith(b"\x30"):
+            key_string = decodebytes(key_string)
+        return self._serialization.load_der_public_key(key_string)
+
+    def export_private_key(self, key):
+        """PKCS#1 DER"""
+        return key.private_bytes(
+            self._serialization.Encoding.DER,
+            self._serialization.PrivateFormat.TraditionalOpenSSL,
+            self._serialization.NoEncryption()
+        )
+
+    def export_public_key(self, key):
+        """SubjectPublicKeyInfo DER"""
+        return key.public_bytes(
+            self._serialization.Encoding.DER, self._serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+
+    def sign(self, key, message, sign_type):
+        return key.sign(message, self._padding, self._hashes[sign_type])
+
+    def verify(self, key, message, signature, sign_type):
+        try:
+            key.verify(signature, message, self._padding, self._hashes[sign_type])
+        except self._invalid_signature:
+            return False
+        return True
+
+    def new_hash(self, sign_type):
+        return hashlib.sha1() if sign_type == "RSA" else hashlib.sha256()
+
+    def verify_hash(self, key, hash_object, signature, sign_type):
+        try:
+            key.verify(signature, hash_object.digest(), self._padding, self._prehashed[sign_type])
+        except self._invalid_signature:
+            return False
+        return True
+
+
+BACKENDS = {
+    CryptodomeBackend.name: CryptodomeBackend,
+    OpenSSLBackend.name: OpenSSLBackend,
+}
+_instances = {}
+
+
+def get_backend(backend=None):
+    """returns a backend instance by its name, backend instances are returned as is"""
+    if backend is None:
+        backend = CryptodomeBackend.name
+    if not isinstance(backend, str):
+        return backend
+    if backend not in _instances:
+        if backend not in BACKENDS:
+            raise AliPayException(None, "Unsupported crypto backend {}".format(backend))
+        _instances[backend] = BACKENDS[backend]()
+    return _instances[backend]
@@ -11,6 +11,14 @@ class AliPayException(Exception):
         self.__code = code
         self.__message = message
 
+    @property
+    def code(self):
+        return self.__code
+
+    @property
+    def message(self):
+        return self.__message
+
     def to_unicode(self):
         return "AliPayException: code:{}, message:{}".format(self.__code, self.__message)
 
@@ -23,3 +31,11 @@ class AliPayException(Exception):
 
 class AliPayValidationError(Exception):
     pass
+
+
+class AliPayCircuitOpenError(AliPayException):
+    """raised without sending the request while the circuit breaker of a gateway is open"""
+
+    def __init__(self, gateway):
+        super().__init__(None, "circuit breaker of {} is open".format(gateway))
+        self.gateway = gateway
@@ -0,0 +1,274 @@
+"""
+    alipay/hooks.py
+    ~~~~~~~~~~
+
+    Instrumentation of gateway calls.
+
+    Hooks given by AliPayConfig(hooks=[...]) receive a CallEvent once a gateway call ends,
+    with wall and cpu time of every phase: build_body, sign, request (retries included)
+    and verify (json parsing and signature verification). Nothing is measured without hooks.
+
+        collector = HistogramCollector()
+        alipay = AliPay(..., config=AliPayConfig(
+            hooks=[collector],
+            retry_policy=RetryPolicy(on_state_change=collector.on_breaker_state_change)
+        ))
+        print(collector.export_prometheus())
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from .loggers import logger
+
+PHASES = ("build_body", "sign", "request", "verify")
+
+# (method, wall, cpu) of the latest build_body, picked up by the call sending the body
+_build_timing = ContextVar("alipay_build_timing", default=None)
+
+
+class _PhaseTimer:
+    __slots__ = ("event", "phase", "wall", "cpu")
+
+    def __init__(self, event, phase):
+        self.event = event
+        self.phase = phase
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.event.add_phase(
+            self.phase, time.perf_counter() - self.wall, time.thread_time() - self.cpu
+        )
+
+
+class CallEvent:
+    """
+    method: api method, e.g. alipay.trade.query
+    phases: {phase: (wall seconds, cpu seconds)}
+    request_size / response_size: bytes sent and received
+    code / sub_code: of the response, None if there is no response
+    attempts: requests sent, more than 1 if retried
+    breaker_state: state of the gateway's circuit breaker after the call, None without retry policy
+    exception: exception raised by the call, if any
+    """
+    __slots__ = (
+        "method", "phases", "request_size", "response_size", "code", "sub_code",
+        "attempts", "breaker_state", "exception"
+    )
+
+    def __init__(self, method):
+        self.method = method
+        self.phases = {}
+        self.request_size = 0
+        self.response_size = 0
+        self.code = None
+        self.sub_code = None
+        self.attempts = 0
+        self.breaker_state = None
+        self.exception = None
+
+    def timer(self, phase):
+        return _PhaseTimer(self, phase)
+
+    def add_phase(self, phase, wall, cpu):
+        if phase in self.phases:
+            wall += self.phases[phase][0]
+            cpu += self.phases[phase][1]
+        self.phases[phase] = (wall, cpu)
+
+    @property
+    def wall(self):
+        return sum(wall for wall, _ in self.phases.values())
+
+    @property
+    def cpu(self):
+        return sum(cpu for _, cpu in self.phases.values())
+
+    def __repr__(self):
+        return "<CallEvent {} code={} wall={:.6f}>".format(self.method, self.code, self.wall)
+
+
+def record_build_body(method, wall, cpu):
+    _build_timing.set((method, wall, cpu))
+
+
+def start_event(method):
+    """a new event of method, the timing of its build_body is taken over if recorded"""
+    event = CallEvent(method)
+    timing = _build_timing.get()
+    if timing is not None and timing[0] == method:
+        event.add_phase("build_body", timing[1], timing[2])
+        _build_timing.set(None)
+    return event
+
+
+def emit(hooks, event):
+    for hook in hooks:
+        try:
+            hook.on_call(event)
+        except Exception:
+            logger.exception("hook %r failed", hook)
+
+
+class BaseHook:
+    def on_call(self, event):
+        """called with a CallEvent once a gateway call ends"""
+        raise NotImplementedError
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = ['{}="{}"'.format(k, _escape(v)) for k, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class HistogramCollector(BaseHook):
+    """
+    in memory histograms of phase durations and payload sizes, and counters of calls,
+    retries and breaker transitions. export_prometheus() renders them in the prometheus text format
+    """
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, size_buckets=SIZE_BUCKETS, namespace="alipay"):
+        self.buckets = tuple(buckets)
+        self.size_buckets = tuple(size_buckets)
+        self.namespace = namespace
+        # (method, phase) => _Histogram
+        self.phase_seconds = {}
+        # (method, phase) => cpu seconds
+        self.phase_cpu_seconds = {}
+        # method => _Histogram
+        self.request_bytes = {}
+        self.response_bytes = {}
+        # (method, code, sub_code, error) => count
+        self.calls = {}
+        # method => count
+        self.retries = {}
+        # (gateway, from, to) => count
+        self.breaker_transitions = {}
+        self._lock = threading.Lock()
+
+    def on_call(self, event):
+        method = event.method or ""
+        error = type(event.exception).__name__ if event.exception is not None else ""
+        with self._lock:
+            for phase, (wall, cpu) in event.phases.items():
+                key = (method, phase)
+                histogram = self.phase_seconds.get(key)
+                if histogram is None:
+                    histogram = self.phase_seconds[key] = _Histogram(self.buckets)
+                histogram.observe(wall)
+                self.phase_cpu_seconds[key] = self.phase_cpu_seconds.get(key, 0) + cpu
+            for histograms, size in (
+                (self.request_bytes, event.request_size), (self.response_bytes, event.response_size)
+            ):
+                if size:
+                    histogram = histograms.get(method)
+                    if histogram is None:
+                        histogram = histograms[method] = _Histogram(self.size_buckets)
+                    histogram.observe(size)
+            key = (method, event.code or "", event.sub_code or "", error)
+            self.calls[key] = self.calls.get(key, 0) + 1
+            if event.attempts > 1:
+                self.retries[method] = self.retries.get(method, 0) + event.attempts - 1
+
+    def on_breaker_state_change(self, gateway, old_state, new_state):
+        """may be given to RetryPolicy(on_state_change=...)"""
+        key = (gateway, old_state, new_state)
+        with self._lock:
+            self.breaker_transitions[key] = self.breaker_transitions.get(key, 0) + 1
+
+    def _histogram_lines(self, name, label_names, histograms):
+        lines = []
+        for label_values, histogram in sorted(histograms.items()):
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            cumulative = 0
+            bounds = [str(b) for b in histogram.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    name, _labels(label_names, label_values, 'le="{}"'.format(bound)), cumulative
+                ))
+            lines.append("{}_sum{} {}".format(name, _labels(label_names, label_values), histogram.sum))
+            lines.append("{}_count{} {}".format(name, _labels(label_names, label_values), histogram.count))
+        return lines
+
+    def export_prometheus(self):
+        ns = self.namespace
+        metrics = []
+        with self._lock:
+            metrics.append((
+                ns + "_phase_seconds", "histogram", "wall time of a call phase",
+                self._histogram_lines(ns + "_phase_seconds", ("method", "phase"), self.phase_seconds)
+            ))
+            metrics.append((
+                ns + "_phase_cpu_seconds_total", "counter", "cpu time of a call phase", [
+                    "{}_phase_cpu_seconds_total{} {}".format(ns, _labels(("method", "phase"), key), value)
+                    for key, value in sorted(self.phase_cpu_seconds.items())
+                ]
+            ))
+            for name, histograms, help_text in (
+                ("request_bytes", self.request_bytes, "size of requests"),
+                ("response_bytes", self.response_bytes, "size of responses"),
+            ):
+                metrics.append((
+                    ns + "_" + name, "histogram", help_text,
+                    self._histogram_lines(ns + "_" + name, ("method",), histograms)
+                ))
+            metrics.append((
+                ns + "_calls_total", "counter", "gateway calls by response code or exception", [
+                    "{}_calls_total{} {}".format(
+                        ns, _labels(("method", "code", "sub_code", "error"), key), value
+                    )
+                    for key, value in sorted(self.calls.items())
+                ]
+            ))
+            metrics.append((
+                ns + "_retries_total", "counter", "requests sent again", [
+                    "{}_retries_total{} {}".format(ns, _labels(("method",), (key,)), value)
+                    for key, value in sorted(self.retries.items())
+                ]
+            ))
+            metrics.append((
+                ns + "_breaker_transitions_total", "counter", "circuit breaker state transitions", [
+                    "{}_breaker_transitions_total{} {}".format(
+                        ns, _labels(("gateway", "from_state", "to_state"), key), value
+                    )
+                    for key, value in sorted(self.breaker_transitions.items())
+                ]
+            ))
+
+        lines = []
+        for name, kind, help_text, samples in metrics:
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
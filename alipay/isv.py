@@ -0,0 +1,398 @@
+"""
+    alipay/isv.py
+    ~~~~~~~~~~
+
+    Service providers acting for many merchants.
+
+    One client holds the app credentials shared by every merchant, a registry keeps a small
+    record per merchant, and requests of a merchant carry its app_auth_token:
+
+        alipay = AliPay(appid="isv appid", app_private_key_string=..., alipay_public_key_string=...)
+        registry = MerchantRegistry(alipay, maxsize=10000, store=MyRedisStore())
+        registry.register("merchant-1", app_auth_token="...", app_refresh_token="...", expires_in=31536000)
+
+        registry.merchant("merchant-1").api_alipay_trade_query(out_trade_no="xxx")
+
+    A TokenManager keeps the tokens fresh:
+
+        with TokenManager(registry) as manager:
+            manager.merchant("merchant-1").api_alipay_trade_query(out_trade_no="xxx")
+"""
+import heapq
+import random
+import threading
+import time
+
+from .cache import LRUCache
+from .exceptions import AliPayException
+from .loggers import logger
+from .singleflight import SingleFlight
+
+# methods of a client which build request bodies, they're run with a merchant's token injected
+_BODY_BUILDING_METHODS = frozenset((
+    "client_api", "server_api", "server_api_stream", "server_api_many", "download_bill", "download_bills"
+))
+
+
+class MerchantContext:
+    """tokens of one merchant, expires_at and re_expires_at are unix timestamps"""
+    __slots__ = (
+        "merchant_id", "app_auth_token", "app_refresh_token", "expires_at", "re_expires_at", "user_id",
+        "auth_app_id"
+    )
+
+    def __init__(
+        self,
+        merchant_id,
+        app_auth_token,
+        app_refresh_token=None,
+        expires_at=None,
+        re_expires_at=None,
+        user_id=None,
+        auth_app_id=None
+    ):
+        self.merchant_id = merchant_id
+        self.app_auth_token = app_auth_token
+        self.app_refresh_token = app_refresh_token
+        self.expires_at = expires_at
+        self.re_expires_at = re_expires_at
+        self.user_id = user_id
+        self.auth_app_id = auth_app_id
+
+    @property
+    def expired(self):
+        return self.expires_at is not None and self.expires_at <= time.time()
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{k: data.get(k) for k in cls.__slots__})
+
+    def __repr__(self):
+        return "<MerchantContext {}>".format(self.merchant_id)
+
+
+class BaseMerchantStore:
+    """persistence of merchant contexts, e.g. in a database or redis"""
+
+    def load(self, merchant_id):
+        """returns the MerchantContext or None"""
+        raise NotImplementedError
+
+    def save(self, context):
+        raise NotImplementedError
+
+    def delete(self, merchant_id):
+        raise NotImplementedError
+
+    def merchant_ids(self):
+        """ids of every stored merchant, used by TokenManager.schedule_all()"""
+        raise NotImplementedError
+
+
+class MemoryMerchantStore(BaseMerchantStore):
+    """keeps contexts as dicts, for tests and small deployments"""
+
+    def __init__(self):
+        self._data = {}
+
+    def load(self, merchant_id):
+        data = self._data.get(merchant_id)
+        return None if data is None else MerchantContext.from_dict(data)
+
+    def save(self, context):
+        self._data[context.merchant_id] = context.to_dict()
+
+    def delete(self, merchant_id):
+        self._data.pop(merchant_id, None)
+
+    def merchant_ids(self):
+        return list(self._data)
+
+
+class MerchantClient:
+    """
+    client of one merchant, api methods of the shared client are run with the merchant's
+    app_auth_token added to every request body. Other attributes are the shared client's
+    """
+    __slots__ = ("_client", "_context")
+
+    def __init__(self, client, context):
+        self._client = client
+        self._context = context
+
+    @property
+    def context(self):
+        return self._context
+
+    def build_body(self, method, biz_content=None, **kwargs):
+        kwargs.setdefault("app_auth_token", self._context.app_auth_token)
+        return self._client.build_body(method, biz_content, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith("api_") or name in _BODY_BUILDING_METHODS:
+            func = getattr(type(self._client), name, None)
+            if callable(func):
+                # the method calls self.build_body, so self has to be this object
+                return func.__get__(self)
+        return getattr(self._client, name)
+
+
+class MerchantRegistry:
+    """
+    contexts of at most maxsize merchants are kept in memory, the least recently used ones
+    are evicted and loaded from store again when needed. Without a store evicted merchants
+    are forgotten, so maxsize should exceed the number of merchants
+    """
+
+    def __init__(self, client, maxsize=10000, store=None):
+        self.client = client
+        self.store = store
+        self._contexts = LRUCache(maxsize=maxsize)
+        # called with every context put into the registry or loaded from the store
+        self.listeners = []
+        if getattr(client, "_trade_cache", None) is not None:
+            self.listeners.append(self._add_trade_cache_scope)
+
+    def _add_trade_cache_scope(self, context):
+        # so that verified notifications of the merchant update its cached trades
+        if context.auth_app_id:
+            self.client._trade_cache.add_scope(context.auth_app_id, context.app_auth_token)
+
+    def register(
+        self,
+        merchant_id,
+        app_auth_token,
+        app_refresh_token=None,
+        expires_in=None,
+        re_expires_in=None,
+        user_id=None,
+        auth_app_id=None
+    ):
+        """adds or updates a merchant, expires_in and re_expires_in are in seconds"""
+        now = time.time()
+        context = MerchantContext(
+            merchant_id,
+            app_auth_token,
+            app_refresh_token,
+            now + int(expires_in) if expires_in is not None else None,
+            now + int(re_expires_in) if re_expires_in is not None else None,
+            user_id,
+            auth_app_id
+        )
+        return self.put(context)
+
+    def register_response(self, merchant_id, response):
+        """adds a merchant from the response of api_alipay_open_auth_token_app"""
+        # responses of batch authorization have tokens in a list
+        tokens = response.get("tokens") or [response]
+        token = tokens[0]
+        return self.register(
+            merchant_id,
+            token["app_auth_token"],
+            token.get("app_refresh_token"),
+            token.get("expires_in"),
+            token.get("re_expires_in"),
+            token.get("user_id"),
+            token.get("auth_app_id")
+        )
+
+    def put(self, context):
+        if self.store is not None:
+            self.store.save(context)
+        self._contexts.set(context.merchant_id, context)
+        self._notify(context)
+        return context
+
+    def _notify(self, context):
+        for listener in self.listeners:
+            listener(context)
+
+    def get(self, merchant_id):
+        """returns the MerchantContext of merchant_id, or None if it's unknown"""
+        context = self._contexts.get(merchant_id)
+        if context is None and self.store is not None:
+            context = self.store.load(merchant_id)
+            if context is not None:
+                self._contexts.set(merchant_id, context)
+                self._notify(context)
+        return context
+
+    def merchant_ids(self):
+        """ids of the stored merchants, or of the ones in memory without a store"""
+        if self.store is not None:
+            return self.store.merchant_ids()
+        return self._contexts.keys()
+
+    def remove(self, merchant_id):
+        self._contexts.pop(merchant_id)
+        if self.store is not None:
+            self.store.delete(merchant_id)
+
+    def merchant(self, merchant_id):
+        """MerchantClient of merchant_id, raises AliPayException if it's unknown"""
+        context = self.get(merchant_id)
+        if context is None:
+            raise AliPayException(None, "Unknown merchant {}".format(merchant_id))
+        return MerchantClient(self.client, context)
+
+    def build_body(self, merchant_id, method, biz_content=None, **kwargs):
+        return self.merchant(merchant_id).build_body(method, biz_content, **kwargs)
+
+    def __contains__(self, merchant_id):
+        return self.get(merchant_id) is not None
+
+    def __len__(self):
+        """merchants in memory"""
+        return len(self._contexts)
+
+
+class TokenManager:
+    """
+    refreshes app_auth_token of merchants in registry before they expire.
+
+    A refresh is due between refresh_ahead + jitter and refresh_ahead seconds before expiry,
+    at a random point so merchants registered together don't refresh together. For tokens
+    living shorter than that, refresh_ahead is at most half and jitter at most a quarter of
+    the remaining lifetime, and a refresh is never due earlier than min_delay seconds from now.
+    Due refreshes are run by a background thread after start(), or by calling refresh_due().
+    Concurrent refreshes of a merchant share one gateway call, failed ones are tried again
+    after retry_delay. Call schedule_all() at startup to schedule merchants in the store
+    """
+
+    def __init__(self, registry, refresh_ahead=3 * 86400, jitter=86400, retry_delay=60, min_delay=60):
+        self.registry = registry
+        self.refresh_ahead = refresh_ahead
+        self.jitter = jitter
+        self.retry_delay = retry_delay
+        self.min_delay = min_delay
+        # (due, merchant_id, expires_at), entries whose expires_at is outdated are skipped
+        self._heap = []
+        # merchant_id => expires_at in the heap, so that a context loaded again isn't scheduled twice
+        self._scheduled = {}
+        self._condition = threading.Condition()
+        self._flight = SingleFlight()
+        self._thread = None
+        self._stopped = False
+        registry.listeners.append(self.schedule)
+
+    def schedule(self, context, due=None):
+        if context.expires_at is None or not context.app_refresh_token:
+            return
+        with self._condition:
+            if due is None:
+                if self._scheduled.get(context.merchant_id) == context.expires_at:
+                    return
+                now = time.time()
+                lifetime = max(context.expires_at - now, 0)
+                due = (context.expires_at - min(self.refresh_ahead, lifetime / 2)
+                       - random.uniform(0, min(self.jitter, lifetime / 4)))
+                due = max(due, now + self.min_delay)
+            self._scheduled[context.merchant_id] = context.expires_at
+            heapq.heappush(self._heap, (due, context.merchant_id, context.expires_at))
+            self._condition.notify()
+
+    def schedule_all(self):
+        """schedules every merchant of the registry's store, returns how many were found"""
+        count = 0
+        for merchant_id in self.registry.merchant_ids():
+            # contexts loaded from the store are scheduled by the registry listener
+            context = self.registry.get(merchant_id)
+            if context is not None:
+                self.schedule(context)
+                count += 1
+        return count
+
+    def refresh(self, merchant_id):
+        """refreshes the token of merchant_id now, returns the new MerchantContext"""
+        return self._flight.do(merchant_id, self._refresh, merchant_id)
+
+    def _refresh(self, merchant_id, only_expired=False):
+        context = self.registry.get(merchant_id)
+        if context is None:
+            raise AliPayException(None, "Unknown merchant {}".format(merchant_id))
+        if only_expired and not context.expired:
+            # refreshed by another caller meanwhile
+            return context
+        if not context.app_refresh_token:
+            raise AliPayException(None, "No refresh token of merchant {}".format(merchant_id))
+
+        client = self.registry.client
+        data = client.build_body("alipay.open.auth.token.app", {
+            "grant_type": "refresh_token",
+            "refresh_token": context.app_refresh_token
+        })
+        response = client.verified_sync_response(data, "alipay_open_auth_token_app_response")
+        if not (response.get("tokens") or response.get("app_auth_token")):
+            raise AliPayException(response.get("sub_code") or response.get("code"), response.get("msg"))
+        return self.registry.register_response(merchant_id, response)
+
+    def token(self, merchant_id):
+        """app_auth_token of merchant_id, refreshed first if it's expired"""
+        context = self.registry.get(merchant_id)
+        if context is not None and context.expired and context.app_refresh_token:
+            context = self._flight.do(merchant_id, self._refresh, merchant_id, True)
+        return context.app_auth_token if context is not None else None
+
+    def merchant(self, merchant_id):
+        """like MerchantRegistry.merchant, with an expired token refreshed first"""
+        self.token(merchant_id)
+        return self.registry.merchant(merchant_id)
+
+    def refresh_due(self, now=None):
+        """runs refreshes due by now, returns how many succeeded"""
+        now = time.time() if now is None else now
+        due = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                if self._scheduled.get(entry[1]) == entry[2]:
+                    del self._scheduled[entry[1]]
+                due.append(entry)
+        return sum(self._run_refresh(merchant_id, expires_at) for _, merchant_id, expires_at in due)
+
+    def _run_refresh(self, merchant_id, expires_at):
+        context = self.registry.get(merchant_id)
+        if context is None or context.expires_at != expires_at:
+            # removed, or refreshed since it was scheduled
+            return 0
+        try:
+            self.refresh(merchant_id)
+            return 1
+        except Exception:
+            logger.exception("refreshing app_auth_token of %s failed", merchant_id)
+            self.schedule(context, time.time() + self.retry_delay * random.uniform(1, 2))
+            return 0
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and (not self._heap or self._heap[0][0] > time.time()):
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    self._condition.wait(timeout)
+                if self._stopped:
+                    return
+            self.refresh_due()
+
+    def start(self):
+        if self._thread is None:
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name="alipay-token-manager", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
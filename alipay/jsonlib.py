@@ -0,0 +1,102 @@
+"""
+    alipay/jsonlib.py
+    ~~~~~~~~~~
+
+    JSON backends used to dump biz_content and to parse sync responses.
+
+    - json: the standard library, the default one
+    - orjson / ujson: optional, install them by yourself
+
+    All of them dump compact json like json.dumps(v, separators=(',', ':')) with non-ascii
+    characters escaped, so biz_content and its signature don't depend on the backend, except
+    for floats: orjson writes 1e20 where json writes 1e+20. Pass amounts as strings.
+
+        alipay = AliPay(..., config=AliPayConfig(json_backend="orjson"))
+"""
+import json
+import re
+
+from .exceptions import AliPayException
+
+
+class StdlibJSON:
+    name = "json"
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    def loads(self, content):
+        if isinstance(content, memoryview):
+            content = bytes(content)
+        return json.loads(content)
+
+
+# characters json.dumps escapes and orjson doesn't, control characters are escaped by both
+_UNESCAPED = re.compile("[\x7f-\U0010ffff]")
+
+
+def _escape(match):
+    code = ord(match.group())
+    if code > 0xffff:
+        # a surrogate pair, like json.dumps
+        code -= 0x10000
+        return "\\u{:04x}\\u{:04x}".format(0xd800 | (code >> 10), 0xdc00 | (code & 0x3ff))
+    return "\\u{:04x}".format(code)
+
+
+class OrjsonJSON:
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj):
+        content = self._orjson.dumps(obj).decode()
+        # \x7f is ascii, but escaped by json.dumps
+        if content.isascii() and "\x7f" not in content:
+            return content
+        return _UNESCAPED.sub(_escape, content)
+
+    def loads(self, content):
+        return self._orjson.loads(content)
+
+
+class UjsonJSON:
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj, ensure_ascii=True, escape_forward_slashes=False)
+
+    def loads(self, content):
+        if isinstance(content, memoryview):
+            content = bytes(content)
+        return self._ujson.loads(content)
+
+
+BACKENDS = {
+    StdlibJSON.name: StdlibJSON,
+    OrjsonJSON.name: OrjsonJSON,
+    UjsonJSON.name: UjsonJSON,
+}
+_instances = {}
+
+
+def get_backend(backend=None):
+    """returns a backend instance by its name, backend instances are returned as is"""
+    if backend is None:
+        backend = StdlibJSON.name
+    if not isinstance(backend, str):
+        return backend
+    if backend not in _instances:
+        if backend not in BACKENDS:
+            raise AliPayException(None, "Unsupported json backend {}".format(backend))
+        try:
+            _instances[backend] = BACKENDS[backend]()
+        except ImportError:
+            raise AliPayException(None, "json backend {} is not installed".format(backend))
+    return _instances[backend]
@@ -0,0 +1,65 @@
+"""
+    alipay/keystore.py
+    ~~~~~~~~~~
+
+    Process-wide store of parsed keys, certificate public keys and certificate SNs.
+
+    Clients built from the same key and cert strings share the parsed objects instead of
+    parsing them again, which matters when short-lived clients are created per request:
+
+        # every client shares alipay.keystore.default_store unless told otherwise
+        alipay = AliPay(..., config=AliPayConfig(key_store=KeyStore(maxsize=10000)))
+"""
+import threading
+
+from .cache import LRUCache
+from .snapshot import KeySnapshot
+
+_missing = object()
+
+
+class KeyStore:
+    """
+    thread-safe LRU store of at most maxsize entries keyed by (kind, sha256 of the source, scope).
+    A value is loaded once even if several threads ask for it at the same time, values are
+    shared by every client and must not be modified. maxsize=0 turns caching off
+    """
+
+    def __init__(self, maxsize=1024):
+        self._cache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        # key => lock held while the value is being loaded
+        self._loading = {}
+
+    def get(self, kind, content, loader, scope=None):
+        """returns the value of content, loader(content) is called on misses"""
+        key = (kind, KeySnapshot.fingerprint(content), scope)
+        value = self._cache.get(key, _missing)
+        if value is not _missing:
+            return value
+
+        with self._lock:
+            lock = self._loading.setdefault(key, threading.Lock())
+        try:
+            with lock:
+                value = self._cache.get(key, _missing)
+                if value is _missing:
+                    value = loader(content)
+                    self._cache.set(key, value)
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+        return value
+
+    def clear(self):
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def stats(self):
+        return self._cache.stats
+
+
+default_store = KeyStore()
@@ -0,0 +1,251 @@
+"""
+    alipay/polling.py
+    ~~~~~~~~~~
+
+    Polling of pending trades, e.g. of barcode payments waiting for the buyer's password:
+
+        def on_change(trade, old_status, new_status, result):
+            ...
+
+        poller = TradePoller(alipay, on_change=on_change, checkpoint_path="poller.json")
+        poller.add("20150320010101001", timeout=300)
+        poller.start()
+
+        # a verified notification resolves the trade at once
+        if alipay.verify(data, signature):
+            poller.notify(data)
+
+    Trades are kept in a heap by their next due time, every trade is polled fast at first and
+    slower later, due trades are queried in batches on a bounded pool of threads.
+"""
+import heapq
+import json
+import os
+import threading
+import time
+
+from .loggers import logger
+from .tradecache import TERMINAL_STATES
+
+# seconds between queries of a trade, the last one is repeated
+DEFAULT_SCHEDULE = (1, 1, 2, 2, 3, 5, 5, 10, 10, 30)
+
+
+class PendingTrade:
+    __slots__ = ("out_trade_no", "status", "attempts", "due", "expires_at")
+
+    def __init__(self, out_trade_no, status=None, attempts=0, due=0, expires_at=None):
+        self.out_trade_no = out_trade_no
+        self.status = status
+        self.attempts = attempts
+        self.due = due
+        self.expires_at = expires_at
+
+    def to_list(self):
+        return [self.out_trade_no, self.status, self.attempts, self.due, self.expires_at]
+
+    def __repr__(self):
+        return "<PendingTrade {} {}>".format(self.out_trade_no, self.status)
+
+
+class TradePoller:
+    """
+    queries pending trades until they reach a terminal state or expire.
+
+    on_change(trade, old_status, new_status, result) is called when the state of a trade changes,
+    on_expire(trade) when a trade is given up. Trades are polled by a background thread after
+    start(), or by calling run_due(). With checkpoint_path, pending trades are saved after every
+    batch and loaded again on creation
+    """
+
+    def __init__(
+        self,
+        client,
+        schedule=DEFAULT_SCHEDULE,
+        max_workers=8,
+        batch_size=100,
+        on_change=None,
+        on_expire=None,
+        checkpoint_path=None
+    ):
+        self.client = client
+        self.schedule = tuple(schedule)
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.on_change = on_change
+        self.on_expire = on_expire
+        self.checkpoint_path = checkpoint_path
+        # out_trade_no => PendingTrade, (due, out_trade_no) in the heap, outdated entries are skipped
+        self._trades = {}
+        self._heap = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as fp:
+                self.restore(json.load(fp))
+
+    def add(self, out_trade_no, timeout=None, expires_at=None, delay=None):
+        """polls out_trade_no until it's resolved, or for timeout seconds, first after delay seconds"""
+        now = time.time()
+        if expires_at is None and timeout is not None:
+            expires_at = now + timeout
+        trade = PendingTrade(out_trade_no, expires_at=expires_at)
+        self._schedule(trade, now + (self.schedule[0] if delay is None else delay))
+        return trade
+
+    def _schedule(self, trade, due):
+        if trade.expires_at is not None:
+            # the last query is sent when the trade expires
+            due = min(due, trade.expires_at)
+        trade.due = due
+        with self._condition:
+            self._trades[trade.out_trade_no] = trade
+            heapq.heappush(self._heap, (due, trade.out_trade_no))
+            self._condition.notify()
+
+    def remove(self, out_trade_no):
+        with self._condition:
+            return self._trades.pop(out_trade_no, None)
+
+    def resolve(self, out_trade_no, trade_status, result=None):
+        """sets the state of a trade known by other means, a terminal state stops polling it"""
+        with self._condition:
+            trade = self._trades.get(out_trade_no)
+            if trade is None:
+                return
+            if trade_status in TERMINAL_STATES:
+                del self._trades[out_trade_no]
+            old_status, trade.status = trade.status, trade_status
+        self._changed(trade, old_status, trade_status, result)
+
+    def notify(self, data):
+        """resolves the trade of a verified notification"""
+        if data.get("out_trade_no") and data.get("trade_status"):
+            self.resolve(data["out_trade_no"], data["trade_status"], data)
+
+    def _changed(self, trade, old_status, status, result):
+        if status != old_status and self.on_change is not None:
+            try:
+                self.on_change(trade, old_status, status, result)
+            except Exception:
+                logger.exception("on_change of %s failed", trade.out_trade_no)
+
+    def __len__(self):
+        return len(self._trades)
+
+    def __contains__(self, out_trade_no):
+        return out_trade_no in self._trades
+
+    def _pop_due(self, now):
+        due = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+                when, out_trade_no = heapq.heappop(self._heap)
+                trade = self._trades.get(out_trade_no)
+                if trade is not None and trade.due == when:
+                    due.append(trade)
+        return due
+
+    def run_due(self, now=None):
+        """
+        queries trades due by now, returns how many were queried. Without now, results are
+        handled at the time they arrive, so that long runs don't schedule polls in the past
+        """
+        due_by = time.time() if now is None else now
+        count = 0
+        while True:
+            trades = self._pop_due(due_by)
+            if not trades:
+                break
+            count += len(trades)
+            by_id = {trade.out_trade_no: trade for trade in trades}
+            for batch_result in self.client.api_alipay_trade_query_many(by_id, self.max_workers):
+                self._handle(by_id[batch_result.key], batch_result, time.time() if now is None else now)
+            self.save()
+        return count
+
+    def _handle(self, trade, batch_result, now):
+        result = status = None
+        if batch_result.exception is not None:
+            logger.warning("querying %s failed: %r", trade.out_trade_no, batch_result.exception)
+        else:
+            result = batch_result.response
+            # ACQ.TRADE_NOT_EXIST: the buyer hasn't scanned or paid yet
+            status = result.get("trade_status")
+
+        # the state is changed and the trade rescheduled at once, so that a resolve() meanwhile wins
+        with self._condition:
+            if self._trades.get(trade.out_trade_no) is not trade:
+                # removed or resolved meanwhile
+                return
+            trade.attempts += 1
+            old_status = trade.status
+            if status:
+                trade.status = status
+            expired = trade.expires_at is not None and now >= trade.expires_at
+            if status in TERMINAL_STATES or expired:
+                del self._trades[trade.out_trade_no]
+            else:
+                delay = self.schedule[min(trade.attempts, len(self.schedule) - 1)]
+                self._schedule(trade, now + delay)
+
+        if status:
+            self._changed(trade, old_status, status, result)
+        if expired and status not in TERMINAL_STATES and self.on_expire is not None:
+            try:
+                self.on_expire(trade)
+            except Exception:
+                logger.exception("on_expire of %s failed", trade.out_trade_no)
+
+    def checkpoint(self):
+        """pending trades as a json serializable dict"""
+        with self._condition:
+            return {"version": 1, "trades": [trade.to_list() for trade in self._trades.values()]}
+
+    def restore(self, checkpoint):
+        for out_trade_no, status, attempts, due, expires_at in checkpoint["trades"]:
+            self._schedule(PendingTrade(out_trade_no, status, attempts, due, expires_at), due)
+
+    def save(self):
+        if self.checkpoint_path is None:
+            return
+        tmp = "{}.{}.tmp".format(self.checkpoint_path, threading.get_ident())
+        with open(tmp, "w") as fp:
+            json.dump(self.checkpoint(), fp)
+        os.replace(tmp, self.checkpoint_path)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and (not self._heap or self._heap[0][0] > time.time()):
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    self._condition.wait(timeout)
+                if self._stopped:
+                    return
+            try:
+                self.run_due()
+            except Exception:
+                logger.exception("polling trades failed")
+
+    def start(self):
+        if self._thread is None:
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name="alipay-trade-poller", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.save()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
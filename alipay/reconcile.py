@@ -0,0 +1,274 @@
+"""
+    alipay/reconcile.py
+    ~~~~~~~~~~
+
+    Reconciliation of alipay trades against local orders, requires numpy:
+
+        pip install python-alipay-sdk[reconcile]
+
+    Rows of both sides are loaded in chunks into columnar arrays, out_trade_no is mapped to an
+    integer code by a hash index, and the sides are compared with vectorized operations:
+
+        reconciler = Reconciler()
+        with alipay.download_bill("trade", "2023-01-01") as bill:
+            reconciler.add_bill_rows(bill.rows())
+        reconciler.add_local_orders((o.out_trade_no, o.amount, o.status, o.refunded) for o in orders)
+        result = reconciler.run()
+        print(result.counts())
+        result.write_csv("diff.csv")
+"""
+import csv
+
+from .exceptions import AliPayException
+
+MISSING_LOCAL = 1
+MISSING_REMOTE = 2
+AMOUNT_DIFFERS = 4
+STATUS_DIFFERS = 8
+REFUND_DIFFERS = 16
+ISSUES = (
+    (MISSING_LOCAL, "missing_local"),
+    (MISSING_REMOTE, "missing_remote"),
+    (AMOUNT_DIFFERS, "amount"),
+    (STATUS_DIFFERS, "status"),
+    (REFUND_DIFFERS, "refund"),
+)
+
+# local orders in these states have to be in the bill
+PAID_STATES = ("TRADE_SUCCESS", "TRADE_FINISHED")
+
+# columns of trade bills
+BILL_KEY_COLUMN = "商户订单号"
+BILL_AMOUNT_COLUMN = "订单金额（元）"
+BILL_TYPE_COLUMN = "业务类型"
+BILL_REFUND_TYPE = "退款"
+
+
+def _yuan(cents):
+    cents = int(cents)
+    return "{}{}.{:02d}".format("-" if cents < 0 else "", abs(cents) // 100, abs(cents) % 100)
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise AliPayException(None, "numpy is not installed, pip install python-alipay-sdk[reconcile]")
+    return numpy
+
+
+class _Side:
+    """columns of one side, as lists of arrays of at most chunk_size rows"""
+
+    def __init__(self):
+        self.codes = []
+        self.amounts = []
+        self.statuses = []
+        self.refund_codes = []
+        self.refunds = []
+        # whether statuses of a chunk only tell if the trade is paid, e.g. of bills
+        self.paid_only = []
+
+
+class Reconciler:
+    """
+    collects alipay rows (remote) and local orders, run() compares them by out_trade_no.
+    Amounts are compared in cents, statuses are alipay trade states, e.g. TRADE_SUCCESS
+    """
+
+    def __init__(self, chunk_size=1000000):
+        self._np = _import_numpy()
+        self.chunk_size = chunk_size
+        # out_trade_no => code, and code => out_trade_no
+        self._index = {}
+        self._keys = []
+        # status => code, 0 is no status
+        self._status_index = {None: 0}
+        self._statuses = [None]
+        self._remote = _Side()
+        self._local = _Side()
+
+    def _code(self, key):
+        code = self._index.get(key)
+        if code is None:
+            code = self._index[key] = len(self._keys)
+            self._keys.append(key)
+        return code
+
+    def _status_code(self, status):
+        code = self._status_index.get(status)
+        if code is None:
+            code = self._status_index[status] = len(self._statuses)
+            self._statuses.append(status)
+        return code
+
+    def _cents(self, amounts):
+        np = self._np
+        return np.rint(np.asarray(amounts, dtype=np.float64) * 100).astype(np.int64)
+
+    def _flush(self, side, codes, amounts, statuses, refund_codes, refunds, paid_only):
+        np = self._np
+        if codes:
+            side.codes.append(np.asarray(codes, dtype=np.int64))
+            side.amounts.append(self._cents(amounts))
+            side.statuses.append(np.asarray(statuses, dtype=np.int32))
+            side.paid_only.append(paid_only)
+        if refund_codes:
+            side.refund_codes.append(np.asarray(refund_codes, dtype=np.int64))
+            side.refunds.append(np.abs(self._cents(refunds)))
+        for column in (codes, amounts, statuses, refund_codes, refunds):
+            del column[:]
+
+    def _load(self, side, records, paid_only=False):
+        """records are (out_trade_no, amount, status, is_refund)"""
+        code, status_code = self._code, self._status_code
+        codes, amounts, statuses, refund_codes, refunds = [], [], [], [], []
+        for key, amount, status, is_refund in records:
+            if is_refund:
+                refund_codes.append(code(key))
+                refunds.append(amount)
+            else:
+                codes.append(code(key))
+                amounts.append(amount)
+                statuses.append(status_code(status))
+            if len(codes) + len(refund_codes) >= self.chunk_size:
+                self._flush(side, codes, amounts, statuses, refund_codes, refunds, paid_only)
+        self._flush(side, codes, amounts, statuses, refund_codes, refunds, paid_only)
+
+    def add_bill_rows(self, rows, key_column=BILL_KEY_COLUMN, amount_column=BILL_AMOUNT_COLUMN,
+                      type_column=BILL_TYPE_COLUMN):
+        """
+        rows of a trade bill, e.g. Bill.rows(), refunds are summed. Trades are TRADE_SUCCESS, which
+        matches any of PAID_STATES, bills don't tell whether a trade is finished
+        """
+        self._load(self._remote, (
+            (row[key_column], row[amount_column], "TRADE_SUCCESS", row[type_column] == BILL_REFUND_TYPE)
+            for row in rows
+        ), paid_only=True)
+
+    def add_query_results(self, results):
+        """responses of api_alipay_trade_query, responses without trade_status are skipped"""
+        self._load(self._remote, (
+            (result["out_trade_no"], result.get("total_amount") or 0, result["trade_status"], False)
+            for result in results if result.get("trade_status")
+        ))
+
+    def add_local_orders(self, orders):
+        """(out_trade_no, amount, status[, refunded amount]) of local orders"""
+        def records():
+            for order in orders:
+                yield order[0], order[1], order[2], False
+                if len(order) > 3 and order[3]:
+                    yield order[0], order[3], None, True
+        self._load(self._local, records())
+
+    def _columns(self, side, size):
+        np = self._np
+        present = np.zeros(size, dtype=bool)
+        amounts = np.zeros(size, dtype=np.int64)
+        statuses = np.zeros(size, dtype=np.int32)
+        refunds = np.zeros(size, dtype=np.int64)
+        for codes, chunk_amounts, chunk_statuses in zip(side.codes, side.amounts, side.statuses):
+            present[codes] = True
+            # a trade appearing twice keeps its latest state
+            amounts[codes] = chunk_amounts
+            statuses[codes] = chunk_statuses
+        for codes, chunk_refunds in zip(side.refund_codes, side.refunds):
+            # cents are exact in float64 far beyond any real amount
+            refunds += np.rint(np.bincount(codes, weights=chunk_refunds, minlength=size)).astype(np.int64)
+        return present, amounts, statuses, refunds
+
+    def _masks(self, side, size):
+        """whether the latest status of a trade only tells if it's paid, and whether it has refunds"""
+        np = self._np
+        paid_only = np.zeros(size, dtype=bool)
+        refunded = np.zeros(size, dtype=bool)
+        for codes, chunk_paid_only in zip(side.codes, side.paid_only):
+            paid_only[codes] = chunk_paid_only
+        for codes in side.refund_codes:
+            refunded[codes] = True
+        return paid_only, refunded
+
+    def run(self):
+        np = self._np
+        size = len(self._keys)
+        remote = self._columns(self._remote, size)
+        local = self._columns(self._local, size)
+        remote_present, remote_amounts, remote_statuses, remote_refunds = remote
+        local_present, local_amounts, local_statuses, local_refunds = local
+        remote_paid_only, remote_refunded = self._masks(self._remote, size)
+
+        paid = np.zeros(len(self._statuses), dtype=bool)
+        for status in PAID_STATES:
+            if status in self._status_index:
+                paid[self._status_index[status]] = True
+
+        flags = np.zeros(size, dtype=np.uint8)
+        # compared in chunks, so that temporary arrays stay small
+        for start in range(0, size, self.chunk_size):
+            window = slice(start, start + self.chunk_size)
+            rp, lp = remote_present[window], local_present[window]
+            rs, ls = remote_statuses[window], local_statuses[window]
+            both = rp & lp
+            chunk = flags[window]
+            # refunds of trades missing on both sides as well
+            chunk[(rp | remote_refunded[window]) & ~lp] |= MISSING_LOCAL
+            chunk[lp & ~rp & paid[ls]] |= MISSING_REMOTE
+            chunk[both & (remote_amounts[window] != local_amounts[window])] |= AMOUNT_DIFFERS
+            status_differs = np.where(remote_paid_only[window], paid[rs] != paid[ls], rs != ls)
+            chunk[both & status_differs] |= STATUS_DIFFERS
+            chunk[both & (remote_refunds[window] != local_refunds[window])] |= REFUND_DIFFERS
+        return ReconcileResult(self._keys, self._statuses, flags, remote, local)
+
+
+class ReconcileResult:
+    """flags has an ISSUES bit mask for every out_trade_no, 0 if both sides agree"""
+    __slots__ = ("keys", "statuses", "flags", "remote", "local")
+
+    def __init__(self, keys, statuses, flags, remote, local):
+        self.keys = keys
+        self.statuses = statuses
+        self.flags = flags
+        self.remote = remote
+        self.local = local
+
+    def counts(self):
+        counts = {"total": len(self.keys), "matched": int((self.flags == 0).sum())}
+        for bit, name in ISSUES:
+            counts[name] = int(((self.flags & bit) != 0).sum())
+        return counts
+
+    def issues(self):
+        """yields (out_trade_no, [issue names]) of every mismatch"""
+        for code in self.flags.nonzero()[0]:
+            flag = self.flags[code]
+            yield self.keys[code], [name for bit, name in ISSUES if flag & bit]
+
+    def write_csv(self, path_or_file):
+        """writes mismatches, amounts in yuan"""
+        if isinstance(path_or_file, str):
+            with open(path_or_file, "w", newline="", encoding="utf-8") as fp:
+                return self.write_csv(fp)
+
+        writer = csv.writer(path_or_file)
+        writer.writerow([
+            "out_trade_no", "issues", "remote_amount", "local_amount", "remote_status", "local_status",
+            "remote_refund", "local_refund"
+        ])
+        remote_present, remote_amounts, remote_statuses, remote_refunds = self.remote
+        local_present, local_amounts, local_statuses, local_refunds = self.local
+        count = 0
+        for code in self.flags.nonzero()[0]:
+            flag = self.flags[code]
+            writer.writerow([
+                self.keys[code],
+                "|".join(name for bit, name in ISSUES if flag & bit),
+                _yuan(remote_amounts[code]) if remote_present[code] else "",
+                _yuan(local_amounts[code]) if local_present[code] else "",
+                self.statuses[remote_statuses[code]] or "",
+                self.statuses[local_statuses[code]] or "",
+                _yuan(remote_refunds[code]),
+                _yuan(local_refunds[code]),
+            ])
+            count += 1
+        return count
@@ -0,0 +1,141 @@
+"""
+    alipay/responses.py
+    ~~~~~~~~~~
+
+    Lightweight response objects, returned instead of dicts with AliPayConfig(response_objects=True).
+
+    An object keeps the verified bytes of the response and nothing else until a field is read,
+    then the response is decoded once and the declared fields are kept in slots, amounts as Decimal:
+
+        result = alipay.api_alipay_trade_query(out_trade_no="xxx")
+        result.trade_status, result.total_amount    # "TRADE_SUCCESS", Decimal("88.88")
+        result["trade_status"]                      # like a dict
+        result.as_dict()                            # the full response as a dict
+"""
+from decimal import Decimal
+
+from .jsonlib import get_backend
+
+
+class LazyResponse:
+    """
+    fields: names decoded into slots, missing ones are None
+    amount_fields: fields converted to Decimal
+    """
+    # _data is the decoded response, kept once a field is read
+    __slots__ = ("_raw", "_json", "_data")
+    fields = ("code", "msg", "sub_code", "sub_msg")
+    amount_fields = frozenset()
+
+    def __init__(self, raw, json_backend=None):
+        self._raw = raw
+        self._json = json_backend or get_backend()
+        self._data = None
+
+    @classmethod
+    def from_dict(cls, data, json_backend=None):
+        json_backend = json_backend or get_backend()
+        return cls(json_backend.dumps(data).encode(), json_backend)
+
+    def _decoded(self):
+        if self._data is None:
+            self._data = self._json.loads(self._raw)
+        return self._data
+
+    def _load(self):
+        data = self._decoded()
+        amount_fields = self.amount_fields
+        for name in self.fields:
+            value = data.get(name)
+            if value is not None and name in amount_fields:
+                value = Decimal(value)
+            object.__setattr__(self, name, value)
+
+    def __copy__(self):
+        # the verified bytes never change, copies share them and the backend, which can't be copied,
+        # and decode them by themselves, so that changes of one copy don't show up in another
+        return type(self)(self._raw, self._json)
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+
+    def __getattr__(self, name):
+        # called for fields which are not decoded yet
+        if name in type(self).fields:
+            self._load()
+            return object.__getattribute__(self, name)
+        raise AttributeError(name)
+
+    def as_dict(self):
+        """the full response, values are as alipay sent them, a new dict on every call"""
+        return self._json.loads(self._raw)
+
+    def __getitem__(self, name):
+        if name in self.fields:
+            value = getattr(self, name)
+            if value is None:
+                raise KeyError(name)
+            return value
+        return self._decoded()[name]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    @property
+    def raw(self):
+        """the verified bytes"""
+        return self._raw
+
+    def __repr__(self):
+        return "<{} code={}>".format(type(self).__name__, self.code)
+
+
+class TradeQueryResponse(LazyResponse):
+    fields = LazyResponse.fields + (
+        "trade_no", "out_trade_no", "trade_status", "total_amount", "receipt_amount", "buyer_pay_amount",
+        "point_amount", "invoice_amount", "buyer_logon_id", "buyer_user_id", "send_pay_date"
+    )
+    amount_fields = frozenset(("total_amount", "receipt_amount", "buyer_pay_amount", "point_amount",
+                               "invoice_amount"))
+    __slots__ = fields
+
+
+class RefundResponse(LazyResponse):
+    fields = LazyResponse.fields + (
+        "trade_no", "out_trade_no", "out_request_no", "buyer_logon_id", "fund_change", "refund_fee",
+        "refund_amount", "total_amount", "refund_status", "gmt_refund_pay"
+    )
+    amount_fields = frozenset(("refund_fee", "refund_amount", "total_amount"))
+    __slots__ = fields
+
+
+class PrecreateResponse(LazyResponse):
+    fields = LazyResponse.fields + ("out_trade_no", "qr_code")
+    __slots__ = fields
+
+
+class TransferResponse(LazyResponse):
+    fields = LazyResponse.fields + (
+        "out_biz_no", "order_id", "pay_fund_order_id", "status", "trans_date", "pay_date", "order_fee",
+        "trans_amount"
+    )
+    amount_fields = frozenset(("order_fee", "trans_amount"))
+    __slots__ = fields
+
+
+# response_type => class
+RESPONSE_CLASSES = {
+    "alipay_trade_query_response": TradeQueryResponse,
+    "alipay_trade_refund_response": RefundResponse,
+    "alipay_trade_fastpay_refund_query_response": RefundResponse,
+    "alipay_trade_precreate_response": PrecreateResponse,
+    "alipay_fund_trans_toaccount_transfer_response": TransferResponse,
+    "alipay_fund_trans_uni_transfer_response": TransferResponse,
+    "alipay_fund_trans_order_query_response": TransferResponse,
+}
@@ -0,0 +1,239 @@
+"""
+    alipay/retry.py
+    ~~~~~~~~~~
+
+    Retries with exponential backoff and per gateway circuit breakers.
+
+    Only idempotent methods are retried, on timeouts, connection errors and 5xx responses.
+    Every method goes through the circuit breaker of its gateway, which fails fast
+    with AliPayCircuitOpenError while open and lets a few probes through when half open:
+
+        policy = RetryPolicy(max_attempts=3, on_state_change=lambda gateway, old, new: ...)
+        alipay = AliPay(..., config=AliPayConfig(retry_policy=policy))
+"""
+import asyncio
+import random
+import threading
+import time
+from http.client import HTTPException
+from urllib.error import HTTPError
+
+from .exceptions import AliPayCircuitOpenError
+from .loggers import logger
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# safe to be sent again, their results don't depend on how many times they are called
+IDEMPOTENT_METHODS = frozenset((
+    "alipay.trade.query",
+    "alipay.trade.close",
+    "alipay.trade.cancel",
+    "alipay.trade.fastpay.refund.query",
+    "alipay.fund.trans.order.query",
+    "alipay.open.auth.token.app.query",
+    "alipay.open.app.alipaycert.download",
+))
+RETRY_STATUSES = frozenset((500, 502, 503, 504))
+
+
+class CircuitBreaker:
+    """
+    consecutive failure counting breaker of one gateway.
+
+    closed => open after failure_threshold failures in a row,
+    open => half_open after recovery_timeout seconds,
+    half_open => closed once a probe succeeds, or open again once a probe fails.
+    At most half_open_max_calls probes are in flight while half open
+    """
+
+    def __init__(
+        self,
+        name,
+        failure_threshold=5,
+        recovery_timeout=30,
+        half_open_max_calls=1,
+        on_state_change=None
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.on_state_change = on_state_change
+        self.failures = 0
+        self._state = CLOSED
+        self._opened_at = None
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            self._check_recovery()
+            return self._state
+
+    def _check_recovery(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self._transition(HALF_OPEN)
+
+    def _transition(self, state):
+        old, self._state = self._state, state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        self._probes = 0
+        logger.debug("circuit breaker of %s: %s => %s", self.name, old, state)
+        if self.on_state_change is not None:
+            try:
+                self.on_state_change(self.name, old, state)
+            except Exception:
+                logger.exception("on_state_change failed")
+
+    def acquire(self):
+        """raises AliPayCircuitOpenError if the call is not allowed"""
+        with self._lock:
+            self._check_recovery()
+            if self._state == CLOSED:
+                return
+            if self._state == HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return
+        raise AliPayCircuitOpenError(self.name)
+
+    def release(self):
+        """gives the probe back when a call ends without an outcome, e.g. it's cancelled"""
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self._state != CLOSED:
+                self._transition(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._state == HALF_OPEN or (
+                self._state == CLOSED and self.failures >= self.failure_threshold
+            ):
+                self._transition(OPEN)
+
+
+class RetryPolicy:
+    """
+    max_attempts: attempts of an idempotent method, other methods are sent once
+    backoff_base / backoff_max: the n-th retry sleeps
+        uniform(0, min(backoff_max, backoff_base * 2 ** n)) seconds
+    retry_statuses: http statuses retried and counted as failures by breakers
+    idempotent_methods: methods which may be retried
+    failure_threshold / recovery_timeout / half_open_max_calls: see CircuitBreaker
+    on_state_change: called with (gateway, old_state, new_state) on breaker transitions
+
+    A policy may be shared by several clients, they'll share the breakers as well
+    """
+
+    def __init__(
+        self,
+        max_attempts=3,
+        backoff_base=0.1,
+        backoff_max=2.0,
+        retry_statuses=RETRY_STATUSES,
+        idempotent_methods=IDEMPOTENT_METHODS,
+        failure_threshold=5,
+        recovery_timeout=30,
+        half_open_max_calls=1,
+        on_state_change=None
+    ):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_statuses = frozenset(retry_statuses)
+        self.idempotent_methods = frozenset(idempotent_methods)
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.on_state_change = on_state_change
+        self.breakers = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, gateway):
+        breaker = self.breakers.get(gateway)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.get(gateway)
+                if breaker is None:
+                    breaker = self.breakers[gateway] = CircuitBreaker(
+                        gateway,
+                        self.failure_threshold,
+                        self.recovery_timeout,
+                        self.half_open_max_calls,
+                        self.on_state_change
+                    )
+        return breaker
+
+    def is_failure(self, e):
+        """timeouts, connection errors and retry_statuses mean the gateway is in trouble"""
+        if isinstance(e, HTTPError):
+            return e.code in self.retry_statuses
+        return isinstance(e, (OSError, HTTPException, asyncio.TimeoutError))
+
+    def attempts(self, method):
+        return self.max_attempts if method in self.idempotent_methods else 1
+
+    def backoff(self, retry):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry))
+
+    def _should_retry(self, breaker, method, attempt, e):
+        if not self.is_failure(e):
+            if isinstance(e, HTTPError):
+                # the gateway answered, e.g. 4xx
+                breaker.record_success()
+            else:
+                breaker.release()
+            return False
+        breaker.record_failure()
+        if attempt + 1 >= self.attempts(method):
+            return False
+        logger.warning("%s failed, retrying: %r", method, e)
+        return True
+
+    def call(self, gateway, method, func, *args):
+        breaker = self.breaker(gateway)
+        attempt = 0
+        while True:
+            breaker.acquire()
+            try:
+                result = func(*args)
+            except Exception as e:
+                if not self._should_retry(breaker, method, attempt, e):
+                    raise
+            except BaseException:
+                breaker.release()
+                raise
+            else:
+                breaker.record_success()
+                return result
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+
+    async def acall(self, gateway, method, func, *args):
+        """call for coroutine functions"""
+        breaker = self.breaker(gateway)
+        attempt = 0
+        while True:
+            breaker.acquire()
+            try:
+                result = await func(*args)
+            except Exception as e:
+                if not self._should_retry(breaker, method, attempt, e):
+                    raise
+            except BaseException:
+                breaker.release()
+                raise
+            else:
+                breaker.record_success()
+                return result
+            await asyncio.sleep(self.backoff(attempt))
+            attempt += 1
@@ -0,0 +1,213 @@
+"""
+    alipay/signing.py
+    ~~~~~~~~~~
+
+    Signing engine spreading RSA private key operations over several processes.
+
+        signer = ProcessPoolSigner(max_workers=4)
+        alipay = AliPay(..., config=AliPayConfig(signer=signer))
+        # signed in the pool
+        alipay.api_alipay_trade_app_pay(...)
+"""
+import hashlib
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+from .compat import encodebytes
+from .crypto import get_backend
+from .loggers import logger
+
+# keys imported by the current worker process, (backend, key_id) => key
+_worker_keys = {}
+
+
+def _sign_batch(backend, key_id, key_string, sign_type, unsigned_strings):
+    """runs in worker processes, a key is only imported once per process"""
+    crypto = get_backend(backend)
+    key = _worker_keys.get((backend, key_id))
+    if key is None:
+        key = _worker_keys[(backend, key_id)] = crypto.load_private_key(key_string)
+    return [
+        encodebytes(crypto.sign(key, s.encode(), sign_type)).decode().replace("\n", "")
+        for s in unsigned_strings
+    ]
+
+
+class ProcessPoolSigner:
+    """
+    signs strings in a process pool holding the already imported private keys.
+
+    Concurrent sign() calls are collected into batches of at most batch_size strings,
+    a batch is sent once it's full or max_delay seconds after its first string arrived.
+    When more than max_pending strings are waiting, the pool is broken, or a signature
+    takes longer than timeout seconds, strings are signed in the calling process instead.
+    """
+
+    def __init__(
+        self,
+        max_workers=None,
+        batch_size=32,
+        max_delay=0.001,
+        max_pending=10000,
+        mp_context=None,
+        timeout=10
+    ):
+        self._max_workers = max_workers
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._mp_context = mp_context or multiprocessing.get_context("spawn")
+        self._timeout = timeout
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._executor = None
+        self._dispatcher = None
+        self._broken = False
+        self._closed = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_id(key_string):
+        return hashlib.sha256(key_string.encode()).hexdigest()
+
+    def _start(self, item=None):
+        """starts the pool if needed and enqueues item, False if closed. May raise queue.Full"""
+        with self._lock:
+            # checked and enqueued under the lock, so that close() can't drain the queue in between
+            if self._closed:
+                return False
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self._max_workers, mp_context=self._mp_context
+                )
+                self._dispatcher = threading.Thread(
+                    target=self._dispatch, name="alipay-signer", daemon=True
+                )
+                self._dispatcher.start()
+            if item is not None:
+                self._pending.put_nowait(item)
+            return True
+
+    @property
+    def available(self):
+        return not (self._broken or self._closed)
+
+    def _dispatch(self):
+        stopping = False
+        while not stopping:
+            item = self._pending.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self._max_delay
+            while len(batch) < self._batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._pending.get(timeout=timeout) if timeout > 0 else self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            groups = {}
+            for backend, key_id, key_string, sign_type, unsigned_string, future in batch:
+                group = groups.setdefault((backend, key_id, sign_type), (key_string, [], []))
+                group[1].append(unsigned_string)
+                group[2].append(future)
+            for (backend, key_id, sign_type), (key_string, strings, futures) in groups.items():
+                self._submit(backend, key_id, key_string, sign_type, strings, futures)
+
+        # closed, strings still waiting will be signed by their callers
+        while True:
+            try:
+                item = self._pending.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                item[-1].set_exception(RuntimeError("signer is closed"))
+
+    def _submit(self, backend, key_id, key_string, sign_type, strings, futures):
+        def done(batch_future):
+            try:
+                signatures = batch_future.result()
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future, signature in zip(futures, signatures):
+                    future.set_result(signature)
+
+        try:
+            batch_future = self._executor.submit(
+                _sign_batch, backend, key_id, key_string, sign_type, strings
+            )
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+        else:
+            batch_future.add_done_callback(done)
+
+    def _mark_broken(self, e):
+        if not self._broken:
+            logger.warning("signing pool is unavailable, falling back to in-process signing: %s", e)
+        self._broken = True
+
+    def sign(self, key_string, sign_type, unsigned_string, fallback, backend="cryptodome"):
+        """
+        returns the signature of unsigned_string, fallback(unsigned_string) is called
+        if it can't be signed in the pool. backend is the name of the crypto backend used by workers
+        """
+        if not self.available:
+            return fallback(unsigned_string)
+
+        future = Future()
+        item = (backend, self.key_id(key_string), key_string, sign_type, unsigned_string, future)
+        try:
+            if not self._start(item):
+                return fallback(unsigned_string)
+        except queue.Full:
+            return fallback(unsigned_string)
+        try:
+            return future.result(self._timeout)
+        except FutureTimeoutError:
+            logger.warning("signing in the pool timed out, signing in process")
+            return fallback(unsigned_string)
+        except Exception as e:
+            if not self._closed:
+                self._mark_broken(e)
+            return fallback(unsigned_string)
+
+    def sign_many(self, key_string, sign_type, unsigned_strings, fallback, backend="cryptodome"):
+        """returns signatures in the same order as unsigned_strings, batches are signed in parallel"""
+        unsigned_strings = list(unsigned_strings)
+        if not self.available or not self._start():
+            return [fallback(s) for s in unsigned_strings]
+
+        key_id = self.key_id(key_string)
+        size = self._batch_size
+        futures = [
+            self._executor.submit(
+                _sign_batch, backend, key_id, key_string, sign_type, unsigned_strings[i:i + size]
+            )
+            for i in range(0, len(unsigned_strings), size)
+        ]
+        signatures = []
+        for i, future in enumerate(futures):
+            try:
+                signatures.extend(future.result())
+            except Exception as e:
+                self._mark_broken(e)
+                signatures.extend(fallback(s) for s in unsigned_strings[i * size:(i + 1) * size])
+        return signatures
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._executor is not None:
+                self._pending.put(None)
+                self._dispatcher.join()
+                self._executor.shutdown()
+                self._executor = None
@@ -0,0 +1,551 @@
+"""
+    alipay/simulator.py
+    ~~~~~~~~~~
+
+    Local alipay gateway for load testing and offline development.
+
+    Requests produced by sign_data are verified with the app public key, trades are kept
+    in memory, and responses are signed with the simulator's own alipay key, which is
+    generated on start if not given:
+
+        with GatewaySimulator(app_public_key_string=app_public_key) as simulator:
+            alipay = AliPay(
+                ...,
+                alipay_public_key_string=simulator.alipay_public_key_string,
+                config=AliPayConfig(gateway=simulator.url, crypto_backend="openssl")
+            )
+            alipay.api_alipay_trade_precreate(...)
+
+    Latency and faults are injected per request:
+
+        GatewaySimulator(..., latency=lognormal(0.05, 0.5), faults={503: 0.01, "reset": 0.001})
+
+    or from the command line:
+
+        python -m alipay.simulator --app-public-key app_public_key.pem --port 8000
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import threading
+import uuid
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from urllib.parse import parse_qsl
+
+from .cache import LRUCache
+from .compat import decodebytes, encodebytes
+from .crypto import get_backend
+from .loggers import logger
+
+# faults which aren't http statuses
+RESET = "reset"
+TIMEOUT = "timeout"
+ERROR_RESPONSE = "error_response"
+
+STATUS_REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error",
+    502: "Bad Gateway", 503: "Service Unavailable", 504: "Gateway Timeout",
+}
+
+WAIT_BUYER_PAY = "WAIT_BUYER_PAY"
+TRADE_SUCCESS = "TRADE_SUCCESS"
+TRADE_CLOSED = "TRADE_CLOSED"
+
+
+def constant(seconds):
+    return lambda: seconds
+
+
+def uniform(low, high):
+    return lambda: random.uniform(low, high)
+
+
+def exponential(mean):
+    return lambda: random.expovariate(1 / mean)
+
+
+def lognormal(median, sigma):
+    """long tailed latency, half of the requests are faster than median"""
+    mu = math.log(median)
+    return lambda: random.lognormvariate(mu, sigma)
+
+
+class GatewayError(Exception):
+    def __init__(self, code, msg, sub_code, sub_msg):
+        self.content = {"code": code, "msg": msg, "sub_code": sub_code, "sub_msg": sub_msg}
+
+
+def _invalid_arguments(sub_code, sub_msg):
+    return GatewayError("40002", "Invalid Arguments", sub_code, sub_msg)
+
+
+def _business_failed(sub_code, sub_msg):
+    return GatewayError("40004", "Business Failed", sub_code, sub_msg)
+
+
+def _amount(value, name):
+    try:
+        amount = Decimal(str(value)).quantize(Decimal("0.01"))
+    except (InvalidOperation, TypeError):
+        raise _invalid_arguments("isv.invalid-parameter", "{} is invalid".format(name))
+    if amount <= 0:
+        raise _invalid_arguments("isv.invalid-parameter", "{} is invalid".format(name))
+    return amount
+
+
+class Trade:
+    __slots__ = (
+        "out_trade_no", "trade_no", "total_amount", "subject", "status",
+        "refunded_amount", "refunds", "gmt_payment"
+    )
+
+    def __init__(self, out_trade_no, trade_no, total_amount, subject, status=WAIT_BUYER_PAY):
+        self.out_trade_no = out_trade_no
+        self.trade_no = trade_no
+        self.total_amount = total_amount
+        self.subject = subject
+        self.status = status
+        self.refunded_amount = Decimal("0.00")
+        # out_request_no => refund_amount
+        self.refunds = {}
+        self.gmt_payment = None
+
+
+class GatewaySimulator:
+    """
+    app_public_key_string: verifies requests, signatures are not checked if not given
+    alipay_private_key_string: signs responses, a 2048 bits key is generated if not given
+    crypto_backend: see AliPayConfig
+    latency: seconds or a callable returning seconds, e.g. lognormal(0.05, 0.5)
+    faults: {fault: probability}, fault is a http status, "reset", "timeout" or "error_response"
+    """
+
+    def __init__(
+        self,
+        app_public_key_string=None,
+        alipay_private_key_string=None,
+        sign_type="RSA2",
+        crypto_backend=None,
+        latency=None,
+        faults=None,
+        host="127.0.0.1",
+        port=0,
+        timeout_delay=60
+    ):
+        self._crypto = get_backend(crypto_backend)
+        self._sign_type = sign_type
+        if alipay_private_key_string is None:
+            from Cryptodome.PublicKey import RSA
+
+            key = RSA.generate(2048)
+            alipay_private_key_string = key.export_key().decode()
+            self.alipay_public_key_string = key.publickey().export_key().decode()
+        else:
+            self.alipay_public_key_string = None
+        self._alipay_private_key = self._crypto.load_private_key(alipay_private_key_string)
+        self._app_public_key = app_public_key_string and self._crypto.load_public_key(app_public_key_string)
+
+        if latency is not None and not callable(latency):
+            latency = constant(latency)
+        self._latency = latency
+        self._faults = sorted((faults or {}).items(), key=lambda item: str(item[0]))
+        self._timeout_delay = timeout_delay
+        self.host = host
+        self.port = port
+
+        self.trades = {}
+        # trade_no => out_trade_no
+        self._trade_nos = {}
+        # content => signature, the same query is answered again and again in load tests
+        self._signatures = LRUCache(maxsize=100000)
+        self._lock = threading.Lock()
+        self._loop = None
+        self._server = None
+        # serving task => stream writer
+        self._connections = {}
+        self._thread = None
+        self._handlers = {
+            "alipay.trade.create": self._trade_create,
+            "alipay.trade.precreate": self._trade_precreate,
+            "alipay.trade.pay": self._trade_pay,
+            "alipay.trade.query": self._trade_query,
+            "alipay.trade.refund": self._trade_refund,
+            "alipay.trade.fastpay.refund.query": self._trade_fastpay_refund_query,
+            "alipay.trade.close": self._trade_close,
+            "alipay.trade.cancel": self._trade_cancel,
+        }
+
+    @property
+    def url(self):
+        return "http://{}:{}/gateway.do".format(self.host, self.port)
+
+    # trades
+
+    def _get_trade(self, biz_content):
+        out_trade_no = biz_content.get("out_trade_no")
+        trade = self.trades.get(out_trade_no)
+        if trade is None and biz_content.get("trade_no"):
+            trade = self.trades.get(self._trade_nos.get(biz_content["trade_no"]))
+        if trade is None:
+            raise _business_failed("ACQ.TRADE_NOT_EXIST", "交易不存在")
+        return trade
+
+    def _new_trade(self, biz_content):
+        out_trade_no = biz_content.get("out_trade_no")
+        if not out_trade_no:
+            raise _invalid_arguments("isv.missing-parameter", "out_trade_no is missing")
+        trade = self.trades.get(out_trade_no)
+        if trade is not None:
+            if trade.status != WAIT_BUYER_PAY:
+                raise _business_failed("ACQ.TRADE_HAS_SUCCESS", "交易已被支付")
+            return trade
+        trade_no = datetime.now().strftime("%Y%m%d") + uuid.uuid4().hex[:20]
+        trade = self.trades[out_trade_no] = Trade(
+            out_trade_no,
+            trade_no,
+            _amount(biz_content.get("total_amount"), "total_amount"),
+            biz_content.get("subject", "")
+        )
+        self._trade_nos[trade_no] = out_trade_no
+        return trade
+
+    def complete_payment(self, out_trade_no):
+        """the buyer pays the trade, e.g. after scanning the qr code"""
+        with self._lock:
+            trade = self.trades[out_trade_no]
+            if trade.status == WAIT_BUYER_PAY:
+                trade.status = TRADE_SUCCESS
+                trade.gmt_payment = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            return trade
+
+    def _trade_create(self, biz_content):
+        trade = self._new_trade(biz_content)
+        return {"out_trade_no": trade.out_trade_no, "trade_no": trade.trade_no}
+
+    def _trade_precreate(self, biz_content):
+        trade = self._new_trade(biz_content)
+        return {
+            "out_trade_no": trade.out_trade_no,
+            "qr_code": "https://qr.alipay.com/" + trade.trade_no,
+        }
+
+    def _trade_pay(self, biz_content):
+        trade = self._new_trade(biz_content)
+        trade.status = TRADE_SUCCESS
+        trade.gmt_payment = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return {
+            "out_trade_no": trade.out_trade_no,
+            "trade_no": trade.trade_no,
+            "total_amount": str(trade.total_amount),
+            "receipt_amount": str(trade.total_amount),
+            "buyer_logon_id": "159****5620",
+            "gmt_payment": trade.gmt_payment,
+        }
+
+    def _trade_query(self, biz_content):
+        trade = self._get_trade(biz_content)
+        content = {
+            "out_trade_no": trade.out_trade_no,
+            "trade_no": trade.trade_no,
+            "trade_status": trade.status,
+            "total_amount": str(trade.total_amount),
+        }
+        if trade.gmt_payment:
+            content["send_pay_date"] = trade.gmt_payment
+        return content
+
+    def _trade_refund(self, biz_content):
+        trade = self._get_trade(biz_content)
+        refund_amount = _amount(biz_content.get("refund_amount"), "refund_amount")
+        out_request_no = biz_content.get("out_request_no") or trade.out_trade_no
+        if out_request_no in trade.refunds:
+            # the same refund is requested again
+            fund_change = "N"
+        elif trade.status != TRADE_SUCCESS:
+            raise _business_failed("ACQ.TRADE_STATUS_ERROR", "交易状态不合法")
+        elif trade.refunded_amount + refund_amount > trade.total_amount:
+            raise _business_failed("ACQ.REFUND_AMT_NOT_EQUAL_TOTAL", "退款金额超限")
+        else:
+            fund_change = "Y"
+            trade.refunds[out_request_no] = refund_amount
+            trade.refunded_amount += refund_amount
+            if trade.refunded_amount == trade.total_amount:
+                trade.status = TRADE_CLOSED
+        return {
+            "out_trade_no": trade.out_trade_no,
+            "trade_no": trade.trade_no,
+            "fund_change": fund_change,
+            "refund_fee": str(trade.refunded_amount),
+        }
+
+    def _trade_fastpay_refund_query(self, biz_content):
+        trade = self._get_trade(biz_content)
+        out_request_no = biz_content.get("out_request_no") or trade.out_trade_no
+        content = {
+            "out_trade_no": trade.out_trade_no,
+            "trade_no": trade.trade_no,
+            "out_request_no": out_request_no,
+        }
+        if out_request_no in trade.refunds:
+            content["refund_amount"] = str(trade.refunds[out_request_no])
+            content["refund_status"] = "REFUND_SUCCESS"
+        return content
+
+    def _trade_close(self, biz_content):
+        trade = self._get_trade(biz_content)
+        if trade.status != WAIT_BUYER_PAY:
+            raise _business_failed("ACQ.TRADE_STATUS_ERROR", "交易状态不合法")
+        trade.status = TRADE_CLOSED
+        return {"out_trade_no": trade.out_trade_no, "trade_no": trade.trade_no}
+
+    def _trade_cancel(self, biz_content):
+        trade = self._get_trade(biz_content)
+        action = "close"
+        if trade.status == TRADE_SUCCESS:
+            action = "refund"
+            refund_amount = trade.total_amount - trade.refunded_amount
+            trade.refunds[trade.out_trade_no] = refund_amount
+            trade.refunded_amount = trade.total_amount
+        trade.status = TRADE_CLOSED
+        return {
+            "out_trade_no": trade.out_trade_no,
+            "trade_no": trade.trade_no,
+            "retry_flag": "N",
+            "action": action,
+        }
+
+    # requests
+
+    def _verify_request(self, params):
+        if self._app_public_key is None:
+            return True
+        signature = params.pop("sign", None)
+        sign_type = params.get("sign_type", self._sign_type)
+        if not signature or sign_type not in ("RSA", "RSA2"):
+            return False
+        message = "&".join("{}={}".format(k, v) for k, v in sorted(params.items()))
+        return self._crypto.verify(
+            self._app_public_key, message.encode(), decodebytes(signature.encode()), sign_type
+        )
+
+    def _sign_response(self, response_type, content):
+        content = json.dumps(content, ensure_ascii=False, separators=(',', ':'))
+        sign = self._signatures.get(content)
+        if sign is None:
+            signature = self._crypto.sign(self._alipay_private_key, content.encode(), self._sign_type)
+            sign = encodebytes(signature).decode().replace("\n", "")
+            self._signatures.set(content, sign)
+        body = '{"' + response_type + '":' + content + ',"sign":"' + sign + '"}'
+        return body.encode()
+
+    def handle(self, params):
+        """
+        answers one gateway request, params are the decoded query or form fields.
+        returns the response body, faults are not injected here
+        """
+        method = params.get("method", "")
+        response_type = method.replace(".", "_") + "_response"
+        try:
+            if not self._verify_request(params):
+                raise _invalid_arguments("isv.invalid-signature", "验签出错")
+            handler = self._handlers.get(method)
+            if handler is None:
+                response_type = "error_response"
+                raise _invalid_arguments("isv.invalid-method", "不存在的方法名")
+            try:
+                biz_content = json.loads(params.get("biz_content") or "{}")
+            except ValueError:
+                raise _invalid_arguments("isv.invalid-parameter", "biz_content is invalid")
+            with self._lock:
+                content = handler(biz_content)
+            content = dict({"code": "10000", "msg": "Success"}, **content)
+        except GatewayError as e:
+            content = e.content
+        return self._sign_response(response_type, content)
+
+    def _pick_fault(self):
+        if not self._faults:
+            return None
+        value = random.random()
+        for fault, probability in self._faults:
+            if value < probability:
+                return fault
+            value -= probability
+        return None
+
+    async def _respond(self, params):
+        """returns (status, body) or None if the connection should be dropped"""
+        if self._latency is not None:
+            await asyncio.sleep(self._latency())
+        fault = self._pick_fault()
+        if fault is None:
+            return 200, self.handle(params)
+        if fault == RESET:
+            return None
+        if fault == TIMEOUT:
+            await asyncio.sleep(self._timeout_delay)
+            return None
+        if fault == ERROR_RESPONSE:
+            return 200, self._sign_response("error_response", {
+                "code": "20000",
+                "msg": "Service Currently Unavailable",
+                "sub_code": "isp.unknown-error",
+                "sub_msg": "系统繁忙",
+            })
+        return int(fault), b""
+
+    async def _serve_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    http_method, target, version = lines[0].split(" ")
+                except ValueError:
+                    writer.write(
+                        b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+                    )
+                    return
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = b""
+                if "content-length" in headers:
+                    body = await reader.readexactly(int(headers["content-length"]))
+
+                _, _, query = target.partition("?")
+                params = dict(parse_qsl(query, keep_blank_values=True))
+                if body:
+                    params.update(parse_qsl(body.decode(), keep_blank_values=True))
+
+                result = await self._respond(params)
+                if result is None:
+                    writer.transport.abort()
+                    return
+                status, payload = result
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write((
+                    "HTTP/1.1 {} {}\r\n"
+                    "Content-Type: text/html;charset=utf-8\r\n"
+                    "Content-Length: {}\r\n"
+                    "Connection: {}\r\n\r\n"
+                ).format(
+                    status, STATUS_REASONS.get(status, "Error"), len(payload),
+                    "keep-alive" if keep_alive else "close"
+                ).encode("latin-1") + payload)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            logger.exception("simulator failed to serve a connection")
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+    async def start_async(self):
+        """starts serving in the running loop"""
+        self._server = await asyncio.start_server(
+            self._serve_connection, self.host, self.port, backlog=1024
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.url
+
+    async def stop_async(self):
+        self._server.close()
+        # idle keep-alive connections are dropped, their tasks end by themselves
+        for writer in list(self._connections.values()):
+            writer.transport.abort()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def start(self):
+        """starts serving in a background thread, returns the gateway url"""
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start_async())
+            started.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self.stop_async())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="alipay-simulator", daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.url
+
+    def stop(self):
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="local alipay gateway")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--app-public-key", help="pem file verifying requests")
+    parser.add_argument("--alipay-private-key", help="pem file signing responses, generated if not given")
+    parser.add_argument("--sign-type", default="RSA2", choices=("RSA", "RSA2"))
+    parser.add_argument("--crypto-backend", default=None, choices=("cryptodome", "openssl"))
+    parser.add_argument("--latency", type=float, default=None, help="median latency in seconds")
+    parser.add_argument("--fault", action="append", default=[], metavar="FAULT=PROBABILITY",
+                        help="e.g. 503=0.01, reset=0.001, timeout=0.001, error_response=0.01")
+    args = parser.parse_args(argv)
+
+    def read(path):
+        if path is None:
+            return None
+        with open(path) as fp:
+            return fp.read()
+
+    faults = {}
+    for item in args.fault:
+        fault, _, probability = item.partition("=")
+        faults[int(fault) if fault.isdigit() else fault] = float(probability)
+
+    simulator = GatewaySimulator(
+        app_public_key_string=read(args.app_public_key),
+        alipay_private_key_string=read(args.alipay_private_key),
+        sign_type=args.sign_type,
+        crypto_backend=args.crypto_backend,
+        latency=lognormal(args.latency, 0.5) if args.latency else None,
+        faults=faults,
+        host=args.host,
+        port=args.port
+    )
+    if simulator.alipay_public_key_string:
+        print(simulator.alipay_public_key_string)
+
+    async def serve():
+        print("serving on", await simulator.start_async())
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+    alipay/singleflight.py
+    ~~~~~~~~~~
+
+    Coalescing of concurrent identical calls: while a call of a key is running, other callers
+    of the same key wait for it and get its result instead of running it again.
+"""
+import json
+import threading
+
+# read-only methods coalesced by AliPayConfig(single_flight=True)
+READ_ONLY_METHODS = frozenset((
+    "alipay.trade.query",
+    "alipay.trade.fastpay.refund.query",
+    "alipay.fund.trans.order.query",
+    "alipay.fund.trans.common.query",
+))
+
+
+class _Call:
+    __slots__ = ("event", "result", "exception")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight:
+    """thread-safe, the result is shared by every caller of the same key"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result
+
+    def __len__(self):
+        """calls in flight"""
+        return len(self._calls)
+
+
+class _AsyncCall:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class AsyncSingleFlight:
+    """
+    asyncio version of SingleFlight, to be used within one event loop.
+    The call runs in its own task, a cancelled caller stops waiting for it without
+    cancelling the others, the call is cancelled once no caller waits anymore
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def _done(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def do(self, key, func, *args):
+        # imported here, sync clients don't load asyncio
+        import asyncio
+
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = _AsyncCall(asyncio.ensure_future(func(*args)))
+            call.task.add_done_callback(lambda _: self._done(key, call))
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                call.task.cancel()
+
+    def __len__(self):
+        return len(self._calls)
+
+
+def request_key(data, response_type):
+    """key of a request body, requests differing only in timestamp have the same key"""
+    return response_type + json.dumps(
+        {k: v for k, v in data.items() if k != "timestamp"}, sort_keys=True, default=str
+    )
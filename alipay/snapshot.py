@@ -0,0 +1,73 @@
+"""
+    alipay/snapshot.py
+    ~~~~~~~~~~
+
+    Pre-parsed key material for fast cold starts.
+
+    Parsing a PEM private key validates it, which takes tens of milliseconds, and DCAliPay
+    parses all of its certificates on creation. A snapshot keeps the results, keyed by the sha256
+    of the key and cert strings they came from, so it's only used for the very same strings:
+
+        # at build time
+        open("alipay.snapshot", "wb").write(alipay.snapshot_keys().dumps())
+
+        # in a cold worker
+        snapshot = KeySnapshot.loads(open("alipay.snapshot", "rb").read())
+        alipay = AliPay(..., config=AliPayConfig(key_snapshot=snapshot))
+
+    A snapshot contains the private key, keep it as secret as the key itself.
+"""
+import hashlib
+import json
+from base64 import b64decode, b64encode
+
+VERSION = 1
+
+
+class KeySnapshot:
+    """
+    entries are keyed by (kind, sha256 of the source string):
+
+    - private_key / public_key: DER of the loaded key, bytes
+    - cert_public_key: public key string of a certificate
+    - cert_sn / root_cert_sn: sn of a certificate / root certificate chain
+    """
+
+    def __init__(self, entries=None):
+        self._entries = dict(entries or {})
+
+    @staticmethod
+    def fingerprint(content):
+        if isinstance(content, str):
+            content = content.encode()
+        return hashlib.sha256(content).hexdigest()
+
+    def get(self, kind, content):
+        if content is None:
+            return None
+        return self._entries.get((kind, self.fingerprint(content)))
+
+    def set(self, kind, content, value):
+        self._entries[(kind, self.fingerprint(content))] = value
+
+    def __len__(self):
+        return len(self._entries)
+
+    def dumps(self):
+        entries = []
+        for (kind, fingerprint), value in sorted(self._entries.items()):
+            if isinstance(value, bytes):
+                entries.append([kind, fingerprint, b64encode(value).decode(), True])
+            else:
+                entries.append([kind, fingerprint, value, False])
+        return json.dumps({"version": VERSION, "entries": entries}).encode()
+
+    @classmethod
+    def loads(cls, data):
+        content = json.loads(data)
+        if content.get("version") != VERSION:
+            raise ValueError("unsupported snapshot version {}".format(content.get("version")))
+        return cls({
+            (kind, fingerprint): b64decode(value) if binary else value
+            for kind, fingerprint, value, binary in content["entries"]
+        })
@@ -0,0 +1,273 @@
+"""
+    alipay/streaming.py
+    ~~~~~~~~~~
+
+    Incremental handling of large sync responses.
+
+    The body is read chunk by chunk into a spooled temporary file, the signature digest
+    is updated while the signed span streams past, and after verification top level
+    arrays of the response are exposed as lazy iterators reading from the spooled file:
+
+        with alipay.server_api_stream("alipay.ebpp.invoice.token.batchquery", biz_content) as response:
+            for invoice in response["invoice_info_list"]:
+                ...
+"""
+import json
+import re
+import tempfile
+import threading
+
+from .compat import decodebytes
+from .exceptions import AliPayValidationError
+
+# bytes kept back from hashing, the tail after the signed span has to fit in it
+TAIL_SIZE = 16 * 1024
+# bytes searched for response_type before giving up
+HEAD_SIZE = 64 * 1024
+# responses smaller than this are verified as a whole if the signed span can't be located
+FALLBACK_SIZE = 1024 * 1024
+
+# the top level pairs after the signed span, e.g. ,"alipay_cert_sn":"xxx","sign":"xxx"}
+TAIL_PATTERN = re.compile(
+    rb'\}(\s*(?:,\s*"(?:[^"\\]|\\.)*"\s*:\s*(?:"(?:[^"\\]|\\.)*"|null|-?\d+)\s*)+)\}\s*$'
+)
+JSON_DECODER = json.JSONDecoder()
+WHITESPACE = " \t\n\r"
+
+
+class _SpanReader:
+    """
+    reads json values one by one from [offset, end) of a file.
+
+    Bytes are decoded as latin-1 so that offsets in text equal offsets in bytes,
+    values which are not pure ascii are parsed again from the utf-8 bytes
+    """
+
+    def __init__(self, fileobj, lock, offset, end, chunk_size):
+        self._file = fileobj
+        self._lock = lock
+        self._end = end
+        self._chunk_size = chunk_size
+        self._read_offset = offset
+        self._offset = offset
+        self._buffer = b""
+        self._text = ""
+        self._pos = 0
+
+    @property
+    def position(self):
+        return self._offset + self._pos
+
+    def _fill(self):
+        size = min(self._chunk_size, self._end - self._read_offset)
+        if size <= 0:
+            return False
+        with self._lock:
+            self._file.seek(self._read_offset)
+            chunk = self._file.read(size)
+        if not chunk:
+            return False
+        self._read_offset += len(chunk)
+        self._offset += self._pos
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._text = self._buffer.decode("latin-1")
+        self._pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self._pos < len(self._text) and self._text[self._pos] in WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._text):
+                return self._text[self._pos]
+            if not self._fill():
+                raise AliPayValidationError("unexpected end of response")
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise AliPayValidationError("unexpected {!r} in response".format(c))
+        self._pos += 1
+        return c
+
+    def value(self, decode=True):
+        """decode=False skips the value and returns None"""
+        self.peek()
+        while True:
+            try:
+                value, end = JSON_DECODER.raw_decode(self._text, self._pos)
+            except ValueError:
+                value = end = None
+            # a value ending at the end of the buffer may be truncated, e.g. a number
+            if end is not None and end < len(self._text):
+                break
+            if not self._fill():
+                if end is None:
+                    raise AliPayValidationError("invalid json in response")
+                break
+        if not decode:
+            value = None
+        elif not self._text[self._pos:end].isascii():
+            value = json.loads(self._buffer[self._pos:end])
+        self._pos = end
+        return value
+
+    def iter_array(self, decode=True):
+        self.expect("[")
+        if self.peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self.value(decode)
+            if self.expect(",]") == "]":
+                return
+
+
+class LazyArray:
+    """top level array of a streamed response, elements are parsed while iterating"""
+
+    def __init__(self, response, offset, length):
+        self._response = response
+        self._offset = offset
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return self._response._reader(self._offset).iter_array()
+
+    def __repr__(self):
+        return "<LazyArray length={}>".format(self._length)
+
+
+class StreamingResponse:
+    """
+    verified response_type value of a streamed sync response.
+    Top level arrays are LazyArray, other top level values are parsed eagerly
+    """
+
+    def __init__(self, fileobj, start, end, chunk_size=64 * 1024):
+        self._file = fileobj
+        self._lock = threading.Lock()
+        self._chunk_size = chunk_size
+        self._start = start
+        self._end = end
+        self._fields = self._index()
+
+    def _reader(self, offset):
+        return _SpanReader(self._file, self._lock, offset, self._end, self._chunk_size)
+
+    def _index(self):
+        fields = {}
+        reader = self._reader(self._start)
+        reader.expect("{")
+        if reader.peek() == "}":
+            return fields
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            if reader.peek() == "[":
+                offset = reader.position
+                length = sum(1 for _ in reader.iter_array(decode=False))
+                fields[key] = LazyArray(self, offset, length)
+            else:
+                fields[key] = reader.value()
+            if reader.expect(",}") == "}":
+                return fields
+
+    def __getitem__(self, key):
+        return self._fields[key]
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def get(self, key, default=None):
+        return self._fields.get(key, default)
+
+    def keys(self):
+        return self._fields.keys()
+
+    def to_dict(self):
+        """materialize the whole response"""
+        return {
+            k: list(v) if isinstance(v, LazyArray) else v for k, v in self._fields.items()
+        }
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_stream(alipay, response, response_type, chunk_size=64 * 1024, spool_size=1024 * 1024):
+    """
+    read a sync response from file-like object response and verify it with alipay's public key,
+    at most spool_size bytes of the body are kept in memory
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    digest = alipay._crypto.new_hash(alipay.sign_type)
+    key = ('"' + response_type).encode()
+    head = bytearray()
+    pending = bytearray()
+    # absolute offset of pending[0] and of the signed span
+    pending_offset = start = None
+    total = 0
+
+    try:
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                break
+            spool.write(chunk)
+            total += len(chunk)
+
+            if start is None:
+                if head is None:
+                    continue
+                head += chunk
+                index = head.find(key)
+                index = head.find(b"{", index + len(key)) if index >= 0 else -1
+                if index < 0:
+                    if len(head) > HEAD_SIZE:
+                        # give up searching, the rest is only spooled
+                        head = None
+                    continue
+                start = pending_offset = total - len(head) + index
+                chunk = head[index:]
+                head = None
+            pending += chunk
+            # hash everything except the last TAIL_SIZE bytes, the span may end in them
+            if len(pending) > 2 * TAIL_SIZE:
+                digest.update(pending[:-TAIL_SIZE])
+                pending_offset += len(pending) - TAIL_SIZE
+                del pending[:-TAIL_SIZE]
+
+        match = TAIL_PATTERN.search(pending) if start is not None else None
+        sign = alipay._find_sign(match.group(1), -1, -1) if match else None
+        if sign is None:
+            # error_response, missing sign or something we can't handle in streaming mode
+            if total > FALLBACK_SIZE:
+                raise AliPayValidationError("signed span can not be located")
+            spool.seek(0)
+            raw_string = spool.read()
+            # raises unless the response is verified
+            alipay._verify_and_return_sync_response(raw_string, response_type)
+            start, end, _ = alipay._parse_signed_span(raw_string, response_type)
+            return StreamingResponse(spool, start, end, chunk_size)
+
+        end = match.start() + 1
+        digest.update(memoryview(pending)[:end])
+        signature = decodebytes(sign)
+        # the tail holds alipay_cert_sn, the span is out of it
+        public_key = alipay._response_public_key(bytes(match.group(1)), -1, -1) or alipay.alipay_public_key
+        if not alipay._crypto.verify_hash(public_key, digest, signature, alipay.sign_type):
+            raise AliPayValidationError
+        return StreamingResponse(spool, start, pending_offset + end, chunk_size)
+    except BaseException:
+        spool.close()
+        raise
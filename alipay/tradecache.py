@@ -0,0 +1,125 @@
+"""
+    alipay/tradecache.py
+    ~~~~~~~~~~
+
+    Local cache of trade states, so that api_alipay_trade_query doesn't ask the gateway about
+    trades we already know about:
+
+        alipay = AliPay(..., config=AliPayConfig(trade_cache=TradeStateCache()))
+
+        alipay.verify(data, signature)                      # verified notifications update the cache
+        alipay.api_alipay_trade_query(out_trade_no="xxx")   # answered from the cache if possible
+"""
+import copy
+
+from .cache import LRUCache
+
+TERMINAL_STATES = frozenset(("TRADE_SUCCESS", "TRADE_FINISHED", "TRADE_CLOSED"))
+
+# fields of a trade notification which are part of alipay.trade.query responses too
+QUERY_FIELDS = (
+    "trade_no", "out_trade_no", "trade_status", "total_amount", "receipt_amount", "buyer_pay_amount",
+    "point_amount", "invoice_amount", "buyer_logon_id", "buyer_id", "send_pay_date"
+)
+
+_missing = object()
+
+
+class TradeStateCache:
+    """
+    query responses by out_trade_no and trade_no, at most maxsize entries with an LRU eviction.
+    Trades in terminal states are answered until evicted or invalidated, others for ttl seconds.
+    A terminal state is never replaced by a non-terminal one, e.g. by a delayed notification.
+
+    Trades are scoped by the app_auth_token of the query. Notifications have no app_auth_token,
+    those of merchants of a service provider carry auth_app_id instead, which is mapped to
+    the merchant's app_auth_token by add_scope(), MerchantRegistry does it for its merchants
+    """
+
+    def __init__(self, maxsize=100000, ttl=5):
+        self.ttl = ttl
+        self._cache = LRUCache(maxsize=maxsize)
+        # auth_app_id => app_auth_token
+        self._scopes = {}
+
+    def add_scope(self, auth_app_id, app_auth_token):
+        """notifications of auth_app_id update trades queried with app_auth_token"""
+        self._scopes[auth_app_id] = app_auth_token
+
+    def _keys(self, scope, out_trade_no=None, trade_no=None):
+        if out_trade_no:
+            yield scope, "out_trade_no", out_trade_no
+        if trade_no:
+            yield scope, "trade_no", trade_no
+
+    def get(self, out_trade_no=None, trade_no=None, scope=None):
+        """a copy of the cached response, or None"""
+        for key in self._keys(scope, out_trade_no, trade_no):
+            result = self._cache.get(key)
+            if result is not None:
+                return copy.deepcopy(result)
+        return None
+
+    def update(self, result, scope=None):
+        """caches a response of alipay.trade.query, responses without trade_status are ignored"""
+        status = result.get("trade_status")
+        if not status:
+            return
+        terminal = status in TERMINAL_STATES
+        result = copy.deepcopy(result)
+        for key in self._keys(scope, result.get("out_trade_no"), result.get("trade_no")):
+            if not terminal:
+                current = self._cache.get(key)
+                if current is not None and current["trade_status"] in TERMINAL_STATES:
+                    continue
+            self._cache.set(key, result, ttl=None if terminal else self.ttl)
+
+    def update_from_notify(self, data, scope=_missing):
+        """
+        caches the trade state of a verified notification, in the scope of its auth_app_id
+        if not given. Notifications of merchants whose app_auth_token is unknown are ignored
+        """
+        if "trade_status" not in data:
+            return
+        if scope is _missing:
+            scope = None
+            auth_app_id = data.get("auth_app_id")
+            if auth_app_id and auth_app_id != data.get("app_id"):
+                scope = self._scopes.get(auth_app_id)
+                if scope is None:
+                    return
+        result = {"code": "10000", "msg": "Success"}
+        result.update((k, data[k]) for k in QUERY_FIELDS if k in data)
+        self.update(result, scope)
+
+    def invalidate(self, out_trade_no=None, trade_no=None, scope=None):
+        """forgets a trade, both of its keys are removed if the cached response has them"""
+        for key in list(self._keys(scope, out_trade_no, trade_no)):
+            result = self._cache.pop(key)
+            if result is not None:
+                for other in self._keys(scope, result.get("out_trade_no"), result.get("trade_no")):
+                    self._cache.pop(other)
+
+    # used by verified_sync_response of clients
+
+    def lookup(self, data):
+        biz_content = data.get("biz_content")
+        if not isinstance(biz_content, dict):
+            return None
+        return self.get(
+            biz_content.get("out_trade_no"), biz_content.get("trade_no"), data.get("app_auth_token")
+        )
+
+    def store(self, data, result):
+        self.update(result, data.get("app_auth_token"))
+
+    def clear(self):
+        self._cache.clear()
+        self._scopes.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def stats(self):
+        return self._cache.stats
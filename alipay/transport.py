@@ -0,0 +1,308 @@
+"""
+    alipay/transport.py
+    ~~~~~~~~~~
+
+    HTTP transports used by server side apis.
+    By default a client sends requests with `urlopen`, pass a transport to
+    `AliPayConfig` to reuse keep-alive connections:
+
+        config = AliPayConfig(transport=PooledTransport(pool_size=20))
+"""
+import http.client
+import io
+import ssl
+import threading
+import time
+import zlib
+from collections import deque
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+from .exceptions import AliPayException
+
+DEFAULT_HEADERS = {
+    "Accept-Encoding": "gzip",
+    "Connection": "keep-alive",
+    "User-Agent": "python-alipay-sdk",
+}
+FORM_CONTENT_TYPE = "application/x-www-form-urlencoded;charset=utf-8"
+
+
+class BaseTransport:
+    """
+    transport.open() returns a file-like response object supporting read(amt) and close(),
+    transport.request() reads the whole body.
+    """
+
+    def open(self, url, data=None, headers=None, timeout=None):
+        raise NotImplementedError
+
+    def request(self, url, data=None, headers=None, timeout=None):
+        response = self.open(url, data=data, headers=headers, timeout=timeout)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+    def close(self):
+        pass
+
+
+class _ConnectionPool:
+    """keep-alive connections to one host, LIFO so that hot connections are reused first"""
+
+    def __init__(self, scheme, host, port, pool_size, idle_timeout, block, pool_timeout, ssl_context):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self._idle_timeout = idle_timeout
+        self._pool_timeout = pool_timeout
+        self._ssl_context = ssl_context
+        self._pool_size = pool_size
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(pool_size) if block else None
+
+    def _new_connection(self, timeout):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(
+                self.host, self.port, timeout=timeout, context=self._ssl_context
+            )
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def acquire(self, timeout):
+        """returns (connection, reused)"""
+        if self._semaphore is not None and not self._semaphore.acquire(timeout=self._pool_timeout):
+            raise AliPayException(None, "connection pool for {} is exhausted".format(self.host))
+
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used <= self._idle_timeout:
+                    break
+                conn.close()
+            else:
+                conn = None
+
+        if conn is None:
+            return self._new_connection(timeout), False
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def release(self, conn):
+        now = time.monotonic()
+        with self._lock:
+            # evict connections idling for too long, the oldest ones are on the left
+            while self._idle and now - self._idle[0][1] > self._idle_timeout:
+                self._idle.popleft()[0].close()
+            if len(self._idle) < self._pool_size:
+                self._idle.append((conn, now))
+                conn = None
+        if conn is not None:
+            conn.close()
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def discard(self, conn):
+        conn.close()
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    @property
+    def idle_count(self):
+        return len(self._idle)
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop()[0].close()
+
+
+class PooledResponse:
+    """
+    response from PooledTransport, gzipped body is decompressed on the fly.
+    The connection goes back to the pool after the body is consumed and close() is called
+    """
+
+    def __init__(self, pool, conn, response):
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self._pool = pool
+        self._conn = conn
+        self._response = response
+        self._buffer = b""
+        self._decoder = None
+        if (response.getheader("Content-Encoding") or "").lower() == "gzip":
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, amt=None):
+        if self._response is None:
+            return b""
+        if self._decoder is None:
+            return self._response.read(amt)
+
+        if amt is None:
+            data = self._buffer + self._decoder.decompress(self._response.read())
+            self._buffer = b""
+            return data + self._decoder.flush()
+
+        while len(self._buffer) < amt:
+            chunk = self._response.read(amt)
+            if not chunk:
+                self._buffer += self._decoder.flush()
+                break
+            self._buffer += self._decoder.decompress(chunk)
+        data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def close(self):
+        response, self._response = self._response, None
+        if response is None:
+            return
+        if response.isclosed() and not response.will_close:
+            self._pool.release(self._conn)
+        else:
+            # body not fully consumed, the connection can not be reused
+            response.close()
+            self._pool.discard(self._conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PooledTransport(BaseTransport):
+    """
+    thread-safe transport which keeps persistent HTTP/1.1 connections for every gateway.
+
+    pool_size: max connections per host, with block=True callers wait at most pool_timeout
+        seconds for a free connection; with block=False extra connections are created but
+        only pool_size of them are kept alive.
+    idle_timeout: connections idling longer than this are closed instead of reused
+    """
+
+    def __init__(
+        self,
+        pool_size=10,
+        idle_timeout=60,
+        block=True,
+        pool_timeout=None,
+        ssl_context=None
+    ):
+        self._pool_size = pool_size
+        self._idle_timeout = idle_timeout
+        self._block = block
+        self._pool_timeout = pool_timeout
+        self._ssl_context = ssl_context or ssl.create_default_context()
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _get_pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = _ConnectionPool(
+                        scheme, host, port, self._pool_size, self._idle_timeout,
+                        self._block, self._pool_timeout, self._ssl_context
+                    )
+                    self._pools[key] = pool
+        return pool
+
+    def open(self, url, data=None, headers=None, timeout=None):
+        parts = urlsplit(url)
+        pool = self._get_pool(parts.scheme, parts.hostname, parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        request_headers = dict(DEFAULT_HEADERS)
+        if data is not None:
+            request_headers["Content-Type"] = FORM_CONTENT_TYPE
+        request_headers.update(headers or {})
+        method = "GET" if data is None else "POST"
+
+        conn, reused = pool.acquire(timeout)
+        try:
+            conn.request(method, path, body=data, headers=request_headers)
+            response = conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            pool.discard(conn)
+            if not reused:
+                raise
+            # the server closed an idle keep-alive connection, try again with a fresh one
+            conn, _ = pool.acquire(timeout)
+            try:
+                conn.request(method, path, body=data, headers=request_headers)
+                response = conn.getresponse()
+            except BaseException:
+                pool.discard(conn)
+                raise
+        except BaseException:
+            pool.discard(conn)
+            raise
+
+        response = PooledResponse(pool, conn, response)
+        if response.status >= 400:
+            # keep the same behavior as urlopen
+            body = response.read()
+            response.close()
+            raise HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+        return response
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+
+class StubResponse(io.BytesIO):
+    status = 200
+    reason = "OK"
+    headers = {}
+
+
+class StubTransport(BaseTransport):
+    """
+    transport for tests, nothing is sent.
+
+    responses are returned in order and the last one is repeated, a response may be bytes,
+    str or an exception to be raised. handler(url, data) may be given to build responses instead.
+    Requests are recorded in transport.requests as (url, data) tuples.
+    """
+
+    def __init__(self, responses=None, handler=None):
+        self.requests = []
+        self._responses = deque(responses or ())
+        self._handler = handler
+        self._lock = threading.Lock()
+
+    def add_response(self, response):
+        with self._lock:
+            self._responses.append(response)
+
+    def open(self, url, data=None, headers=None, timeout=None):
+        with self._lock:
+            self.requests.append((url, data))
+            if self._handler is None:
+                if len(self._responses) > 1:
+                    response = self._responses.popleft()
+                else:
+                    response = self._responses[0]
+        if self._handler is not None:
+            response = self._handler(url, data)
+
+        if isinstance(response, BaseException):
+            raise response
+        if isinstance(response, str):
+            response = response.encode("utf-8")
+        return StubResponse(response)
@@ -2,8 +2,73 @@
     alipay/utils.py
     ~~~~~~~~~~
 """
+from collections import namedtuple
+
+# result of BaseAliPay.server_api_many, exactly one of response and exception is None
+BatchResult = namedtuple("BatchResult", ["key", "response", "exception"])
 
 
 class AliPayConfig:
-    def __init__(self, timeout=15):
+    def __init__(
+        self,
+        timeout=15,
+        transport=None,
+        async_transport=None,
+        executor=None,
+        signer=None,
+        crypto_backend=None,
+        notify_cache=None,
+        json_backend=None,
+        retry_policy=None,
+        gateway=None,
+        hooks=None,
+        key_snapshot=None,
+        key_store=None,
+        single_flight=None,
+        trade_cache=None,
+        cert_cache_dir=None,
+        response_objects=None
+    ):
+        """
+        timeout: request timeout in seconds
+        transport: alipay.transport.BaseTransport instance, urlopen is used if not given
+        async_transport: transport for alipay.aio clients, AsyncPooledTransport by default
+        executor: concurrent.futures.Executor running signing and verification for alipay.aio clients,
+            the event loop's default executor is used if not given
+        signer: alipay.signing.ProcessPoolSigner instance,
+            requests are signed in the calling thread if not given
+        crypto_backend: "cryptodome"(default), "openssl" or an alipay.crypto backend instance
+        notify_cache: alipay.cache.LRUCache instance, results of verify() are cached by notify_id and sign
+        json_backend: "json"(default), "orjson", "ujson" or an alipay.jsonlib backend instance
+        retry_policy: alipay.retry.RetryPolicy instance,
+            requests are sent once and never rejected if not given
+        gateway: overrides the gateway url, e.g. the url of alipay.simulator.GatewaySimulator
+        hooks: alipay.hooks.BaseHook instances receiving an alipay.hooks.CallEvent for every gateway call
+        key_snapshot: alipay.snapshot.KeySnapshot instance, keys and certs found in it are not parsed again
+        key_store: alipay.keystore.KeyStore instance sharing parsed keys and certs between clients,
+            alipay.keystore.default_store if not given
+        single_flight: True or method names, concurrent identical requests of these methods share
+            one gateway call, True means alipay.singleflight.READ_ONLY_METHODS
+        trade_cache: alipay.tradecache.TradeStateCache instance, updated by verified notifications and
+            trade queries, api_alipay_trade_query is answered from it if possible
+        cert_cache_dir: directory keeping alipay certificates downloaded by DCAliPay after a rotation
+        response_objects: True or a dict of response_type => alipay.responses.LazyResponse subclass,
+            responses of these types are returned as lazily decoded objects instead of dicts
+        """
         self.timeout = timeout
+        self.transport = transport
+        self.async_transport = async_transport
+        self.executor = executor
+        self.signer = signer
+        self.crypto_backend = crypto_backend
+        self.notify_cache = notify_cache
+        self.json_backend = json_backend
+        self.retry_policy = retry_policy
+        self.gateway = gateway
+        self.hooks = hooks
+        self.key_snapshot = key_snapshot
+        self.key_store = key_store
+        self.single_flight = single_flight
+        self.trade_cache = trade_cache
+        self.cert_cache_dir = cert_cache_dir
+        self.response_objects = response_objects
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+    benchmarks/crypto_backends.py
+    ~~~~~~~~~~
+
+    sign/verify throughput of every crypto backend:
+
+        python benchmarks/crypto_backends.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+from alipay import AliPay  # noqa: E402
+from alipay.crypto import BACKENDS  # noqa: E402
+from alipay.utils import AliPayConfig  # noqa: E402
+
+CERTS = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "tests", "certs", "app")
+MESSAGE = "&".join("key{}=value{}".format(i, i) for i in range(20))
+
+
+def main(number=500):
+    with open(os.path.join(CERTS, "app_private_key.pem")) as fp:
+        private_key = fp.read()
+    with open(os.path.join(CERTS, "app_public_key.pem")) as fp:
+        public_key = fp.read()
+
+    print("{:<12}{:<6}{:>14}{:>16}".format("backend", "type", "sign ops/s", "verify ops/s"))
+    for backend in BACKENDS:
+        for sign_type in ("RSA", "RSA2"):
+            alipay = AliPay(
+                appid="appid",
+                app_private_key_string=private_key,
+                alipay_public_key_string=public_key,
+                sign_type=sign_type,
+                config=AliPayConfig(crypto_backend=backend)
+            )
+            signature = alipay._sign(MESSAGE)
+            sign = timeit.timeit(lambda: alipay._sign(MESSAGE), number=number)
+            verify = timeit.timeit(lambda: alipay._verify(MESSAGE, signature), number=number)
+            print("{:<12}{:<6}{:>14.0f}{:>16.0f}".format(backend, sign_type, number / sign, number / verify))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+    benchmarks/suite.py
+    ~~~~~~~~~~
+
+    microbenchmarks of the hot paths, results are written as json and compared with a baseline:
+
+        python benchmarks/suite.py                              # compare with benchmarks/baseline.json
+        python benchmarks/suite.py --output result.json         # save the results
+        python benchmarks/suite.py --save-baseline              # results become the new baseline
+        python benchmarks/suite.py --filter sign_data --quick
+
+    The exit status is 1 if a benchmark is slower than its baseline by more than --tolerance.
+    Baselines only make sense on the machine they were recorded on.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from alipay import AliPay, DCAliPay, ISVAliPay  # noqa: E402
+from alipay.keystore import KeyStore  # noqa: E402
+from alipay.utils import AliPayConfig  # noqa: E402
+
+CERTS = os.path.join(ROOT, "tests", "certs")
+BASELINE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "baseline.json")
+
+# name => (setup, number), setup() returns the function being measured
+BENCHMARKS = {}
+
+
+def benchmark(name, number):
+    def decorator(setup):
+        BENCHMARKS[name] = (setup, number)
+        return setup
+    return decorator
+
+
+def read(*path):
+    with open(os.path.join(CERTS, *path)) as fp:
+        return fp.read()
+
+
+def get_alipay(sign_type="RSA2"):
+    return AliPay(
+        appid="2016080000000000",
+        app_notify_url="http://example.com/app_notify_url",
+        app_private_key_string=read("app", "app_private_key.pem"),
+        alipay_public_key_string=read("app", "app_public_key.pem"),
+        sign_type=sign_type
+    )
+
+
+def get_dc_alipay(config=None):
+    return DCAliPay(
+        appid="2016080000000000",
+        app_notify_url="http://example.com/app_notify_url",
+        app_private_key_string=read("dc", "app_private_key"),
+        app_public_key_cert_string=read("dc", "app_public_key_cert.crt"),
+        alipay_public_key_cert_string=read("dc", "alipay_public_key_cert.crt"),
+        alipay_root_cert_string=read("dc", "alipay_root_cert.crt"),
+        config=config
+    )
+
+
+def get_isv_alipay():
+    return ISVAliPay(
+        appid="2016080000000000",
+        app_notify_url="http://example.com/app_notify_url",
+        app_private_key_string=read("app", "app_private_key.pem"),
+        alipay_public_key_string=read("app", "app_public_key.pem"),
+        app_auth_token="201708BB28623ce3d10f4f62875e9ef5cbeebX07"
+    )
+
+
+SMALL_BIZ_CONTENT = {
+    "subject": "测试订单",
+    "out_trade_no": "20150320010101001",
+    "total_amount": "88.88",
+    "product_code": "FAST_INSTANT_TRADE_PAY",
+}
+LARGE_BIZ_CONTENT = dict(SMALL_BIZ_CONTENT, goods_detail=[
+    {
+        "goods_id": "apple-{:04d}".format(i),
+        "goods_name": "苹果 {}".format(i),
+        "quantity": 1,
+        "price": "2.00",
+        "body": "特价手机" * 5,
+    }
+    for i in range(200)
+])
+
+
+def signed_response(alipay, size):
+    """a sync response of about size bytes, signed with the app key"""
+    item = {"invoice_code": "011001800111", "invoice_no": "12345678", "buyer_name": "某某公司"}
+    count = max(1, size // len(json.dumps(item)))
+    content = json.dumps({"code": "10000", "msg": "Success", "invoice_info_list": [item] * count})
+    return json.dumps({
+        "alipay_ebpp_invoice_token_batchquery_response": json.loads(content),
+        "sign": alipay._sign(content)
+    })
+
+
+for sign_type in ("RSA", "RSA2"):
+    for size, biz_content in (("small", SMALL_BIZ_CONTENT), ("large", LARGE_BIZ_CONTENT)):
+        def setup(sign_type=sign_type, biz_content=biz_content):
+            alipay = get_alipay(sign_type)
+            return lambda: alipay.sign_data(alipay.build_body("alipay.trade.page.pay", biz_content))
+        benchmark("sign_data[{},{}]".format(sign_type, size), 200)(setup)
+
+    def setup(sign_type=sign_type):
+        alipay = get_alipay(sign_type)
+        data = {
+            "notify_id": "2017050900222161310016931008470015",
+            "out_trade_no": "20170509224812",
+            "trade_status": "TRADE_SUCCESS",
+            "total_amount": "88.88",
+        }
+        signature = alipay._sign("&".join("{}={}".format(k, v) for k, v in sorted(data.items())))
+        return lambda: alipay.verify(dict(data), signature)
+    benchmark("verify[{}]".format(sign_type), 500)(setup)
+
+for label, size, number in (("1KB", 1024, 2000), ("100KB", 100 * 1024, 200), ("1MB", 1024 ** 2, 20),
+                            ("10MB", 10 * 1024 ** 2, 2)):
+    def setup(size=size):
+        alipay = get_alipay()
+        raw_string = signed_response(alipay, size)
+        response_type = "alipay_ebpp_invoice_token_batchquery_response"
+        return lambda: alipay._get_string_to_be_signed(raw_string, response_type)
+    benchmark("get_string_to_be_signed[{}]".format(label), number)(setup)
+
+    def setup(size=size):
+        alipay = get_alipay()
+        raw_string = signed_response(alipay, size).encode()
+        response_type = "alipay_ebpp_invoice_token_batchquery_response"
+        return lambda: alipay._verify_and_return_sync_response(raw_string, response_type)
+    benchmark("verify_sync_response[{}]".format(label), number)(setup)
+
+
+@benchmark("DCAliPay()", 20)
+def setup_dc_alipay():
+    # keys and certs are parsed every time
+    config = AliPayConfig(key_store=KeyStore(maxsize=0))
+    return lambda: get_dc_alipay(config)
+
+
+@benchmark("DCAliPay() cached", 200)
+def setup_dc_alipay_cached():
+    # parsed keys and certs come from the process-wide key store
+    get_dc_alipay()
+    return get_dc_alipay
+
+
+@benchmark("get_root_cert_sn", 200)
+def setup_root_cert_sn():
+    root_cert = read("dc", "alipay_root_cert.crt")
+    return lambda: DCAliPay.get_root_cert_sn(root_cert)
+
+
+for name, factory in (("AliPay", get_alipay), ("DCAliPay", get_dc_alipay), ("ISVAliPay", get_isv_alipay)):
+    def setup(factory=factory):
+        alipay = factory()
+        return lambda: alipay.build_body("alipay.trade.query", {"out_trade_no": "20150320010101001"})
+    benchmark("build_body[{}]".format(name), 20000)(setup)
+
+
+def run(names, quick=False, repeat=5):
+    results = {}
+    for name in names:
+        setup, number = BENCHMARKS[name]
+        func = setup()
+        func()
+        if quick:
+            number, repeat = max(1, number // 10), 3
+        times = [t / number for t in timeit.repeat(func, number=number, repeat=repeat)]
+        results[name] = {
+            "per_op_us": min(times) * 1e6,
+            "median_us": statistics.median(times) * 1e6,
+            "ops_per_sec": 1 / min(times),
+        }
+        print("{:<40}{:>14.1f} us{:>14.0f} ops/s".format(
+            name, results[name]["per_op_us"], results[name]["ops_per_sec"]
+        ))
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """prints the change of every benchmark, returns names of the regressed ones"""
+    regressions = []
+    print()
+    print("{:<40}{:>14}{:>14}{:>10}".format("benchmark", "baseline us", "current us", "change"))
+    for name, result in report["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print("{:<40}{:>14}{:>14.1f}{:>10}".format(name, "-", result["per_op_us"], "new"))
+            continue
+        change = result["per_op_us"] / base["per_op_us"] - 1
+        flag = ""
+        if change > tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print("{:<40}{:>14.1f}{:>14.1f}{:>+9.0%}{}".format(
+            name, base["per_op_us"], result["per_op_us"], change, flag
+        ))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--quick", action="store_true", help="fewer iterations, for smoke testing")
+    parser.add_argument("--output", help="write results to this json file")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline json file")
+    parser.add_argument("--save-baseline", action="store_true", help="write results to the baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown, 0.2 means 20%%")
+    args = parser.parse_args(argv)
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    report = run(names, quick=args.quick)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+        return 0
+    if not os.path.exists(args.baseline):
+        print("no baseline at {}, run with --save-baseline first".format(args.baseline))
+        return 0
+
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+    regressions = compare(report, baseline, args.tolerance)
+    if regressions:
+        print("\n{} benchmark(s) regressed by more than {:.0%}".format(len(regressions), args.tolerance))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -35,5 +35,6 @@ setup(
         "Programming Language :: Python :: 3.12",
     ],
     install_requires=["pycryptodomex>=3.15.0", "pyOpenSSL>=22.0.0"],
+    extras_require={"reconcile": ["numpy>=1.20"]},
     test_suite="setup.alipay_test_suite"
 )
@@ -25,3 +25,11 @@ def get_dc_certs():
         os.path.join(path, "alipay_public_key_cert.crt"),
         os.path.join(path, "alipay_root_cert.crt")
     )
+
+
+def get_alipay_certs():
+    path = os.path.join(current_dir, "certs/ali")
+    return (
+        os.path.join(path, "ali_private_key.pem"),
+        os.path.join(path, "ali_public_key.pem")
+    )
@@ -4,8 +4,12 @@
     test.py
     ~~~~~~~~~~
 """
+import importlib.util
 import json
+import os
 import subprocess
+import sys
+import time
 import unittest
 
 from alipay import AliPay, DCAliPay, ISVAliPay
@@ -33,7 +37,7 @@ class AliPayTestCase(unittest.TestCase):
         super().setUp()
         self._app_private_key_path, self._app_public_key_path = helper.get_app_certs()
 
-    def get_client(self, sign_type):
+    def get_client(self, sign_type, config=None):
         with open(self._app_private_key_path) as fp:
             app_private_key_string = fp.read()
 
@@ -45,7 +49,8 @@ class AliPayTestCase(unittest.TestCase):
             app_notify_url="http://example.com/app_notify_url",
             app_private_key_string=app_private_key_string,
             alipay_public_key_string=app_public_key_string,
-            sign_type=sign_type
+            sign_type=sign_type,
+            config=config
         )
     
     def get_empty_notify_url_client(self, sign_type):
@@ -62,12 +67,13 @@ class AliPayTestCase(unittest.TestCase):
             sign_type=sign_type
         )
 
-    def _prepare_sync_response(self, alipay, response_type):
+    def _prepare_sync_response(self, alipay, response_type, data=None):
         """sign data with private key so we can validate with our public key later"""
-        data = {
-            "name": "Lily",
-            "age": "12"
-        }
+        if data is None:
+            data = {
+                "name": "Lily",
+                "age": "12"
+            }
         response = {
             response_type: data,
             "sign": alipay._sign(json.dumps(data))
@@ -210,6 +216,42 @@ class AliPaySignTestCase(AliPayTestCase):
         alipay = self.get_client(sign_type="RSA2")
         alipay.verify(data, "ssss")
 
+    def test_openssl_backend(self):
+        """两种加密后端得到相同的签名"""
+        from alipay.utils import AliPayConfig
+
+        raw_content = "a=1&b=中文\n"
+        for sign_type in ("RSA", "RSA2"):
+            alipay = self.get_client(sign_type)
+            openssl_alipay = self.get_client(sign_type, config=AliPayConfig(crypto_backend="openssl"))
+            signature = alipay._sign(raw_content)
+            self.assertEqual(openssl_alipay._sign(raw_content), signature)
+            self.assertTrue(openssl_alipay._verify(raw_content, signature))
+            self.assertFalse(openssl_alipay._verify(raw_content[:-1], signature))
+
+    def test_sign_data_with_template(self):
+        """预编译模板与逐项拼接得到相同的结果"""
+        from urllib.parse import quote_plus
+
+        def sign_data(alipay, data):
+            ordered_items = sorted(
+                (k, json.dumps(v, separators=(',', ':')) if isinstance(v, dict) else v)
+                for k, v in data.items()
+            )
+            raw_string = "&".join("{}={}".format(k, v) for k, v in ordered_items)
+            unquoted_items = ordered_items + [('sign', alipay._sign(raw_string))]
+            return "&".join("{}={}".format(k, quote_plus(v)) for k, v in unquoted_items)
+
+        alipay = self.get_client("RSA2")
+        for method, kwargs in (
+            ("alipay.trade.page.pay", {"return_url": "http://example.com/?a=1&b=中文"}),
+            ("alipay.trade.page.pay", {"notify_url": "http://example.com/other"}),
+            ("alipay.trade.query", {}),
+            ("alipay.trade.query", {"app_id": "another"}),
+        ):
+            data = alipay.build_body(method, {"subject": "中文 &=+"}, **kwargs)
+            self.assertEqual(alipay.sign_data(dict(data)), sign_data(alipay, data))
+
     def test_init_alipay_with_string(self):
         with open(self._app_private_key_path) as fp:
             private_string = fp.read()
@@ -414,7 +456,7 @@ class DCAliPayTestCase(AliPayTestCase):
             self._alipay_root_cert_path
         ) = helper.get_dc_certs()
 
-    def get_client(self):
+    def get_client(self, config=None):
         with open(self._app_private_key_path) as fp:
             app_private_key_string = fp.read()
         with open(self._app_public_key_cert_path) as fp:
@@ -433,7 +475,8 @@ class DCAliPayTestCase(AliPayTestCase):
             app_private_key_string=app_private_key_string,
             app_public_key_cert_string=app_public_key_cert_string,
             alipay_public_key_cert_string=alipay_public_key_cert_string,
-            alipay_root_cert_string=alipay_root_cert_string
+            alipay_root_cert_string=alipay_root_cert_string,
+            config=config
         )
 
     def _prepare_create_face_to_face_response(self, alipay):
@@ -471,6 +514,13 @@ class DCAliPayTestCase(AliPayTestCase):
 
         self.assertTrue(mock_urlopen.called)
 
+    def test_build_body(self):
+        alipay = self.get_client()
+        data = alipay.build_body("alipay.trade.query", {"out_trade_no": "out_trade_no"})
+        self.assertEqual(data["app_cert_sn"], alipay.app_cert_sn)
+        self.assertEqual(data["alipay_root_cert_sn"], alipay.alipay_root_cert_sn)
+        self.assertIn("app_cert_sn=" + alipay.app_cert_sn, alipay.sign_data(data))
+
     @mock.patch("alipay.urlopen")
     def test_alipay_fund_trans_uni_transfer(self, mock_urlopen):
         alipay = self.get_client()
@@ -552,3 +602,1641 @@ class AliPayUtilTestCase(AliPayTestCase):
         # 不合法测试, 不报错就好
         s = """{"response_type":"key1":"key2":"""
         alipay._get_string_to_be_signed(s, "response_type")
+        # 字符串中的大括号
+        s = """{"response_type":{"key1":"}{\\"}","key2":{}},"sign":"xx"}"""
+        expected = """{"key1":"}{\\"}","key2":{}}"""
+        self.assertEqual(expected, alipay._get_string_to_be_signed(s, "response_type"))
+        self.assertEqual(
+            expected.encode(), bytes(alipay._get_string_to_be_signed(memoryview(s.encode()), "response_type"))
+        )
+
+    def test_verify_bytes_response(self):
+        alipay = self.get_client("RSA2")
+        content = json.dumps({"name": "{中文}", "items": [{"a": "}"}] * 100}, ensure_ascii=False)
+        sign = alipay._sign(content).replace("/", "\\/")
+        raw = '{"alipay_trade_query_response":%s,"sign":"%s"}' % (content, sign)
+
+        for raw_string in (raw, raw.encode(), memoryview(raw.encode())):
+            result = alipay._verify_and_return_sync_response(raw_string, "alipay_trade_query_response")
+            self.assertEqual(result["name"], "{中文}")
+        with self.assertRaises(AliPayValidationError):
+            alipay._verify_and_return_sync_response(
+                raw.replace("中文", "英文").encode(), "alipay_trade_query_response"
+            )
+
+
+class TransportTestCase(AliPayTestCase):
+
+    def _start_server(self, body, gzipped=False):
+        import gzip
+        import http.server
+        import threading
+
+        connections = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                connections.append(self.client_address)
+
+            def do_GET(self):
+                payload = gzip.compress(body) if gzipped else body
+                self.send_response(200)
+                if gzipped:
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return "http://127.0.0.1:{}/gateway.do".format(server.server_port), connections
+
+    def test_pooled_transport_reuses_connection(self):
+        from alipay.transport import PooledTransport
+
+        url, connections = self._start_server(b"hello")
+        transport = PooledTransport(pool_size=2)
+        self.addCleanup(transport.close)
+        for _ in range(5):
+            self.assertEqual(transport.request(url + "?a=1"), b"hello")
+        self.assertEqual(len(connections), 1)
+
+    def test_pooled_transport_gzip(self):
+        from alipay.transport import PooledTransport
+
+        body = b"x" * 100000
+        url, _ = self._start_server(body, gzipped=True)
+        transport = PooledTransport()
+        self.addCleanup(transport.close)
+        self.assertEqual(transport.request(url), body)
+        response = transport.open(url)
+        chunks = iter(lambda: response.read(4096), b"")
+        self.assertEqual(b"".join(chunks), body)
+        response.close()
+
+    def test_stub_transport(self):
+        from alipay.transport import StubTransport
+        from alipay.utils import AliPayConfig
+
+        transport = StubTransport()
+        alipay = self.get_client("RSA2", config=AliPayConfig(transport=transport))
+        transport.add_response(self._prepare_sync_response(alipay, "alipay_trade_query_response"))
+
+        result = alipay.api_alipay_trade_query(out_trade_no="out_trade_no")
+        self.assertEqual(result["name"], "Lily")
+        self.assertEqual(len(transport.requests), 1)
+        self.assertIn("method=alipay.trade.query", transport.requests[0][0])
+
+
+class AsyncAliPayTestCase(AliPayTestCase):
+
+    def get_async_client(self, config=None):
+        from alipay.aio import AsyncAliPay
+
+        with open(self._app_private_key_path) as fp:
+            app_private_key_string = fp.read()
+        with open(self._app_public_key_path) as fp:
+            app_public_key_string = fp.read()
+        return AsyncAliPay(
+            appid="appid",
+            app_private_key_string=app_private_key_string,
+            alipay_public_key_string=app_public_key_string,
+            config=config
+        )
+
+    def test_concurrent_queries(self):
+        import asyncio
+
+        body = self._prepare_sync_response(self.get_client("RSA2"), "alipay_trade_query_response")
+        connections = []
+
+        async def handle(reader, writer):
+            connections.append(writer)
+            try:
+                while await reader.readuntil(b"\r\n\r\n"):
+                    writer.write(
+                        b"HTTP/1.1 200 OK\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+                    )
+                    await writer.drain()
+            except asyncio.IncompleteReadError:
+                writer.close()
+
+        async def main():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            async with self.get_async_client() as alipay:
+                alipay._gateway = "http://127.0.0.1:{}/gateway.do".format(port)
+                results = await asyncio.gather(*[
+                    alipay.api_alipay_trade_query(out_trade_no=str(i)) for i in range(50)
+                ])
+                # connections are reused by the following requests
+                await alipay.api_alipay_trade_query(out_trade_no="51")
+            server.close()
+            return results
+
+        results = asyncio.run(main())
+        self.assertEqual(len(results), 50)
+        self.assertTrue(all(result["name"] == "Lily" for result in results))
+        self.assertLessEqual(len(connections), 50)
+
+    def test_sign_and_verify(self):
+        import asyncio
+
+        alipay = self.get_async_client()
+        sync_alipay = self.get_client("RSA2")
+
+        async def main():
+            order_string = await alipay.api_alipay_trade_page_pay(
+                out_trade_no="out_trade_no", total_amount=100, subject="test"
+            )
+            signature = sync_alipay._sign("a=1")
+            return order_string, await alipay.verify({"a": "1"}, signature)
+
+        order_string, verified = asyncio.run(main())
+        self.assertIn("sign=", order_string)
+        self.assertTrue(verified)
+
+    def test_batch_and_stream(self):
+        import asyncio
+        from alipay.transport import StubTransport
+        from alipay.utils import AliPayConfig
+
+        transport = StubTransport()
+        alipay = self.get_async_client(config=AliPayConfig(transport=transport))
+        body = self._prepare_sync_response(self.get_client("RSA2"), "alipay_trade_query_response")
+        transport.add_response(self._prepare_sync_response(
+            self.get_client("RSA2"), "alipay_ebpp_invoice_token_batchquery_response"
+        ))
+
+        async def request(url, data=None):
+            await asyncio.sleep(0)
+            return body
+
+        async def main():
+            with mock.patch.object(alipay, "_request", side_effect=request):
+                keys = [result.key async for result in alipay.api_alipay_trade_query_many(
+                    [str(i) for i in range(5)], max_workers=2
+                )]
+                calls = [("alipay.trade.query", {"out_trade_no": "1"})]
+                results = [result async for result in alipay.server_api_many(calls)]
+            with await alipay.server_api_stream("alipay.ebpp.invoice.token.batchquery") as response:
+                name = response["name"]
+            return keys, results, name
+
+        keys, results, name = asyncio.run(main())
+        self.assertEqual(sorted(keys), ["0", "1", "2", "3", "4"])
+        self.assertEqual(results[0].response["name"], "Lily")
+        self.assertEqual(name, "Lily")
+
+
+class BatchApiTestCase(AliPayTestCase):
+
+    def test_api_alipay_trade_query_many(self):
+        from alipay.transport import StubTransport
+        from alipay.utils import AliPayConfig
+
+        def handler(url, data):
+            if "out_trade_no%22%3A%22bad" in url:
+                return json.dumps({
+                    "alipay_trade_query_response": {"code": "40004", "sub_code": "ACQ.TRADE_NOT_EXIST"}
+                })
+            return self._prepare_sync_response(alipay, "alipay_trade_query_response")
+
+        alipay = self.get_client("RSA2", config=AliPayConfig(transport=StubTransport(handler=handler)))
+
+        results = list(alipay.api_alipay_trade_query_many(["1", "2", "bad", "3"], max_workers=2))
+        self.assertEqual(len(results), 4)
+        results = {result.key: result for result in results}
+        self.assertIsInstance(results["bad"].exception, AliPayException)
+        self.assertIsNone(results["bad"].response)
+        self.assertEqual(results["1"].response["name"], "Lily")
+
+    def test_server_api_many(self):
+        from alipay.transport import StubTransport
+        from alipay.utils import AliPayConfig
+
+        transport = StubTransport()
+        alipay = self.get_client("RSA2", config=AliPayConfig(transport=transport))
+        transport.add_response(self._prepare_sync_response(alipay, "alipay_trade_query_response"))
+        calls = (("alipay.trade.query", {"out_trade_no": str(i)}) for i in range(10))
+
+        keys = sorted(result.key for result in alipay.server_api_many(calls, max_workers=3))
+        self.assertEqual(keys, list(range(10)))
+
+
+class ProcessPoolSignerTestCase(AliPayTestCase):
+
+    def test_sign_in_pool(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        from alipay.signing import ProcessPoolSigner
+        from alipay.utils import AliPayConfig
+
+        signer = ProcessPoolSigner(max_workers=2, batch_size=4)
+        self.addCleanup(signer.close)
+        for sign_type in ("RSA", "RSA2"):
+            alipay = self.get_client(sign_type, config=AliPayConfig(signer=signer))
+            strings = ["a={}&b=中文".format(i) for i in range(20)]
+            expected = [alipay._sign_in_process(s) for s in strings]
+            with ThreadPoolExecutor(8) as executor:
+                self.assertEqual(list(executor.map(alipay._sign, strings)), expected)
+            self.assertEqual(
+                signer.sign_many(alipay._app_private_key_string, sign_type, strings, alipay._sign_in_process),
+                expected
+            )
+
+    def test_fallback_after_close(self):
+        from alipay.signing import ProcessPoolSigner
+        from alipay.utils import AliPayConfig
+
+        signer = ProcessPoolSigner(max_workers=1)
+        signer.close()
+        alipay = self.get_client("RSA2", config=AliPayConfig(signer=signer))
+        self.assertEqual(alipay._sign("hello"), alipay._sign_in_process("hello"))
+
+    def test_fallback_on_timeout(self):
+        from alipay.signing import ProcessPoolSigner
+        from alipay.utils import AliPayConfig
+
+        # starting a worker takes far longer than the timeout
+        signer = ProcessPoolSigner(max_workers=1, timeout=0.001)
+        alipay = self.get_client("RSA2", config=AliPayConfig(signer=signer))
+        try:
+            self.assertEqual(alipay._sign("hello"), alipay._sign_in_process("hello"))
+            self.assertTrue(signer.available)
+        finally:
+            signer.close()
+
+
+class StreamingResponseTestCase(AliPayTestCase):
+
+    def _prepare_large_response(self, alipay, count):
+        content = json.dumps({
+            "code": "10000",
+            "msg": "Success",
+            "invoice_info_list": [
+                {"id": i, "name": "发票{}".format(i), "memo": "}{[]\\\""} for i in range(count)
+            ],
+            "total": count
+        }, ensure_ascii=False)
+        raw = '{"alipay_ebpp_invoice_token_batchquery_response":%s,"alipay_cert_sn":"sn","sign":"%s"}' % (
+            content, alipay._sign(content)
+        )
+        return raw.encode("utf-8")
+
+    def test_server_api_stream(self):
+        from alipay.transport import StubTransport
+        from alipay.utils import AliPayConfig
+
+        for backend in ("cryptodome", "openssl"):
+            transport = StubTransport()
+            alipay = self.get_client("RSA2", config=AliPayConfig(transport=transport, crypto_backend=backend))
+            transport.add_response(self._prepare_large_response(alipay, 5000))
+
+            with alipay.server_api_stream(
+                "alipay.ebpp.invoice.token.batchquery", {"invoice_token": "token"},
+                chunk_size=4096, spool_size=8192
+            ) as response:
+                self.assertEqual(response["code"], "10000")
+                self.assertEqual(response["total"], 5000)
+                invoices = response["invoice_info_list"]
+                self.assertEqual(len(invoices), 5000)
+                for i, invoice in enumerate(invoices):
+                    self.assertEqual(invoice["name"], "发票{}".format(i))
+                    self.assertEqual(invoice["memo"], "}{[]\\\"")
+
+    def test_server_api_stream_invalid_sign(self):
+        from alipay.transport import StubTransport
+        from alipay.utils import AliPayConfig
+
+        transport = StubTransport()
+        alipay = self.get_client("RSA2", config=AliPayConfig(transport=transport))
+        transport.add_response(self._prepare_large_response(alipay, 100).replace("发票1".encode(), b"x", 1))
+        transport.add_response(json.dumps({
+            "error_response": {"code": "40002", "sub_code": "isv.code-invalid"}
+        }))
+
+        with self.assertRaises(AliPayValidationError):
+            alipay.server_api_stream("alipay.ebpp.invoice.token.batchquery", chunk_size=1024)
+        with self.assertRaises(AliPayException):
+            alipay.server_api_stream("alipay.ebpp.invoice.token.batchquery", chunk_size=1024)
+
+    def test_server_api_stream_fallback(self):
+        from alipay.transport import StubTransport
+        from alipay.utils import AliPayConfig
+
+        transport = StubTransport()
+        alipay = self.get_client("RSA2", config=AliPayConfig(transport=transport))
+        response_type = "alipay_ebpp_invoice_token_batchquery_response"
+        data = {"code": "10000", "msg": "Success", "invoice_info_list": [{"id": 1}, {"id": 2}]}
+        response = json.loads(self._prepare_sync_response(alipay, response_type, data))
+        # sign before the signed span, which isn't located while streaming
+        transport.add_response(json.dumps({"sign": response["sign"], response_type: data}))
+        transport.add_response(json.dumps({"sign": response["sign"], response_type: dict(data, msg="x")}))
+
+        with alipay.server_api_stream("alipay.ebpp.invoice.token.batchquery") as response:
+            self.assertEqual(len(response["invoice_info_list"]), 2)
+            self.assertEqual(response.to_dict(), data)
+        with self.assertRaises(AliPayValidationError):
+            alipay.server_api_stream("alipay.ebpp.invoice.token.batchquery")
+
+
+class NotifyCacheTestCase(AliPayTestCase):
+
+    def test_verify_with_cache(self):
+        from alipay.cache import LRUCache
+        from alipay.utils import AliPayConfig
+
+        cache = LRUCache(maxsize=2, ttl=60)
+        alipay = self.get_client("RSA2", config=AliPayConfig(notify_cache=cache))
+        data = {"notify_id": "notify_id", "out_trade_no": "out_trade_no", "trade_status": "TRADE_SUCCESS"}
+        signature = alipay._sign("notify_id=notify_id&out_trade_no=out_trade_no&trade_status=TRADE_SUCCESS")
+
+        self.assertTrue(alipay.verify(dict(data), signature))
+        with mock.patch.object(alipay, "_verify") as mock_verify:
+            self.assertTrue(alipay.verify(dict(data), signature))
+            self.assertFalse(mock_verify.called)
+        self.assertEqual(cache.stats["hits"], 1)
+
+        # 篡改数据后不能命中缓存
+        self.assertFalse(alipay.verify(dict(data, trade_status="TRADE_CLOSED"), signature))
+
+    def test_lru_cache(self):
+        from alipay.cache import LRUCache
+
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("d", 4, ttl=-1)
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(cache.stats["evictions"], 2)
+
+
+class JSONBackendTestCase(AliPayTestCase):
+
+    def test_pre_serialized_biz_content(self):
+        alipay = self.get_client("RSA2")
+        biz_content = {"out_trade_no": "out_trade_no", "subject": "中文"}
+        expected = alipay.build_body("alipay.trade.query", biz_content)
+        for serialized in (
+            json.dumps(biz_content, separators=(',', ':')),
+            json.dumps(biz_content, separators=(',', ':')).encode()
+        ):
+            data = alipay.build_body("alipay.trade.query", serialized)
+            data["timestamp"] = expected["timestamp"]
+            self.assertEqual(alipay.sign_data(data), alipay.sign_data(dict(expected)))
+
+    @unittest.skipIf(not importlib.util.find_spec("orjson"), "orjson is not installed")
+    def test_orjson(self):
+        from alipay.transport import StubTransport
+        from alipay.utils import AliPayConfig
+
+        transport = StubTransport()
+        alipay = self.get_client(
+            "RSA2", config=AliPayConfig(transport=transport, json_backend="orjson")
+        )
+        self.assertEqual(
+            alipay._json.dumps({"a": [1, "b"], "c": {"d": None}}), '{"a":[1,"b"],"c":{"d":null}}'
+        )
+
+        transport.add_response(self._prepare_sync_response(alipay, "alipay_trade_query_response"))
+        result = alipay.api_alipay_trade_query(out_trade_no="out_trade_no")
+        self.assertEqual(result["name"], "Lily")
+        self.assertIn("biz_content=%7B%22out_trade_no%22%3A%22out_trade_no%22%7D", transport.requests[0][0])
+
+        content = json.dumps({"name": "中文"}, ensure_ascii=False)
+        raw = '{"alipay_trade_query_response":%s,"alipay_cert_sn":"sn","sign":"%s"}' % (
+            content, alipay._sign(content)
+        )
+        result = alipay._verify_and_return_sync_response(raw.encode(), "alipay_trade_query_response")
+        self.assertEqual(result["name"], "中文")
+        with self.assertRaises(AliPayValidationError):
+            alipay._verify_and_return_sync_response(
+                raw.replace("中文", "英文").encode(), "alipay_trade_query_response"
+            )
+
+    def test_backends_dump_the_same_bytes(self):
+        from alipay.jsonlib import get_backend
+
+        biz_content = {"subject": "测试商品 é😀\x7f", "body": "a\n\"b\"/", "total_amount": "88.88",
+                       "goods_detail": [{"quantity": 1, "price": 10}], "extend_params": None}
+        ascii_content = {"subject": "a\x7fb"}
+        expected = json.dumps(biz_content, separators=(',', ':'))
+        self.assertIn("\\u6d4b\\u8bd5", expected)
+        for name in ("orjson", "ujson"):
+            if importlib.util.find_spec(name):
+                self.assertEqual(get_backend(name).dumps(biz_content), expected)
+                self.assertEqual(get_backend(name).dumps(ascii_content), '{"subject":"a\\u007fb"}')
+
+
+class RetryPolicyTestCase(AliPayTestCase):
+
+    def _get_client(self, responses, **kwargs):
+        from alipay.retry import RetryPolicy
+        from alipay.transport import StubTransport
+        from alipay.utils import AliPayConfig
+
+        transport = StubTransport()
+        policy = RetryPolicy(backoff_base=0, **kwargs)
+        alipay = self.get_client("RSA2", config=AliPayConfig(transport=transport, retry_policy=policy))
+        for response in responses:
+            transport.add_response(
+                response if isinstance(response, Exception)
+                else self._prepare_sync_response(alipay, response)
+            )
+        return alipay, transport, policy
+
+    def test_retry_idempotent_methods(self):
+        from urllib.error import HTTPError
+
+        alipay, transport, _ = self._get_client([
+            TimeoutError("timed out"),
+            HTTPError("url", 502, "Bad Gateway", {}, None),
+            "alipay_trade_query_response",
+        ])
+        self.assertEqual(alipay.api_alipay_trade_query(out_trade_no="1")["name"], "Lily")
+        self.assertEqual(len(transport.requests), 3)
+
+        alipay, transport, _ = self._get_client([
+            HTTPError("url", 400, "Bad Request", {}, None), "alipay_trade_query_response"
+        ])
+        with self.assertRaises(HTTPError):
+            alipay.api_alipay_trade_query(out_trade_no="1")
+
+        # refunds are never sent twice
+        alipay, transport, _ = self._get_client([
+            TimeoutError("timed out"), "alipay_trade_refund_response"
+        ])
+        with self.assertRaises(TimeoutError):
+            alipay.api_alipay_trade_refund(1, out_trade_no="1")
+        self.assertEqual(len(transport.requests), 1)
+
+    def test_circuit_breaker(self):
+        from alipay.exceptions import AliPayCircuitOpenError
+        from alipay.retry import CLOSED, HALF_OPEN, OPEN
+
+        transitions = []
+        alipay, transport, policy = self._get_client(
+            [ConnectionResetError(), ConnectionResetError(), "alipay_trade_query_response"],
+            max_attempts=1,
+            failure_threshold=2,
+            recovery_timeout=0.05,
+            on_state_change=lambda gateway, old, new: transitions.append((gateway, old, new))
+        )
+        for _ in range(2):
+            with self.assertRaises(ConnectionResetError):
+                alipay.api_alipay_trade_query(out_trade_no="1")
+        with self.assertRaises(AliPayCircuitOpenError):
+            alipay.api_alipay_trade_query(out_trade_no="1")
+        self.assertEqual(len(transport.requests), 2)
+
+        time.sleep(0.06)
+        self.assertEqual(policy.breaker(alipay._gateway).state, HALF_OPEN)
+        self.assertEqual(alipay.api_alipay_trade_query(out_trade_no="1")["name"], "Lily")
+        self.assertEqual(
+            [t[1:] for t in transitions],
+            [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)]
+        )
+        self.assertEqual(transitions[0][0], alipay._gateway)
+
+
+class GatewaySimulatorTestCase(AliPayTestCase):
+
+    def _start(self, **kwargs):
+        from alipay.simulator import GatewaySimulator
+        from alipay.transport import PooledTransport
+        from alipay.utils import AliPayConfig
+
+        with open(self._app_private_key_path) as fp:
+            app_private_key_string = fp.read()
+        with open(self._app_public_key_path) as fp:
+            app_public_key_string = fp.read()
+        with open(helper.get_alipay_certs()[0]) as fp:
+            alipay_private_key_string = fp.read()
+        with open(helper.get_alipay_certs()[1]) as fp:
+            alipay_public_key_string = fp.read()
+
+        simulator = GatewaySimulator(
+            app_public_key_string=app_public_key_string,
+            alipay_private_key_string=alipay_private_key_string,
+            **kwargs
+        )
+        simulator.start()
+        self.addCleanup(simulator.stop)
+        transport = PooledTransport()
+        self.addCleanup(transport.close)
+        alipay = AliPay(
+            appid="appid",
+            app_private_key_string=app_private_key_string,
+            alipay_public_key_string=alipay_public_key_string,
+            config=AliPayConfig(gateway=simulator.url, transport=transport)
+        )
+        return simulator, alipay
+
+    def test_trades(self):
+        simulator, alipay = self._start()
+        result = alipay.api_alipay_trade_precreate("subject", "out_trade_no", 10)
+        self.assertEqual(result["code"], "10000")
+        result = alipay.api_alipay_trade_query(out_trade_no="out_trade_no")
+        self.assertEqual(result["trade_status"], "WAIT_BUYER_PAY")
+
+        simulator.complete_payment("out_trade_no")
+        result = alipay.api_alipay_trade_query(out_trade_no="out_trade_no")
+        self.assertEqual(result["trade_status"], "TRADE_SUCCESS")
+        result = alipay.api_alipay_trade_refund(4, out_trade_no="out_trade_no", out_request_no="1")
+        self.assertEqual((result["fund_change"], result["refund_fee"]), ("Y", "4.00"))
+        result = alipay.api_alipay_trade_refund(7, out_trade_no="out_trade_no", out_request_no="2")
+        self.assertEqual(result["sub_code"], "ACQ.REFUND_AMT_NOT_EQUAL_TOTAL")
+        result = alipay.api_alipay_trade_fastpay_refund_query("1", out_trade_no="out_trade_no")
+        self.assertEqual(result["refund_amount"], "4.00")
+        self.assertEqual(alipay.api_alipay_trade_close(out_trade_no="out_trade_no")["code"], "40004")
+        self.assertEqual(alipay.api_alipay_trade_query(out_trade_no="x")["sub_code"], "ACQ.TRADE_NOT_EXIST")
+
+        # requests signed with another key are rejected
+        alipay._app_private_key = alipay._crypto.load_private_key(open(helper.get_alipay_certs()[0]).read())
+        result = alipay.api_alipay_trade_query(out_trade_no="out_trade_no")
+        self.assertEqual(result["sub_code"], "isv.invalid-signature")
+
+    def test_faults(self):
+        from urllib.error import HTTPError
+
+        simulator, alipay = self._start(latency=0.001, faults={503: 0.5, "error_response": 0.5})
+        errors = set()
+        for _ in range(20):
+            try:
+                alipay.api_alipay_trade_query(out_trade_no="out_trade_no")
+            except HTTPError as e:
+                errors.add(e.code)
+            except AliPayException:
+                errors.add("error_response")
+        self.assertEqual(errors, {503, "error_response"})
+
+
+class HooksTestCase(AliPayTestCase):
+
+    def test_call_events(self):
+        from alipay.hooks import BaseHook, HistogramCollector
+        from alipay.retry import RetryPolicy
+        from alipay.transport import StubTransport
+        from alipay.utils import AliPayConfig
+
+        events = []
+
+        class Hook(BaseHook):
+            def on_call(self, event):
+                events.append(event)
+
+        collector = HistogramCollector()
+        transport = StubTransport()
+        alipay = self.get_client("RSA2", config=AliPayConfig(
+            transport=transport,
+            hooks=[Hook(), collector],
+            retry_policy=RetryPolicy(backoff_base=0)
+        ))
+        body = self._prepare_sync_response(alipay, "alipay_trade_query_response")
+        transport.add_response(TimeoutError())
+        transport.add_response(body)
+        transport.add_response(b'{"error_response":{"code":"40002","msg":"Invalid Arguments"},"sign":""}')
+        alipay.api_alipay_trade_query(out_trade_no="1")
+
+        event = events[0]
+        self.assertEqual(event.method, "alipay.trade.query")
+        self.assertEqual(set(event.phases), {"build_body", "sign", "request", "verify"})
+        self.assertEqual(event.attempts, 2)
+        self.assertEqual(event.response_size, len(body))
+        self.assertEqual(event.request_size, len(transport.requests[-1][0]))
+        self.assertEqual(event.breaker_state, "closed")
+        self.assertIsNone(event.exception)
+
+        with self.assertRaises(AliPayException):
+            alipay.api_alipay_trade_query(out_trade_no="1")
+        self.assertEqual((events[1].code, type(events[1].exception)), ("40002", AliPayException))
+
+        text = collector.export_prometheus()
+        self.assertIn('alipay_phase_seconds_count{method="alipay.trade.query",phase="sign"} 2', text)
+        self.assertIn(
+            'alipay_phase_seconds_bucket{method="alipay.trade.query",phase="verify",le="+Inf"} 2', text
+        )
+        self.assertIn('alipay_retries_total{method="alipay.trade.query"} 1', text)
+        self.assertIn(
+            'alipay_calls_total{method="alipay.trade.query",code="40002",sub_code="",'
+            'error="AliPayException"} 1',
+            text
+        )
+
+    def test_async_call_events(self):
+        import asyncio
+        from alipay.aio import AsyncAliPay
+        from alipay.hooks import HistogramCollector
+        from alipay.utils import AliPayConfig
+
+        collector = HistogramCollector()
+        alipay = self.get_client("RSA2")
+        body = self._prepare_sync_response(alipay, "alipay_trade_query_response")
+
+        class Transport:
+            async def request(self, url, data=None, timeout=None):
+                return body
+
+        async_alipay = AsyncAliPay(
+            appid="appid",
+            app_private_key_string=alipay._app_private_key_string,
+            alipay_public_key_string=alipay._alipay_public_key_string,
+            config=AliPayConfig(async_transport=Transport(), hooks=[collector])
+        )
+        asyncio.run(async_alipay.api_alipay_trade_query(out_trade_no="1"))
+        self.assertEqual(
+            {phase for _, phase in collector.phase_seconds}, {"build_body", "sign", "request", "verify"}
+        )
+
+
+class KeySnapshotTestCase(AliPayTestCase):
+
+    def test_import_has_no_side_effects(self):
+        output = subprocess.check_output([
+            sys.executable, "-c",
+            "import logging, sys, alipay;"
+            "print(logging.getLogger().handlers, logging.getLogger('python-alipay-sdk').handlers,"
+            "'OpenSSL' in sys.modules, 'Cryptodome' in sys.modules, 'asyncio' in sys.modules)"
+        ]).decode().strip()
+        self.assertEqual(output, "[] [] False False False")
+
+    def test_snapshot(self):
+        from alipay.keystore import KeyStore
+        from alipay.snapshot import KeySnapshot
+        from alipay.utils import AliPayConfig
+
+        for backend in ("cryptodome", "openssl"):
+            alipay = self.get_client("RSA2", config=AliPayConfig(crypto_backend=backend))
+            snapshot = KeySnapshot.loads(alipay.snapshot_keys().dumps())
+            self.assertEqual(len(snapshot), 2)
+
+            crypto = alipay._crypto
+            with mock.patch.object(crypto, "load_private_key", wraps=crypto.load_private_key) as load:
+                restored = self.get_client("RSA2", config=AliPayConfig(
+                    crypto_backend=backend, key_snapshot=snapshot, key_store=KeyStore(maxsize=0)
+                ))
+            self.assertEqual(load.call_args[1], {"validate": False})
+            data = alipay.build_body("alipay.trade.query", {"out_trade_no": "1"})
+            self.assertEqual(restored.sign_data(dict(data)), alipay.sign_data(dict(data)))
+            self.assertTrue(restored._verify("a=b", alipay._sign("a=b")))
+
+        # entries are only used for the very same key strings
+        alipay._app_private_key_string += "\n"
+        self.assertIsNone(snapshot.get("private_key", alipay._app_private_key_string))
+
+    def test_dc_snapshot(self):
+        from alipay.keystore import KeyStore
+        from alipay.snapshot import KeySnapshot
+        from alipay.utils import AliPayConfig
+
+        case = DCAliPayTestCase()
+        case.setUp()
+        alipay = case.get_client()
+        snapshot = KeySnapshot.loads(alipay.snapshot_keys().dumps())
+        with mock.patch.object(DCAliPay, "load_alipay_public_key_string") as load, \
+                mock.patch.object(DCAliPay, "get_cert_sn") as get_cert_sn, \
+                mock.patch.object(DCAliPay, "get_root_cert_sn") as get_root_cert_sn:
+            restored = case.get_client(
+                config=AliPayConfig(key_snapshot=snapshot, key_store=KeyStore(maxsize=0))
+            )
+            data = restored.build_body("alipay.trade.query", {"out_trade_no": "1"})
+        self.assertFalse(load.called or get_cert_sn.called or get_root_cert_sn.called)
+        self.assertEqual(data["app_cert_sn"], alipay.app_cert_sn)
+        self.assertEqual(data["alipay_root_cert_sn"], alipay.alipay_root_cert_sn)
+        self.assertEqual(restored._alipay_public_key_string, alipay._alipay_public_key_string)
+
+
+class KeyStoreTestCase(AliPayTestCase):
+
+    def test_shared_keys(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from alipay.keystore import KeyStore
+        from alipay.utils import AliPayConfig
+
+        store = KeyStore(maxsize=2)
+        config = AliPayConfig(key_store=store)
+        with mock.patch.object(AliPay, "_parse_private_key", autospec=True,
+                               side_effect=AliPay._parse_private_key) as parse:
+            with ThreadPoolExecutor(8) as executor:
+                clients = list(executor.map(lambda _: self.get_client("RSA2", config=config), range(16)))
+        self.assertEqual(parse.call_count, 1)
+        self.assertTrue(all(c._app_private_key is clients[0]._app_private_key for c in clients))
+        self.assertTrue(all(c._alipay_public_key is clients[0]._alipay_public_key for c in clients))
+        self.assertEqual(store.stats["size"], 2)
+
+        # keys of another backend are different objects
+        openssl = self.get_client("RSA2", config=AliPayConfig(key_store=store, crypto_backend="openssl"))
+        self.assertIsNot(openssl._app_private_key, clients[0]._app_private_key)
+        self.assertEqual(len(store), 2)
+
+    def test_dc_certs(self):
+        from alipay.keystore import KeyStore
+        from alipay.utils import AliPayConfig
+
+        store = KeyStore()
+        case = DCAliPayTestCase()
+        case.setUp()
+        alipay = case.get_client(config=AliPayConfig(key_store=store))
+        alipay.build_body("alipay.trade.query")
+        with mock.patch.object(DCAliPay, "get_root_cert_sn") as get_root_cert_sn, \
+                mock.patch.object(DCAliPay, "load_alipay_public_key_string") as load:
+            other = case.get_client(config=AliPayConfig(key_store=store))
+            self.assertEqual(other.alipay_root_cert_sn, alipay.alipay_root_cert_sn)
+        self.assertFalse(get_root_cert_sn.called or load.called)
+
+
+class MerchantRegistryTestCase(AliPayTestCase):
+
+    def test_merchant_token(self):
+        from alipay.isv import MerchantRegistry
+
+        alipay = self.get_client("RSA2")
+        registry = MerchantRegistry(alipay)
+        registry.register("m1", "token-1", expires_in=3600)
+        registry.register("m2", "token-2")
+
+        self.assertEqual(registry.build_body("m1", "alipay.trade.query")["app_auth_token"], "token-1")
+        url = registry.merchant("m2").client_api("alipay.trade.page.pay", {"out_trade_no": "1"})
+        self.assertIn("app_auth_token=token-2", url)
+        self.assertNotIn("app_auth_token", alipay.build_body("alipay.trade.query"))
+        self.assertFalse(registry.get("m1").expired)
+
+        with mock.patch.object(alipay, "_request", return_value=json.dumps({
+            "alipay_trade_query_response": {"code": "10000", "msg": "Success"}, "sign": "x"
+        })) as request, mock.patch.object(alipay, "_verify", return_value=True):
+            registry.merchant("m1").api_alipay_trade_query(out_trade_no="1")
+        self.assertIn("app_auth_token=token-1", request.call_args[0][0])
+
+    def test_eviction(self):
+        from alipay.exceptions import AliPayException
+        from alipay.isv import MemoryMerchantStore, MerchantRegistry
+
+        store = MemoryMerchantStore()
+        registry = MerchantRegistry(self.get_client("RSA2"), maxsize=2, store=store)
+        for i in range(3):
+            registry.register("m{}".format(i), "token-{}".format(i), "refresh-{}".format(i), 3600, 7200)
+        self.assertEqual(len(registry), 2)
+        context = registry.get("m0")
+        self.assertEqual((context.app_auth_token, context.app_refresh_token), ("token-0", "refresh-0"))
+
+        registry.remove("m0")
+        self.assertNotIn("m0", registry)
+        with self.assertRaises(AliPayException):
+            registry.merchant("m0")
+
+
+class TokenManagerTestCase(AliPayTestCase):
+
+    def get_manager(self, store=None, **kwargs):
+        from alipay.isv import MerchantRegistry, TokenManager
+
+        alipay = self.get_client("RSA2")
+        registry = MerchantRegistry(alipay, store=store)
+        manager = TokenManager(registry, **kwargs)
+        responses = iter(range(1, 1000))
+
+        def refresh(data, response_type):
+            time.sleep(0.05)
+            i = next(responses)
+            return {
+                "code": "10000", "app_auth_token": "token-{}".format(i),
+                "app_refresh_token": "refresh-{}".format(i), "expires_in": 1000, "re_expires_in": 2000
+            }
+        patcher = mock.patch.object(alipay, "verified_sync_response", side_effect=refresh)
+        self.addCleanup(patcher.stop)
+        return manager, patcher.start()
+
+    def test_single_flight(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        manager, request = self.get_manager()
+        manager.registry.register("m1", "token-0", "refresh-0", expires_in=0)
+        with ThreadPoolExecutor(8) as executor:
+            tokens = set(executor.map(lambda _: manager.token("m1"), range(8)))
+        self.assertEqual(tokens, {"token-1"})
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(request.call_args[0][0]["method"], "alipay.open.auth.token.app")
+        self.assertEqual(request.call_args[0][0]["biz_content"]["refresh_token"], "refresh-0")
+        self.assertEqual(manager.merchant("m1").build_body("alipay.trade.query")["app_auth_token"], "token-1")
+
+    def test_scheduled_refresh(self):
+        manager, request = self.get_manager(refresh_ahead=100, jitter=50, min_delay=0)
+        now = time.time()
+        for i in range(20):
+            manager.registry.register("m{}".format(i), "token-0", "refresh-0", expires_in=1000)
+        # due between 850 and 900 seconds from now
+        self.assertEqual(manager.refresh_due(now + 849), 0)
+        self.assertEqual(manager.refresh_due(now + 901), 20)
+        # refreshed tokens are due 1000 seconds later
+        self.assertEqual(manager.refresh_due(now + 849), 0)
+        self.assertEqual(request.call_count, 20)
+        self.assertTrue(manager.registry.get("m0").expires_at > now + 999)
+
+        # refreshed in background when due
+        with manager:
+            manager.registry.register("m-now", "token-0", "refresh-0", expires_in=0)
+            for _ in range(100):
+                if manager.registry.get("m-now").app_auth_token != "token-0":
+                    break
+                time.sleep(0.02)
+        self.assertNotEqual(manager.registry.get("m-now").app_auth_token, "token-0")
+
+    def test_short_lived_tokens(self):
+        # tokens of 1000 seconds with the defaults of 3 days ahead and 1 day of jitter
+        manager, request = self.get_manager()
+        now = time.time()
+        manager.registry.register("m1", "token-0", "refresh-0", expires_in=1000)
+        # at most half the lifetime ahead, at most a quarter of jitter
+        self.assertEqual(manager.refresh_due(now + 249), 0)
+        self.assertEqual(manager.refresh_due(now + 501), 1)
+        # the new token isn't refreshed at once again
+        self.assertEqual(manager.refresh_due(now + 249), 0)
+        self.assertEqual(request.call_count, 1)
+
+        # nor is an expired one sooner than min_delay
+        manager.registry.register("m2", "token-0", "refresh-0", expires_in=-10)
+        self.assertEqual(manager.refresh_due(now + 30), 0)
+        self.assertEqual(manager.refresh_due(now + 61), 1)
+
+    def test_restart(self):
+        from alipay.isv import MemoryMerchantStore
+
+        store = MemoryMerchantStore()
+        manager, request = self.get_manager(store=store, min_delay=0)
+        for i in range(3):
+            manager.registry.register("m{}".format(i), "token-0", "refresh-0", expires_in=1000)
+
+        # a new process, with the contexts in the store only
+        manager, request = self.get_manager(store=store, min_delay=0)
+        self.assertEqual(manager.refresh_due(time.time() + 1000), 0)
+        manager.registry.merchant("m0")
+        self.assertEqual(manager.schedule_all(), 3)
+        # contexts loaded again aren't scheduled twice
+        self.assertEqual(manager.schedule_all(), 3)
+        self.assertEqual(manager.refresh_due(time.time() + 1000), 3)
+        self.assertEqual(request.call_count, 3)
+        self.assertNotEqual(store.load("m2").app_auth_token, "token-0")
+
+    def test_isv_auth_code_exchanged_once(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        client = self.get_client("RSA2")
+        alipay = ISVAliPay(
+            appid="appid",
+            app_private_key_string=client._app_private_key_string,
+            alipay_public_key_string=client._alipay_public_key_string,
+            app_auth_code="code"
+        )
+
+        def exchange(*args, **kwargs):
+            time.sleep(0.05)
+            return {"app_auth_token": "token"}
+        with mock.patch.object(alipay, "api_alipay_open_auth_token_app", side_effect=exchange) as api:
+            with ThreadPoolExecutor(8) as executor:
+                tokens = set(executor.map(lambda _: alipay.app_auth_token, range(8)))
+        self.assertEqual(tokens, {"token"})
+        api.assert_called_once_with()
+
+
+class SingleFlightTestCase(AliPayTestCase):
+
+    def test_coalesced_queries(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from alipay.utils import AliPayConfig
+
+        alipay = self.get_client("RSA2", config=AliPayConfig(single_flight=True))
+        body = self._prepare_sync_response(alipay, "alipay_trade_query_response")
+
+        def request(url):
+            time.sleep(0.1)
+            return body
+        with mock.patch.object(alipay, "_request", side_effect=request) as _request:
+            with ThreadPoolExecutor(16) as executor:
+                results = list(executor.map(
+                    lambda i: alipay.api_alipay_trade_query(out_trade_no=str(i % 2)), range(16)
+                ))
+        self.assertEqual(_request.call_count, 2)
+        self.assertTrue(all(result == results[0] for result in results))
+        self.assertEqual(len({id(result) for result in results}), 16)
+
+        # not coalesced unless configured
+        alipay = self.get_client("RSA2")
+        with mock.patch.object(alipay, "_request", side_effect=request) as _request:
+            with ThreadPoolExecutor(4) as executor:
+                list(executor.map(lambda _: alipay.api_alipay_trade_query(out_trade_no="1"), range(4)))
+        self.assertEqual(_request.call_count, 4)
+
+    def test_async_coalesced_queries(self):
+        import asyncio
+        from alipay.aio import AsyncAliPay
+        from alipay.utils import AliPayConfig
+
+        client = self.get_client("RSA2")
+        body = self._prepare_sync_response(client, "alipay_trade_query_response")
+        alipay = AsyncAliPay(
+            appid="appid",
+            app_private_key_string=client._app_private_key_string,
+            alipay_public_key_string=client._alipay_public_key_string,
+            config=AliPayConfig(single_flight=["alipay.trade.query"])
+        )
+        calls = []
+
+        async def request(url):
+            calls.append(url)
+            await asyncio.sleep(0.1)
+            return body
+
+        async def main():
+            with mock.patch.object(alipay, "_request", side_effect=request):
+                return await asyncio.gather(*[
+                    alipay.api_alipay_trade_query(out_trade_no="1") for _ in range(10)
+                ])
+        results = asyncio.run(main())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 10)
+        self.assertIsNot(results[0], results[1])
+
+    def test_async_leader_cancelled(self):
+        import asyncio
+        from alipay.singleflight import AsyncSingleFlight
+
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def query():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return "result"
+
+        async def main():
+            leader = asyncio.ensure_future(flight.do("key", query))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(flight.do("key", query))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            result = await follower
+            self.assertTrue(leader.cancelled())
+
+            # the call is cancelled once nobody waits for it
+            alone = asyncio.ensure_future(flight.do("other", query))
+            await asyncio.sleep(0.01)
+            alone.cancel()
+            await asyncio.sleep(0.01)
+            return result, len(flight)
+
+        self.assertEqual(asyncio.run(main()), ("result", 0))
+        self.assertEqual(len(calls), 2)
+
+
+class TradeStateCacheTestCase(AliPayTestCase):
+
+    def query_response(self, alipay, trade_status):
+        data = {"code": "10000", "msg": "Success", "out_trade_no": "1", "trade_no": "2",
+                "trade_status": trade_status}
+        return self._prepare_sync_response(alipay, "alipay_trade_query_response", data)
+
+    def test_query_answered_from_cache(self):
+        from alipay.tradecache import TradeStateCache
+        from alipay.utils import AliPayConfig
+
+        cache = TradeStateCache(ttl=0.2)
+        alipay = self.get_client("RSA2", config=AliPayConfig(trade_cache=cache))
+        with mock.patch.object(alipay, "_request", side_effect=[
+            self.query_response(alipay, "WAIT_BUYER_PAY"), self.query_response(alipay, "TRADE_SUCCESS")
+        ]) as request:
+            result = alipay.api_alipay_trade_query(out_trade_no="1")
+            self.assertEqual(result["trade_status"], "WAIT_BUYER_PAY")
+            # non-terminal states within ttl
+            self.assertEqual(alipay.api_alipay_trade_query(trade_no="2")["trade_status"], "WAIT_BUYER_PAY")
+            self.assertEqual(request.call_count, 1)
+            time.sleep(0.25)
+            self.assertEqual(alipay.api_alipay_trade_query(out_trade_no="1")["trade_status"], "TRADE_SUCCESS")
+            self.assertEqual(request.call_count, 2)
+            time.sleep(0.25)
+            # terminal states until invalidated
+            result = alipay.api_alipay_trade_query(out_trade_no="1")
+            self.assertEqual(result["trade_status"], "TRADE_SUCCESS")
+            result["trade_status"] = "changed by caller"
+            self.assertEqual(alipay.api_alipay_trade_query(trade_no="2")["trade_status"], "TRADE_SUCCESS")
+            self.assertEqual(request.call_count, 2)
+
+        cache.invalidate(out_trade_no="1")
+        self.assertEqual(len(cache), 0)
+
+    def test_notification(self):
+        from alipay.tradecache import TradeStateCache
+        from alipay.utils import AliPayConfig
+
+        cache = TradeStateCache()
+        alipay = self.get_client("RSA2", config=AliPayConfig(trade_cache=cache))
+        data = {"notify_id": "n1", "out_trade_no": "1", "trade_no": "2", "trade_status": "TRADE_SUCCESS",
+                "total_amount": "88.88", "gmt_payment": "2017-05-09 22:48:23"}
+        signature = alipay._sign("&".join("{}={}".format(k, v) for k, v in sorted(data.items())))
+        self.assertFalse(alipay.verify(dict(data, total_amount="0.01"), signature))
+        self.assertIsNone(cache.get(out_trade_no="1"))
+
+        self.assertTrue(alipay.verify(dict(data), signature))
+        with mock.patch.object(alipay, "_request") as request:
+            result = alipay.api_alipay_trade_query(out_trade_no="1")
+        self.assertFalse(request.called)
+        self.assertEqual(result["total_amount"], "88.88")
+
+        # a delayed notification doesn't bring the trade back
+        cache.update_from_notify(dict(data, trade_status="WAIT_BUYER_PAY"))
+        self.assertEqual(cache.get(trade_no="2")["trade_status"], "TRADE_SUCCESS")
+
+    def test_merchant_notification(self):
+        from alipay.isv import MerchantRegistry
+        from alipay.tradecache import TradeStateCache
+        from alipay.utils import AliPayConfig
+
+        cache = TradeStateCache()
+        alipay = self.get_client("RSA2", config=AliPayConfig(trade_cache=cache))
+        registry = MerchantRegistry(alipay)
+        registry.register("m1", "token-1", auth_app_id="merchant-app")
+
+        def notify(**kwargs):
+            data = dict({"notify_id": "n1", "app_id": "isv-app", "out_trade_no": "1",
+                         "trade_status": "TRADE_SUCCESS"}, **kwargs)
+            signature = alipay._sign("&".join("{}={}".format(k, v) for k, v in sorted(data.items())))
+            self.assertTrue(alipay.verify(data, signature))
+
+        # a merchant whose token is unknown
+        notify(auth_app_id="other-app")
+        self.assertEqual(len(cache), 0)
+
+        notify(auth_app_id="merchant-app")
+        self.assertIsNone(cache.get(out_trade_no="1"))
+        with mock.patch.object(alipay, "_request") as request:
+            result = registry.merchant("m1").api_alipay_trade_query(out_trade_no="1")
+        self.assertFalse(request.called)
+        self.assertEqual(result["trade_status"], "TRADE_SUCCESS")
+
+
+class CertRotationTestCase(AliPayTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        import datetime
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.x509.oid import NameOID
+
+        def name(cn):
+            return x509.Name([
+                x509.NameAttribute(NameOID.COUNTRY_NAME, "CN"),
+                x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Test"),
+                x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "Test"),
+                x509.NameAttribute(NameOID.COMMON_NAME, cn),
+            ])
+
+        def issue(cn, issuer_key, issuer_cn, ca=False):
+            key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            now = datetime.datetime.now(datetime.timezone.utc)
+            cert = x509.CertificateBuilder().subject_name(name(cn)).issuer_name(name(issuer_cn or cn)) \
+                .public_key(key.public_key()).serial_number(x509.random_serial_number()) \
+                .not_valid_before(now - datetime.timedelta(days=1)) \
+                .not_valid_after(now + datetime.timedelta(days=30)) \
+                .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True) \
+                .sign(issuer_key or key, hashes.SHA256())
+            return key, cert.public_bytes(serialization.Encoding.PEM).decode()
+
+        cls.root_key, cls.root_cert = issue("Test Root", None, None, ca=True)
+        cls.old_key, cls.old_cert = issue("alipay old", cls.root_key, "Test Root")
+        cls.new_key, cls.new_cert = issue("alipay new", cls.root_key, "Test Root")
+        cls.rogue_key, cls.rogue_cert = issue("alipay rogue", None, None)
+
+    def sign(self, key, content):
+        from base64 import b64encode
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+
+        return b64encode(key.sign(content.encode(), padding.PKCS1v15(), hashes.SHA256())).decode()
+
+    def response(self, response_type, data, key, cert):
+        content = json.dumps(data)
+        return json.dumps({
+            response_type: data, "alipay_cert_sn": DCAliPay.get_cert_sn(cert), "sign": self.sign(key, content)
+        }).encode()
+
+    def download_response(self, key, cert):
+        from base64 import b64encode
+
+        data = {"code": "10000", "msg": "Success", "alipay_cert_content": b64encode(cert.encode()).decode()}
+        return self.response("alipay_open_app_alipaycert_download_response", data, key, cert)
+
+    def get_rotating_client(self, transport, cache_dir, **kwargs):
+        from alipay.utils import AliPayConfig
+
+        case = DCAliPayTestCase()
+        case.setUp()
+        client = case.get_client()
+        return DCAliPay(
+            appid="appid",
+            app_private_key_string=client._app_private_key_string,
+            app_public_key_cert_string=client._app_public_key_cert_string,
+            alipay_public_key_cert_string=self.old_cert,
+            alipay_root_cert_string=self.root_cert,
+            config=AliPayConfig(transport=transport, cert_cache_dir=cache_dir, **kwargs)
+        )
+
+    def test_rotated_cert(self):
+        import tempfile
+        from alipay.keystore import KeyStore
+        from alipay.transport import StubTransport
+
+        query = {"code": "10000", "msg": "Success", "out_trade_no": "1", "trade_status": "TRADE_SUCCESS"}
+        query_response = self.response("alipay_trade_query_response", query, self.new_key, self.new_cert)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            transport = StubTransport([query_response, self.download_response(self.new_key, self.new_cert),
+                                       query_response])
+            alipay = self.get_rotating_client(transport, cache_dir, key_store=KeyStore())
+            self.assertEqual(alipay.api_alipay_trade_query(out_trade_no="1"), query)
+            self.assertEqual(alipay.api_alipay_trade_query(out_trade_no="1"), query)
+            self.assertEqual(len(transport.requests), 3)
+            self.assertIn("alipay.open.app.alipaycert.download", transport.requests[1][0])
+
+            # signed with the old certificate
+            old_response = self.response("alipay_trade_query_response", query, self.old_key, self.old_cert)
+            alipay._transport = StubTransport([old_response])
+            self.assertEqual(alipay.api_alipay_trade_query(out_trade_no="1"), query)
+
+            # another client of the process shares the key
+            key_store = alipay._config.key_store
+            transport = StubTransport([query_response])
+            alipay = self.get_rotating_client(transport, None, key_store=key_store)
+            self.assertEqual(alipay.api_alipay_trade_query(out_trade_no="1"), query)
+            self.assertEqual(len(transport.requests), 1)
+
+            # another process finds the certificate on disk
+            transport = StubTransport([query_response])
+            alipay = self.get_rotating_client(transport, cache_dir, key_store=KeyStore())
+            self.assertEqual(alipay.api_alipay_trade_query(out_trade_no="1"), query)
+            self.assertEqual(len(transport.requests), 1)
+
+    def test_download_retried(self):
+        from urllib.error import HTTPError
+        from alipay.hooks import BaseHook
+        from alipay.keystore import KeyStore
+        from alipay.retry import RetryPolicy
+        from alipay.transport import StubTransport
+
+        events = []
+
+        class Hook(BaseHook):
+            def on_call(self, event):
+                events.append(event)
+
+        query = {"code": "10000", "msg": "Success", "out_trade_no": "1", "trade_status": "TRADE_SUCCESS"}
+        query_response = self.response("alipay_trade_query_response", query, self.new_key, self.new_cert)
+        transport = StubTransport([
+            query_response, HTTPError("url", 502, "Bad Gateway", {}, None),
+            self.download_response(self.new_key, self.new_cert)
+        ])
+        alipay = self.get_rotating_client(
+            transport, None, key_store=KeyStore(), retry_policy=RetryPolicy(backoff_base=0), hooks=[Hook()]
+        )
+        self.assertEqual(alipay.api_alipay_trade_query(out_trade_no="1"), query)
+        self.assertEqual(len(transport.requests), 3)
+        methods = [(event.method, event.attempts) for event in events]
+        self.assertIn(("alipay.open.app.alipaycert.download", 2), methods)
+
+    def test_rotated_cert_streamed(self):
+        from alipay.keystore import KeyStore
+        from alipay.transport import StubTransport
+
+        data = {"code": "10000", "msg": "Success", "invoice_info_list": [{"id": 1}, {"id": 2}]}
+        response_type = "alipay_ebpp_invoice_token_batchquery_response"
+        transport = StubTransport([
+            self.response(response_type, data, self.new_key, self.new_cert),
+            self.download_response(self.new_key, self.new_cert)
+        ])
+        alipay = self.get_rotating_client(transport, None, key_store=KeyStore())
+        with alipay.server_api_stream("alipay.ebpp.invoice.token.batchquery") as response:
+            self.assertEqual(response.to_dict(), data)
+        self.assertIn("alipay.open.app.alipaycert.download", transport.requests[1][0])
+
+    def test_untrusted_cert(self):
+        from alipay.transport import StubTransport
+
+        query = {"code": "10000", "msg": "Success", "out_trade_no": "1", "trade_status": "TRADE_SUCCESS"}
+        transport = StubTransport([
+            self.response("alipay_trade_query_response", query, self.rogue_key, self.rogue_cert),
+            self.download_response(self.rogue_key, self.rogue_cert),
+        ])
+        alipay = self.get_rotating_client(transport, None)
+        with self.assertRaises(AliPayValidationError):
+            alipay.api_alipay_trade_query(out_trade_no="1")
+
+
+class BillTestCase(AliPayTestCase):
+
+    def make_bill(self, rows):
+        import io
+        import zipfile
+
+        lines = ["#支付宝业务明细查询", "#账号：[20880000000000000156]",
+                 "#-----------------------------------------业务明细列表----------------------------------------",
+                 "支付宝交易号,商户订单号,业务类型,订单金额（元）,"]
+        lines += ["{}\t,{}\t,交易,{},".format(trade_no, out_trade_no, amount)
+                  for trade_no, out_trade_no, amount in rows]
+        lines += ["#-----------------------------------------业务明细列表结束------------------------------------",
+                  "#交易合计：{}笔".format(len(rows))]
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            archive.writestr("20880000000000000156_20230101_业务明细.csv", "\r\n".join(lines).encode("gbk"))
+            archive.writestr("20880000000000000156_20230101_业务明细(汇总).csv",
+                             "#汇总\r\n门店编号,交易订单总笔数\r\n,{}\r\n".format(len(rows)).encode("gbk"))
+        return buffer.getvalue()
+
+    def url_response(self, alipay):
+        data = {"code": "10000", "msg": "Success",
+                "bill_download_url": "http://127.0.0.1/downloadBillFile.resource"}
+        response_type = "alipay_data_dataservice_bill_downloadurl_query_response"
+        return self._prepare_sync_response(alipay, response_type, data)
+
+    def test_download_bill(self):
+        from alipay.transport import StubTransport
+        from alipay.utils import AliPayConfig
+
+        transport = StubTransport()
+        alipay = self.get_client("RSA2", config=AliPayConfig(transport=transport))
+        rows = [("2023010122001", str(i), "{}.00".format(i)) for i in range(1000)]
+        transport.add_response(self.url_response(alipay))
+        transport.add_response(self.make_bill(rows))
+
+        with alipay.download_bill("trade", "2023-01-01", spool_size=1024) as bill:
+            self.assertEqual(len(bill.members()), 2)
+            records = list(bill.rows())
+            self.assertEqual(len(records), 1000)
+            self.assertEqual(records[5]["商户订单号"], "5")
+            self.assertEqual(records[5]["订单金额（元）"], "5.00")
+            self.assertEqual(records[5].as_dict()["业务类型"], "交易")
+            self.assertEqual([r["交易订单总笔数"] for r in bill.rows(summary=True)], ["1000"])
+        self.assertIn("bill.downloadurl.query", transport.requests[0][0])
+        self.assertEqual(transport.requests[1][0], "http://127.0.0.1/downloadBillFile.resource")
+
+    def test_download_bills(self):
+        import tempfile
+        from alipay.transport import StubTransport
+        from alipay.utils import AliPayConfig
+
+        alipay = self.get_client("RSA2")
+        url_response, bill = self.url_response(alipay), self.make_bill([("1", "1", "1.00")])
+        alipay = self.get_client("RSA2", config=AliPayConfig(
+            transport=StubTransport(handler=lambda url, data: url_response if "gateway" in url else bill)
+        ))
+        with tempfile.TemporaryDirectory() as directory:
+            results = list(alipay.download_bills(
+                [("trade", "2023-01-0{}".format(i)) for i in range(1, 4)], directory=directory
+            ))
+            self.assertEqual(sorted(r.key[1] for r in results), ["2023-01-01", "2023-01-02", "2023-01-03"])
+            for result in results:
+                self.assertIsNone(result.exception)
+                with result.response as bill:
+                    self.assertEqual([r["商户订单号"] for r in bill], ["1"])
+            self.assertEqual(len(os.listdir(directory)), 3)
+
+    def test_merchant_bills(self):
+        from urllib.parse import parse_qs, urlsplit
+        from alipay.isv import MerchantRegistry
+        from alipay.transport import StubTransport
+        from alipay.utils import AliPayConfig
+
+        alipay = self.get_client("RSA2")
+        url_response, bill = self.url_response(alipay), self.make_bill([("1", "1", "1.00")])
+        transport = StubTransport(handler=lambda url, data: url_response if "gateway" in url else bill)
+        alipay = self.get_client("RSA2", config=AliPayConfig(transport=transport))
+        registry = MerchantRegistry(alipay)
+        registry.register("m1", "token-1")
+
+        merchant = registry.merchant("m1")
+        merchant.download_bill("trade", "2023-01-01").close()
+        for result in merchant.download_bills([("trade", "2023-01-02")]):
+            result.response.close()
+        queries = [parse_qs(urlsplit(url).query) for url, _ in transport.requests if "gateway" in url]
+        self.assertEqual(len(queries), 2)
+        for query in queries:
+            self.assertEqual(query["app_auth_token"], ["token-1"])
+
+
+@unittest.skipIf(not importlib.util.find_spec("numpy"), "numpy is not installed")
+class ReconcileTestCase(AliPayTestCase):
+
+    def test_reconcile(self):
+        import io
+        from alipay.bill import BillRecord
+        from alipay.reconcile import Reconciler
+
+        columns = {"商户订单号": 0, "订单金额（元）": 1, "业务类型": 2}
+        rows = [BillRecord(columns, (str(i), "{}.50".format(i), "交易")) for i in range(10)]
+        rows.append(BillRecord(columns, ("3", "-1.50", "退款")))
+        rows.append(BillRecord(columns, ("100", "1.00", "交易")))
+        orders = [(str(i), "{}.50".format(i), "TRADE_SUCCESS") for i in range(10) if i not in (4, 5)]
+        orders[3] = ("3", "3.50", "TRADE_SUCCESS", "1.50")
+        orders.append(("4", "4.00", "TRADE_SUCCESS"))
+        orders.append(("5", "5.50", "TRADE_CLOSED"))
+        orders.append(("200", "1.00", "TRADE_SUCCESS"))
+        orders.append(("201", "1.00", "WAIT_BUYER_PAY"))
+
+        reconciler = Reconciler(chunk_size=3)
+        reconciler.add_bill_rows(iter(rows))
+        reconciler.add_local_orders(orders)
+        result = reconciler.run()
+        self.assertEqual(dict(result.issues()), {
+            "4": ["amount"],
+            "5": ["status"],
+            "100": ["missing_local"],
+            "200": ["missing_remote"],
+        })
+        counts = result.counts()
+        self.assertEqual((counts["total"], counts["matched"]), (13, 9))
+
+        fp = io.StringIO()
+        self.assertEqual(result.write_csv(fp), 4)
+        self.assertIn("4,amount,4.50,4.00,TRADE_SUCCESS,TRADE_SUCCESS,0.00,0.00", fp.getvalue())
+
+    def test_query_results(self):
+        from alipay.reconcile import Reconciler
+
+        reconciler = Reconciler()
+        reconciler.add_query_results([
+            {"code": "10000", "out_trade_no": "1", "total_amount": "1.00", "trade_status": "TRADE_SUCCESS"},
+            {"code": "40004", "sub_code": "ACQ.TRADE_NOT_EXIST"},
+        ])
+        reconciler.add_local_orders([("1", "1.00", "TRADE_SUCCESS", "0.50")])
+        self.assertEqual(list(reconciler.run().issues()), [("1", ["refund"])])
+
+    def test_bill_statuses(self):
+        from alipay.bill import BillRecord
+        from alipay.reconcile import Reconciler
+
+        columns = {"商户订单号": 0, "订单金额（元）": 1, "业务类型": 2}
+        reconciler = Reconciler()
+        reconciler.add_bill_rows([
+            BillRecord(columns, ("1", "1.00", "交易")),
+            BillRecord(columns, ("2", "1.00", "交易")),
+            # refunded, the trade itself is in an older bill
+            BillRecord(columns, ("3", "-1.00", "退款")),
+        ])
+        reconciler.add_query_results([
+            {"code": "10000", "out_trade_no": "4", "total_amount": "1.00", "trade_status": "TRADE_SUCCESS"},
+        ])
+        reconciler.add_local_orders([
+            ("1", "1.00", "TRADE_FINISHED"), ("2", "1.00", "TRADE_CLOSED"), ("4", "1.00", "TRADE_FINISHED")
+        ])
+        # bills only tell whether a trade is paid, query results tell its state
+        self.assertEqual(dict(reconciler.run().issues()), {
+            "2": ["status"], "3": ["missing_local"], "4": ["status"]
+        })
+
+
+class ResponseObjectTestCase(AliPayTestCase):
+
+    def query_response(self, alipay, data):
+        return self._prepare_sync_response(alipay, "alipay_trade_query_response", data)
+
+    def test_lazy_response(self):
+        from decimal import Decimal
+        from alipay.responses import TradeQueryResponse
+        from alipay.utils import AliPayConfig
+
+        alipay = self.get_client("RSA2", config=AliPayConfig(response_objects=True))
+        data = {"code": "10000", "msg": "Success", "out_trade_no": "1", "trade_status": "TRADE_SUCCESS",
+                "total_amount": "88.88",
+                "fund_bill_list": [{"amount": "88.88", "fund_channel": "ALIPAYACCOUNT"}]}
+        with mock.patch.object(alipay, "_request", return_value=self.query_response(alipay, data)):
+            with mock.patch.object(json, "loads", side_effect=json.loads) as loads:
+                result = alipay.api_alipay_trade_query(out_trade_no="1")
+                self.assertFalse(loads.called)
+        self.assertIsInstance(result, TradeQueryResponse)
+        self.assertEqual(result.trade_status, "TRADE_SUCCESS")
+        self.assertEqual(result.total_amount, Decimal("88.88"))
+        self.assertIsNone(result.receipt_amount)
+        self.assertEqual(result["out_trade_no"], "1")
+        self.assertEqual(result.get("fund_bill_list"), data["fund_bill_list"])
+        self.assertEqual(result.as_dict(), data)
+        # decoded once, undeclared fields included
+        with mock.patch.object(result._json, "loads") as loads:
+            for _ in range(3):
+                self.assertIn("fund_bill_list", result)
+                self.assertIsNone(result.get("unknown"))
+            self.assertFalse(loads.called)
+        with self.assertRaises(AttributeError):
+            result.unknown_field
+
+        # a tampered response is rejected before anything is decoded
+        tampered = self.query_response(alipay, data).replace(b"88.88", b"0.01", 1)
+        with mock.patch.object(alipay, "_request", return_value=tampered):
+            with self.assertRaises(AliPayValidationError):
+                alipay.api_alipay_trade_query(out_trade_no="1")
+
+    def test_shared_responses(self):
+        from alipay.responses import TradeQueryResponse
+        from alipay.tradecache import TradeStateCache
+        from alipay.utils import AliPayConfig
+
+        data = {"code": "10000", "msg": "Success", "out_trade_no": "1", "trade_status": "TRADE_SUCCESS"}
+        for json_backend in ("json", "orjson", "ujson"):
+            if not importlib.util.find_spec(json_backend):
+                continue
+            for config in ({"single_flight": True}, {"trade_cache": TradeStateCache()}):
+                alipay = self.get_client("RSA2", config=AliPayConfig(
+                    response_objects=True, json_backend=json_backend, **config
+                ))
+                with mock.patch.object(alipay, "_request", return_value=self.query_response(alipay, data)):
+                    for _ in range(2):
+                        result = alipay.api_alipay_trade_query(out_trade_no="1")
+                        self.assertIsInstance(result, TradeQueryResponse)
+                        self.assertEqual(result.as_dict(), data)
+
+    def test_cached_notification(self):
+        from decimal import Decimal
+        from alipay.responses import TradeQueryResponse
+        from alipay.tradecache import TradeStateCache
+        from alipay.utils import AliPayConfig
+
+        alipay = self.get_client(
+            "RSA2", config=AliPayConfig(response_objects=True, trade_cache=TradeStateCache())
+        )
+        data = {"notify_id": "n1", "out_trade_no": "1", "trade_status": "TRADE_SUCCESS",
+                "total_amount": "88.88"}
+        signature = alipay._sign("&".join("{}={}".format(k, v) for k, v in sorted(data.items())))
+        self.assertTrue(alipay.verify(data, signature))
+        with mock.patch.object(alipay, "_request") as request:
+            result = alipay.api_alipay_trade_query(out_trade_no="1")
+        self.assertFalse(request.called)
+        # the same type as answers of the gateway
+        self.assertIsInstance(result, TradeQueryResponse)
+        self.assertEqual(result.total_amount, Decimal("88.88"))
+
+    def test_other_responses(self):
+        from alipay.utils import AliPayConfig
+
+        alipay = self.get_client("RSA2", config=AliPayConfig(response_objects=True))
+        # not an api family with a response object
+        data = {"code": "10000", "msg": "Success"}
+        content = json.dumps(data)
+        response = json.dumps({"alipay_trade_close_response": data, "sign": alipay._sign(content)})
+        with mock.patch.object(alipay, "_request", return_value=response.encode()):
+            self.assertEqual(alipay.api_alipay_trade_close(out_trade_no="1"), data)
+
+        # str responses are parsed as usual and wrapped
+        data = {"code": "40004", "msg": "Business Failed", "sub_code": "ACQ.TRADE_NOT_EXIST"}
+        with mock.patch.object(alipay, "_request", return_value=self.query_response(alipay, data).decode()):
+            result = alipay.api_alipay_trade_query(out_trade_no="1")
+        self.assertEqual(
+            (result.code, result.sub_code, result.trade_status), ("40004", "ACQ.TRADE_NOT_EXIST", None)
+        )
+
+
+class TradePollerTestCase(AliPayTestCase):
+
+    def test_polling(self):
+        from alipay.polling import TradePoller
+
+        alipay = self.get_client("RSA2")
+        states = {"1": "WAIT_BUYER_PAY", "2": "WAIT_BUYER_PAY"}
+
+        def query(out_trade_no):
+            if out_trade_no not in states:
+                return {"code": "40004", "msg": "Business Failed", "sub_code": "ACQ.TRADE_NOT_EXIST"}
+            return {"code": "10000", "msg": "Success", "out_trade_no": out_trade_no,
+                    "trade_status": states[out_trade_no]}
+
+        changes, expired = [], []
+        poller = TradePoller(
+            alipay, schedule=(1, 2, 5),
+            on_change=lambda t, old, new, r: changes.append((t.out_trade_no, old, new)),
+            on_expire=lambda t: expired.append(t.out_trade_no)
+        )
+        now = time.time()
+        with mock.patch("alipay.polling.time.time", return_value=now):
+            for out_trade_no in ("1", "2", "3"):
+                poller.add(out_trade_no, timeout=20)
+        with mock.patch.object(alipay, "api_alipay_trade_query", side_effect=query) as api:
+            self.assertEqual(poller.run_due(now), 0)
+            self.assertEqual(poller.run_due(now + 1), 3)
+            self.assertEqual(sorted(changes), [("1", None, "WAIT_BUYER_PAY"), ("2", None, "WAIT_BUYER_PAY")])
+            # the next query is 2 seconds later, then 5 seconds
+            self.assertEqual(poller.run_due(now + 2.5), 0)
+            self.assertEqual(poller.run_due(now + 3), 3)
+            states["1"] = "TRADE_SUCCESS"
+            self.assertEqual(poller.run_due(now + 7), 0)
+            self.assertEqual(poller.run_due(now + 8), 3)
+            self.assertNotIn("1", poller)
+            self.assertIn(("1", "WAIT_BUYER_PAY", "TRADE_SUCCESS"), changes)
+            # the last query is sent when the trades expire
+            self.assertEqual(poller.run_due(now + 13), 2)
+            self.assertEqual(poller.run_due(now + 18), 2)
+            self.assertEqual(expired, [])
+            self.assertEqual(poller.run_due(now + 20), 2)
+            self.assertEqual(sorted(expired), ["2", "3"])
+            self.assertEqual(len(poller), 0)
+            self.assertEqual(api.call_count, 15)
+
+    def test_notify_and_checkpoint(self):
+        import tempfile
+        from alipay.polling import TradePoller
+
+        alipay = self.get_client("RSA2")
+        changes = []
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "poller.json")
+            poller = TradePoller(alipay, checkpoint_path=path)
+            poller.add("1")
+            poller.add("2", expires_at=time.time() + 60)
+            with mock.patch.object(alipay, "api_alipay_trade_query",
+                                   side_effect=OSError("connection reset")) as api:
+                self.assertEqual(poller.run_due(time.time() + 1), 2)
+                self.assertEqual(api.call_count, 2)
+
+            # picked up after a restart
+            restarted = TradePoller(alipay, checkpoint_path=path,
+                                    on_change=lambda t, old, new, r: changes.append((t.out_trade_no, new)))
+            self.assertEqual(restarted.checkpoint(), poller.checkpoint())
+            restarted.notify({"out_trade_no": "1", "trade_status": "TRADE_SUCCESS"})
+            self.assertNotIn("1", restarted)
+            self.assertEqual(changes, [("1", "TRADE_SUCCESS")])
+
+            with mock.patch.object(alipay, "api_alipay_trade_query",
+                                   return_value={"code": "10000", "trade_status": "TRADE_CLOSED"}) as api:
+                restarted.start()
+                for _ in range(100):
+                    if not len(restarted):
+                        break
+                    time.sleep(0.05)
+                restarted.stop()
+            self.assertEqual(api.call_args_list, [mock.call("2")])
+            self.assertEqual(json.load(open(path))["trades"], [])
+
+    def test_slow_batches(self):
+        from alipay.polling import TradePoller
+
+        alipay = self.get_client("RSA2")
+
+        def query(out_trade_no):
+            time.sleep(0.05)
+            return {"code": "10000", "out_trade_no": out_trade_no, "trade_status": "WAIT_BUYER_PAY"}
+
+        poller = TradePoller(alipay, schedule=(0, 1), max_workers=1, batch_size=2)
+        for i in range(6):
+            poller.add(str(i), delay=0)
+        with mock.patch.object(alipay, "api_alipay_trade_query", side_effect=query):
+            started = time.time()
+            self.assertEqual(poller.run_due(), 6)
+        # the next polls are a second after each result, not after the run started
+        dues = sorted(trade.due for trade in poller._trades.values())
+        self.assertGreater(dues[-1] - dues[0], 0.2)
+        self.assertGreater(dues[0], started + 1)
+
+    def test_resolved_while_querying(self):
+        from alipay.polling import TradePoller
+
+        alipay = self.get_client("RSA2")
+        changes = []
+        poller = TradePoller(alipay, on_change=lambda t, old, new, r: changes.append((old, new)))
+
+        def query(out_trade_no):
+            # a notification arrives before the stale answer of the query
+            poller.resolve(out_trade_no, "TRADE_SUCCESS")
+            return {"code": "10000", "out_trade_no": out_trade_no, "trade_status": "WAIT_BUYER_PAY"}
+
+        poller.add("1", delay=0)
+        with mock.patch.object(alipay, "api_alipay_trade_query", side_effect=query) as api:
+            self.assertEqual(poller.run_due(), 1)
+            self.assertEqual(poller.run_due(time.time() + 3600), 0)
+        self.assertEqual(api.call_count, 1)
+        self.assertNotIn("1", poller)
+        self.assertEqual(changes, [(None, "TRADE_SUCCESS")])
+
+        # resolved while the answer of the query is handled
+        def on_change(trade, old, new, result):
+            changes.append((old, new))
+            if new == "WAIT_BUYER_PAY":
+                poller.resolve(trade.out_trade_no, "TRADE_SUCCESS")
+
+        del changes[:]
+        poller.on_change = on_change
+        poller.add("2", delay=0)
+        with mock.patch.object(alipay, "api_alipay_trade_query", return_value={
+            "code": "10000", "out_trade_no": "2", "trade_status": "WAIT_BUYER_PAY"
+        }) as api:
+            self.assertEqual(poller.run_due(), 1)
+            self.assertEqual(poller.run_due(time.time() + 3600), 0)
+        self.assertNotIn("2", poller)
+        self.assertEqual(changes, [(None, "WAIT_BUYER_PAY"), ("WAIT_BUYER_PAY", "TRADE_SUCCESS")])